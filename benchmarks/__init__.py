@@ -0,0 +1,4 @@
+"""
+Microbenchmarks for the USPS API wrappers, run a module with
+python -m benchmarks.<module>
+"""
@@ -0,0 +1,213 @@
+"""
+End-to-end throughput and latency of the service wrappers against the
+local fake ShippingAPI.dll
+
+The fake server runs in its own process so it does not compete with the
+client for the interpreter lock. For every service, batch size and
+concurrency level the runner reports calls/sec, items/sec, p50/p95/p99
+call latency, failed calls and how much the process' peak RSS grew.
+
+    python -m benchmarks.endtoend [--calls 200] [--batch-sizes 1,5,25]
+        [--concurrency 1,4,16] [--latency 0.0] [--error-rate 0.0]
+        [--services AddressValidate,...] [--url http://...]
+        [--transport urllib|pooled] [--record DIR] [--replay DIR]
+
+--record saves every response while benchmarking, --replay serves them
+back from memory without any server so only client-side CPU is measured.
+"""
+import optparse
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+from usps.api.addressinformation import AddressValidate
+from usps.api.ratecalculator import DomesticRateCalculator
+from usps.api.servicestandards import get_service_standards, get_bulk_service_standards
+from usps.api.tracking import TrackConfirm
+from usps.transport import UrllibTransport, HTTPConnectionPool, RecordingTransport, ReplayTransport
+from benchmarks import payloads
+
+USERID = 'BENCHMARK'
+PASSWORD = 'BENCHMARK'
+
+
+def address_batch(size):
+    return [{'Address2': '%s Ivy Lane' % index, 'City': 'Greenbelt', 'State': 'MD',
+             'Zip5': '', 'Zip4': ''} for index in range(size)]
+
+
+def track_batch(size):
+    return [{'ID': 'EJ%09dUS' % index} for index in range(size)]
+
+
+def execute_service(service_class, make_batch):
+    def run(url, transport, size):
+        service = service_class(url, USERID, PASSWORD, transport=transport)
+        data = make_batch(size)
+        return lambda: service.execute(data)
+    return run
+
+
+def service_standards(url, transport, size):
+    packages = [{'OriginZip': '207', 'DestinationZip': '%05d' % (11210 + index), 'CLASSID': 4}
+                for index in range(size)]
+
+    def call():
+        for package in packages:
+            get_service_standards(dict(package), url, USERID, PASSWORD, transport)
+    return call
+
+
+def bulk_service_standards(url, transport, size):
+    packages = [('207', '%05d' % (11210 + index), 4) for index in range(size)]
+    return lambda: get_bulk_service_standards(packages, url, USERID, PASSWORD, transport)
+
+
+SERVICES = [('AddressValidate', execute_service(AddressValidate, address_batch)),
+            ('DomesticRateCalculator', execute_service(DomesticRateCalculator, payloads.rate_request)),
+            ('TrackConfirm', execute_service(TrackConfirm, track_batch)),
+            ('get_service_standards', service_standards),
+            ('bulk_service_standards', bulk_service_standards),
+            ]
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def measure(call, calls, concurrency):
+    """
+    Run call calls times from concurrency threads
+    @return: (elapsed seconds, sorted latencies, failures)
+    """
+    latencies = list()
+    failures = [0]
+    lock = threading.Lock()
+    remaining = [calls]
+
+    def worker():
+        while True:
+            lock.acquire()
+            try:
+                if not remaining[0]:
+                    return
+                remaining[0] -= 1
+            finally:
+                lock.release()
+            started = time.time()
+            try:
+                call()
+            except Exception:
+                failed = True
+            else:
+                failed = False
+            latency = time.time() - started
+            lock.acquire()
+            try:
+                latencies.append(latency)
+                failures[0] += failed
+            finally:
+                lock.release()
+
+    threads = [threading.Thread(target=worker) for i in range(concurrency)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.time() - started, sorted(latencies), failures[0]
+
+
+def peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def transport_factory(options):
+    """
+    @return: a function of the concurrency level returning a new transport
+    """
+    def make_transport(concurrency):
+        if options.replay:
+            return ReplayTransport(options.replay)
+        if options.transport == 'pooled':
+            transport = HTTPConnectionPool(maxsize=concurrency)
+        else:
+            transport = UrllibTransport()
+        if options.record:
+            transport = RecordingTransport(transport, options.record)
+        return transport
+    return make_transport
+
+
+def run(url, services, batch_sizes, concurrencies, calls, make_transport):
+    print '%-22s %5s %4s %9s %10s %9s %9s %9s %6s %9s' % (
+        'service', 'batch', 'conc', 'calls/s', 'items/s', 'p50 ms', 'p95 ms', 'p99 ms', 'errors', 'rss +KB')
+    for name, factory in SERVICES:
+        if services and name not in services:
+            continue
+        for size in batch_sizes:
+            for concurrency in concurrencies:
+                transport = make_transport(concurrency)
+                call = factory(url, transport, size)
+                rss = peak_rss()
+                elapsed, latencies, failures = measure(call, calls, concurrency)
+                print '%-22s %5d %4d %9.1f %10.1f %9.2f %9.2f %9.2f %6d %9d' % (
+                    name, size, concurrency, calls / elapsed, calls * size / elapsed,
+                    percentile(latencies, 0.50) * 1000, percentile(latencies, 0.95) * 1000,
+                    percentile(latencies, 0.99) * 1000, failures, peak_rss() - rss)
+                transport.close()
+
+
+def start_server(options):
+    """
+    Start the fake server in a subprocess
+    @return: (process, url)
+    """
+    process = subprocess.Popen([sys.executable, '-m', 'benchmarks.fakeserver',
+                                '--latency', str(options.latency),
+                                '--jitter', str(options.jitter),
+                                '--error-rate', str(options.error_rate)],
+                               stdout=subprocess.PIPE)
+    return process, process.stdout.readline().strip()
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--url', help='benchmark an already running server')
+    parser.add_option('--calls', type='int', default=200)
+    parser.add_option('--batch-sizes', default='1,5,25')
+    parser.add_option('--concurrency', default='1,4,16')
+    parser.add_option('--services', default='')
+    parser.add_option('--latency', type='float', default=0.0)
+    parser.add_option('--jitter', type='float', default=0.0)
+    parser.add_option('--error-rate', type='float', default=0.0)
+    parser.add_option('--transport', choices=['urllib', 'pooled'], default='urllib')
+    parser.add_option('--record', help='save responses to this directory')
+    parser.add_option('--replay', help='serve responses saved with --record')
+    options, args = parser.parse_args(argv)
+
+    process = None
+    url = options.url
+    if options.replay:
+        url = url or 'http://localhost/ShippingAPI.dll'
+    elif url is None:
+        process, url = start_server(options)
+    try:
+        run(url,
+            [name for name in options.services.split(',') if name],
+            [int(size) for size in options.batch_sizes.split(',')],
+            [int(level) for level in options.concurrency.split(',')],
+            options.calls,
+            transport_factory(options))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == '__main__':
+    main()
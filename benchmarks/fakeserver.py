@@ -0,0 +1,151 @@
+"""
+Local stand-in for ShippingAPI.dll which replays recorded responses
+
+Every request is answered from benchmarks/fixtures/<API>.xml. For APIs
+that batch items the recorded item is repeated once per requested item
+with the request's ID attribute, so chunking and reordering behave as
+they do against USPS.
+
+    python -m benchmarks.fakeserver [--port 8080] [--latency 0.05]
+        [--jitter 0.02] [--error-rate 0.01] [--http-error-rate 0.0]
+"""
+import copy
+import optparse
+import os
+import random
+import sys
+import time
+import urlparse
+import BaseHTTPServer
+import SocketServer
+import threading
+
+from xml.etree import cElementTree as ET
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+ERROR = ('<?xml version="1.0"?><Error><Number>80040b19</Number>'
+         '<Description>XML Syntax Error: Please check the XML request to see if it can be parsed.</Description>'
+         '<Source>USPSCOM::DoAuth</Source></Error>')
+
+
+def load_fixtures(directory=FIXTURES):
+    """
+    @return: a dictionary of API name to parsed fixture response
+    """
+    fixtures = dict()
+    for filename in os.listdir(directory):
+        if filename.endswith('.xml'):
+            fixtures[filename[:-4]] = ET.parse(os.path.join(directory, filename)).getroot()
+    return fixtures
+
+
+class FakeUSPSHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    #buffer the status line and headers so keep-alive replies are not held back by Nagle
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.getheader('Content-Length', 0))
+        params = dict(urlparse.parse_qsl(self.rfile.read(length)))
+        if server.latency or server.jitter:
+            time.sleep(server.latency + random.uniform(0, server.jitter))
+        if random.random() < server.http_error_rate:
+            self.reply(503, 'Service Unavailable')
+            return
+        if random.random() < server.error_rate:
+            self.reply(200, ERROR)
+            return
+        try:
+            body = server.respond(params.get('API'), ET.fromstring(params['XML']))
+        except (KeyError, SyntaxError):
+            body = ERROR
+        self.reply(200, body)
+
+    def reply(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeUSPSServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Threaded HTTP server answering USPS API calls from fixtures
+    """
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address=('127.0.0.1', 0), latency=0.0, jitter=0.0,
+                 error_rate=0.0, http_error_rate=0.0, fixtures=None):
+        """
+        @param latency: seconds every response is delayed by
+        @param jitter: up to this many seconds are randomly added to latency
+        @param error_rate: fraction of requests answered with a USPS Error document
+        @param http_error_rate: fraction of requests answered with HTTP 503
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, address, FakeUSPSHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.http_error_rate = http_error_rate
+        if fixtures is None:
+            fixtures = load_fixtures()
+        self.fixtures = fixtures
+
+    @property
+    def url(self):
+        return 'http://%s:%s/ShippingAPI.dll' % self.server_address
+
+    def respond(self, api, request):
+        """
+        @param api: the API parameter of the request
+        @param request: the parsed request element
+        @return: the response body
+        """
+        fixture = self.fixtures[api]
+        if not len(request) or not len(fixture) or fixture[0].get('ID') is None:
+            return ET.tostring(fixture)
+        response = ET.Element(fixture.tag)
+        for item in request:
+            reply = copy.deepcopy(fixture[0])
+            reply.set('ID', item.get('ID'))
+            response.append(reply)
+        return ET.tostring(response)
+
+    def start(self):
+        """
+        Serve from a daemon thread
+        """
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--host', default='127.0.0.1')
+    parser.add_option('--port', type='int', default=0)
+    parser.add_option('--latency', type='float', default=0.0)
+    parser.add_option('--jitter', type='float', default=0.0)
+    parser.add_option('--error-rate', type='float', default=0.0)
+    parser.add_option('--http-error-rate', type='float', default=0.0)
+    options, args = parser.parse_args(argv)
+    server = FakeUSPSServer((options.host, options.port), options.latency, options.jitter,
+                            options.error_rate, options.http_error_rate)
+    print server.url
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
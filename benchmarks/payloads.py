@@ -0,0 +1,107 @@
+"""
+Realistic USPS request data and response bodies for benchmarks
+"""
+
+MAIL_SERVICES = [
+    (0, 'First-Class Mail Parcel'),
+    (1, 'Priority Mail'),
+    (2, 'Express Mail Hold For Pickup'),
+    (3, 'Express Mail'),
+    (4, 'Parcel Post'),
+    (5, 'Bound Printed Matter'),
+    (6, 'Media Mail'),
+    (7, 'Library Mail'),
+    (12, 'First-Class Postcard Stamped'),
+    (13, 'Express Mail Flat Rate Envelope'),
+    (16, 'Priority Mail Flat Rate Envelope'),
+    (17, 'Priority Mail Regular Flat Rate Box'),
+    (22, 'Priority Mail Large Flat Rate Box'),
+    (23, 'Express Mail Sunday/Holiday'),
+    (28, 'Priority Mail Small Flat Rate Box'),
+    ]
+
+
+def rate_request(count=25):
+    """
+    @return: a list of DomesticRateCalculator data dictionaries
+    """
+    return [{'Service': 'ALL',
+             'FirstClassMailType': 'PARCEL',
+             'ZipOrigination': '44106',
+             'ZipDestination': '%05d' % (97217 - index),
+             'Pounds': str(index % 20),
+             'Ounces': '%s.5' % (index % 16),
+             'Container': None,
+             'Size': 'REGULAR',
+             'Machinable': 'true',
+             } for index in range(count)]
+
+
+def intl_rate_request(count=25):
+    """
+    @return: a list of InternationalRateCalculator data dictionaries
+    """
+    return [{'Pounds': str(index % 10),
+             'Ounces': '3',
+             'MailType': 'Package',
+             'GXG': {'Length': '46',
+                     'Width': '14',
+                     'Height': '15',
+                     'POBoxFlag': 'N',
+                     'GiftFlag': 'N'},
+             'ValueOfContents': '250',
+             'Country': 'Japan',
+             } for index in range(count)]
+
+
+def rate_response(count=25):
+    """
+    @return: a RateV3 response body quoting every service for count packages
+    """
+    packages = list()
+    for index in range(count):
+        postage = ''.join('<Postage CLASSID="%s"><MailService>%s</MailService>'
+                          '<Rate>%s.%02d</Rate></Postage>' % (class_id, service, 5 + class_id, index)
+                          for class_id, service in MAIL_SERVICES)
+        packages.append('<Package ID="%s"><ZipOrigination>44106</ZipOrigination>'
+                        '<ZipDestination>%05d</ZipDestination><Pounds>%s</Pounds>'
+                        '<Ounces>%s.5</Ounces><Size>REGULAR</Size><Machinable>TRUE</Machinable>'
+                        '<Zone>8</Zone>%s</Package>' % (index, 97217 - index, index % 20, index % 16, postage))
+    return '<?xml version="1.0"?><RateV3Response>%s</RateV3Response>' % ''.join(packages)
+
+
+def track_response(count=10, events=12):
+    """
+    @return: a TrackV2 response body for count tracking numbers
+    """
+    infos = list()
+    for index in range(count):
+        details = ''.join('<TrackDetail>May %s %s:07 am ARRIVAL AT UNIT WILMINGTON DE 19850.</TrackDetail>'
+                          % (30 - event % 28, 1 + event % 12) for event in range(events))
+        infos.append('<TrackInfo ID="EJ%09dUS"><TrackSummary>Your item was delivered at 8:10 am '
+                     'on June 1 in Wilmington DE 19801.</TrackSummary>%s</TrackInfo>' % (index, details))
+    return '<?xml version="1.0"?><TrackResponse>%s</TrackResponse>' % ''.join(infos)
+
+
+def address_response(count=5):
+    """
+    @return: an AddressValidate response body for count addresses
+    """
+    addresses = ''.join('<Address ID="%s"><Address2>%s IVY LN</Address2><City>GREENBELT</City>'
+                        '<State>MD</State><Zip5>20770</Zip5><Zip4>1440</Zip4></Address>' % (index, 6400 + index)
+                        for index in range(count))
+    return '<?xml version="1.0"?><AddressValidateResponse>%s</AddressValidateResponse>' % addresses
+
+
+def express_response():
+    """
+    @return: an ExpressMailCommitment response body
+    """
+    location = ('<Location><City>GREENBELT</City><State>MD</State><Street>119 CENTER WAY</Street>'
+                '<Zip>20770</Zip><Facility>EXPRESS MAIL COLLECTION BOX</Facility><CutOff>6:00 PM</CutOff></Location>')
+    commitment = ('<Commitment><CommitmentName>Next Day</CommitmentName><CommitmentTime>3:00 PM</CommitmentTime>'
+                  '<CommitmentSequence>A0115</CommitmentSequence>%s</Commitment>' % (location * 3))
+    return ('<?xml version="1.0"?><ExpressMailCommitmentResponse><OriginZIP>20770</OriginZIP>'
+            '<OriginCity>GREENBELT</OriginCity><OriginState>MD</OriginState><DestinationZIP>11210</DestinationZIP>'
+            '<DestinationCity>BROOKLYN</DestinationCity><DestinationState>NY</DestinationState>'
+            '<Date>05-Aug-2004</Date><Time>11:30 AM</Time>%s</ExpressMailCommitmentResponse>' % (commitment * 2))
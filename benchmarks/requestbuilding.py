@@ -0,0 +1,45 @@
+"""
+Compare request serialization through make_xml and ET.tostring against
+the precompiled RequestTemplate used by make_request
+
+    python -m benchmarks.requestbuilding [repeat]
+"""
+import sys
+import timeit
+
+from usps.api.base import ET
+from usps.api.addressinformation import AddressValidate
+from usps.api.ratecalculator import DomesticRateCalculator, InternationalRateCalculator
+from benchmarks import payloads
+
+
+def cases():
+    address = [{'Address2': '%s Ivy Lane' % index, 'City': 'Greenbelt', 'State': 'MD',
+                'Zip5': '', 'Zip4': ''} for index in range(5)]
+    return [('RateV3 25 packages', DomesticRateCalculator, payloads.rate_request(25)),
+            ('IntlRate 25 packages', InternationalRateCalculator, payloads.intl_rate_request(25)),
+            ('AddressValidate 5', AddressValidate, address),
+            ]
+
+
+def best_of(func, repeat, number):
+    return min(timeit.repeat(func, repeat=repeat, number=number)) / number
+
+
+def run(repeat=5, number=500):
+    print '%-24s %12s %12s %8s' % ('case', 'tree us', 'template us', 'speedup')
+    for name, service_class, data in cases():
+        service = service_class('http://localhost/ShippingAPI.dll', 'USERID', 'PASSWORD')
+        tree = lambda: ET.tostring(service.make_xml(data, 'USERID', 'PASSWORD'))
+        template = lambda: service.make_request(data, 'USERID', 'PASSWORD')
+        assert tree() == template()
+        legacy = best_of(tree, repeat, number)
+        current = best_of(template, repeat, number)
+        print '%-24s %12.1f %12.1f %7.2fx' % (name, legacy * 1e6, current * 1e6, legacy / current)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        run(repeat=int(sys.argv[1]))
+    else:
+        run()
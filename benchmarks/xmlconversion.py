@@ -0,0 +1,129 @@
+"""
+Compare xmltodict and dicttoxml against the original recursive versions
+
+Both versions run on the same cElementTree elements so the speedup is that
+of the conversion code alone. The switch from the pure python ElementTree
+the package used to parse with to cElementTree is reported separately.
+
+    python -m benchmarks.xmlconversion [repeat]
+"""
+import sys
+import timeit
+
+from xml.etree import ElementTree as ET
+
+from usps.utils import xmltodict, dicttoxml, ET as CurrentET
+from usps.api.ratecalculator import DomesticRateCalculator, InternationalRateCalculator
+from benchmarks import payloads
+
+
+def legacy_dicttoxml(dictionary, tagname, attributes=None, etree=CurrentET):
+    element = etree.Element(tagname)
+    if attributes:
+        for key in attributes:
+            value = dictionary.get(key, False)
+            if type(value).__name__ == 'dict':
+                elem = legacy_dicttoxml(value, key, attributes, etree)
+                element.append(elem)
+            elif value != False:
+                etree.SubElement(element, key).text = value
+    else:
+        for key, value in dictionary.iteritems():
+            if type(value).__name__ == 'dict':
+                elem = legacy_dicttoxml(value, key, None, etree)
+                element.append(elem)
+            else:
+                etree.SubElement(element, key).text = value
+    return element
+
+
+def legacy_xmltodict(element):
+    ret = dict()
+    for item in element:
+        if len(item) > 0:
+            value = legacy_xmltodict(item)
+            if len(item.attrib.items()) > 0:
+                for k, v in item.attrib.items():
+                    value[k] = v
+        elif len(item.attrib.items()) > 0:
+            value = {'text': item.text}
+            for k, v in item.attrib.items():
+                    value[k] = v
+        else:
+            value = item.text
+
+        if item.tag in ret and type(ret[item.tag]).__name__ != 'list':
+            old_value = ret.get(item.tag, None)
+            ret[item.tag] = [old_value,value,]
+        elif item.tag in ret and type(ret[item.tag]).__name__ == 'list':
+            ret[item.tag].append(value)
+        else:
+            ret[item.tag] = value
+    return ret
+
+
+def parse_cases():
+    return [('RateV3 25 packages x ALL', payloads.rate_response(25)),
+            ('TrackV2 10 ids', payloads.track_response(10)),
+            ('AddressValidate 5', payloads.address_response(5)),
+            ('ExpressMailCommitment', payloads.express_response()),
+            ]
+
+
+def serialize_cases():
+    return [('RateV3 25 packages', payloads.rate_request(25), DomesticRateCalculator.PARAMETERS),
+            ('IntlRate 25 packages', payloads.intl_rate_request(25), InternationalRateCalculator.PARAMETERS),
+            ('IntlRate 25 unordered', payloads.intl_rate_request(25), None),
+            ]
+
+
+def best_of(func, repeat, number):
+    return min(timeit.repeat(func, repeat=repeat, number=number)) / number
+
+
+def report(name, before, after):
+    print '%-40s %12.1f %12.1f %7.2fx' % (name, before * 1e6, after * 1e6, before / after)
+
+
+def run(repeat=5, number=200):
+    print '%-40s %12s %12s %8s' % ('conversion on cElementTree', 'legacy us', 'current us', 'speedup')
+    for name, body in parse_cases():
+        root = CurrentET.fromstring(body)
+        assert [xmltodict(item) for item in root] == [legacy_xmltodict(item) for item in root]
+        legacy = best_of(lambda: [legacy_xmltodict(item) for item in root], repeat, number)
+        current = best_of(lambda: [xmltodict(item) for item in root], repeat, number)
+        report('xmltodict ' + name, legacy, current)
+
+    for name, data, parameters in serialize_cases():
+        assert ([ET.tostring(dicttoxml(item, 'Package', parameters)) for item in data] ==
+                [ET.tostring(legacy_dicttoxml(item, 'Package', parameters)) for item in data])
+        legacy = best_of(lambda: [legacy_dicttoxml(item, 'Package', parameters) for item in data], repeat, number)
+        current = best_of(lambda: [dicttoxml(item, 'Package', parameters) for item in data], repeat, number)
+        report('dicttoxml ' + name, legacy, current)
+
+    print
+    print '%-40s %12s %12s %8s' % ('ElementTree to cElementTree', 'python us', 'C us', 'speedup')
+    for name, body in parse_cases():
+        legacy = best_of(lambda: ET.fromstring(body), repeat, number)
+        current = best_of(lambda: CurrentET.fromstring(body), repeat, number)
+        report('parse ' + name, legacy, current)
+
+    for name, body in parse_cases():
+        python_root = ET.fromstring(body)
+        root = CurrentET.fromstring(body)
+        legacy = best_of(lambda: [legacy_xmltodict(item) for item in python_root], repeat, number)
+        current = best_of(lambda: [legacy_xmltodict(item) for item in root], repeat, number)
+        report('legacy xmltodict ' + name, legacy, current)
+
+    for name, data, parameters in serialize_cases():
+        legacy = best_of(lambda: [legacy_dicttoxml(item, 'Package', parameters, ET) for item in data],
+                         repeat, number)
+        current = best_of(lambda: [legacy_dicttoxml(item, 'Package', parameters) for item in data],
+                          repeat, number)
+        report('legacy dicttoxml ' + name, legacy, current)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        run(repeat=int(sys.argv[1]))
+    else:
+        run()
@@ -26,9 +26,15 @@ setup(name='python-usps',
       maintainer_email = 'zbyte64@gmail.com',
       url='http://github.com/cuker/python-usps',
       license='New BSD License',
-      packages=find_packages(exclude=['ez_setup']),
+      packages=find_packages(exclude=['ez_setup', 'benchmarks']),
       zip_safe=False,
       install_requires=[
       ],
+      extras_require={
+          'numpy': ['numpy'],
+      },
+      entry_points={
+          'console_scripts': ['usps-validate-addresses = usps.bulkvalidate:main'],
+      },
       #test_suite='tests.test_suite',
       )
@@ -1,12 +1,38 @@
 """
 Tests for USPS API wrappers
 """
+import os
+import shutil
+import socket
+import tempfile
 import unittest
+import threading
+import time
+import urlparse
+import BaseHTTPServer
+from StringIO import StringIO
+from xml.etree import ElementTree as ET
 from usps.api import USPS_CONNECTION_TEST, USPS_CONNECTION
 from usps.api.addressinformation import AddressValidate, ZipCodeLookup, CityStateLookup
 from usps.api.ratecalculator import DomesticRateCalculator, InternationalRateCalculator
-from usps.api.servicestandards import PriorityMailServiceStandards, PackageServicesServiceStandards, ExpressMailServiceCommitment, get_service_standards
+from usps.api.servicestandards import PriorityMailServiceStandards, PackageServicesServiceStandards, ExpressMailServiceCommitment, get_service_standards, get_bulk_service_standards
 from usps.api.tracking import TrackConfirm
+from usps.api.asynchronous import AsyncAddressValidate, AsyncDomesticRateCalculator, Executor
+from usps.transport import HTTPConnectionPool, RecordingTransport, ReplayTransport
+from usps.cache import LRUCache, SQLiteCache
+from usps.coalesce import SingleFlight
+from usps.errors import USPSXMLError, USPSTransportError, USPSTimeoutError
+from usps.records import AddressResult, RatePackage, TrackInfo
+from usps.utils import xmltodict, dicttoxml, atomic_write
+from usps.zipindex import ZipIndex, build_index_from_csv
+from usps.poller import TrackingPoller
+from usps import metrics
+from usps.policy import RequestPolicy
+from usps.throttle import AdaptiveConcurrency, ThrottledTransport
+from usps.bulkvalidate import validate_file, column_map, Checkpoint
+from usps.ratetable import RateEngine
+from usps import rateshopping
+from usps.standardsmatrix import StandardsMatrix, build_matrix_from_responses
 
 
 USERID = "621OLYMP1079"
@@ -349,6 +375,1225 @@ class TestAddressInformationAPI(unittest.TestCase):
         self.assertEqual(response['State'], 'MD')
         self.assertEqual(response['Zip5'], '20770')
 
+class LocalUSPSHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answers every POST with a canned CityStateLookup response over keep-alive
+    """
+    protocol_version = 'HTTP/1.1'
+    RESPONSE = ('<?xml version="1.0"?><CityStateLookupResponse>'
+                '<ZipCode ID="0"><Zip5>90210</Zip5><City>BEVERLY HILLS</City>'
+                '<State>CA</State></ZipCode></CityStateLookupResponse>')
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(self.RESPONSE)))
+        self.end_headers()
+        self.wfile.write(self.RESPONSE)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestHTTPConnectionPool(unittest.TestCase):
+    """
+    Tests for the keep-alive connection pool transport
+    """
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), LocalUSPSHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%s/ShippingAPI.dll' % self.server.server_port
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connection_reuse(self):
+        pool = HTTPConnectionPool(maxsize=2)
+        connector = CityStateLookup(self.url, USERID, PASSWORD, transport=pool)
+        for i in range(5):
+            response = connector.execute([{'Zip5':'90210'}])[0]
+            self.assertEqual(response['City'], 'BEVERLY HILLS')
+        stats = pool.stats()
+        self.assertEqual(stats['acquired'], 5)
+        self.assertEqual(stats['created'], 1)
+        self.assertEqual(stats['reused'], 4)
+        self.assertEqual(stats['reuse_ratio'], 0.8)
+        pool.close()
+        self.assertEqual(pool.stats()['open'], 0)
+
+
+class EchoTransport(object):
+    """
+    Transport which answers each request by echoing its items back in
+    reverse order, the way USPS is free to order them
+    """
+    def __init__(self):
+        self.requests = list()
+        self.lock = threading.Lock()
+
+    def post(self, url, body):
+        params = dict(urlparse.parse_qsl(body))
+        request = ET.fromstring(params['XML'])
+        self.lock.acquire()
+        try:
+            self.requests.append(request)
+        finally:
+            self.lock.release()
+        response = ET.Element(request.tag.replace('Request', 'Response'))
+        response[:] = list(reversed(request))
+        return StringIO(ET.tostring(response))
+
+
+class TestBatching(unittest.TestCase):
+    """
+    Tests for splitting large batches over several requests
+    """
+    def test_address_chunks(self):
+        transport = EchoTransport()
+        connector = AddressValidate(USPS_CONNECTION_TEST, USERID, PASSWORD, transport=transport)
+        data = [{'Address2': '%s Ivy Lane' % i, 'Zip5': '20770'} for i in range(23)]
+        response = connector.execute(data)
+        self.assertEqual(len(transport.requests), 5)
+        self.assertTrue(max(len(request) for request in transport.requests) <= 5)
+        self.assertEqual([item['Address2'] for item in response],
+                         [item['Address2'] for item in data])
+
+    def test_tracking_chunks(self):
+        transport = EchoTransport()
+        connector = TrackConfirm(USPS_CONNECTION_TEST, USERID, PASSWORD, transport=transport, concurrency=1)
+        data = [{'ID': 'EJ%09dUS' % i} for i in range(25)]
+        connector.execute(data)
+        self.assertEqual([len(request) for request in transport.requests], [10, 10, 5])
+
+
+class TestAsyncServices(unittest.TestCase):
+    """
+    Tests for the future returning service wrappers
+    """
+    def test_async_address_validate(self):
+        transport = EchoTransport()
+        connector = AsyncAddressValidate(USPS_CONNECTION_TEST, USERID, PASSWORD,
+                                         transport=transport, executor=Executor(2))
+        data = [{'Address2': '%s Ivy Lane' % i, 'Zip5': '20770'} for i in range(12)]
+        future = connector.execute(data)
+        response = future.result(timeout=5)
+        self.assertTrue(future.done())
+        self.assertEqual(len(transport.requests), 3)
+        self.assertEqual([item['Address2'] for item in response],
+                         [item['Address2'] for item in data])
+
+    def test_service_options(self):
+        transport = CannedTransport(TestRateShopping.RESPONSE)
+        cache = LRUCache()
+        connector = AsyncDomesticRateCalculator(USPS_CONNECTION_TEST, USERID, PASSWORD, transport=transport,
+                                                concurrency=2, cache=cache, records=True, executor=Executor(2))
+        shipments = [{'Service': 'ALL', 'ZipOrigination': '20770', 'ZipDestination': zip_code,
+                      'Pounds': '1', 'Ounces': '0'} for zip_code in ('11210', '90210')]
+        response = connector.execute(shipments).result(timeout=5)
+        self.assertTrue(isinstance(response[0], RatePackage))
+        self.assertEqual(response[1].zip_destination, '90210')
+        connector.execute(shipments).result(timeout=5)
+        self.assertEqual(transport.requests, 1)
+        self.assertEqual(cache.stats()['hits'], 2)
+
+    def test_execute_iter_blocks(self):
+        connector = AsyncAddressValidate(USPS_CONNECTION_TEST, USERID, PASSWORD,
+                                         transport=EchoTransport(), executor=Executor(2))
+        data = [{'Address2': '%s Ivy Lane' % i, 'Zip5': '20770'} for i in range(7)]
+        results = dict(connector.execute_iter(data))
+        self.assertEqual([results[index]['Address2'] for index in range(7)],
+                         [item['Address2'] for item in data])
+
+
+class TestRateCache(unittest.TestCase):
+    """
+    Tests for caching rate quotes
+    """
+    def test_mixed_batch(self):
+        transport = EchoTransport()
+        cache = LRUCache(maxsize=3)
+        connector = DomesticRateCalculator(USPS_CONNECTION, USERID, PASSWORD,
+                                           transport=transport, cache=cache)
+        package = {'Service': 'Priority', 'ZipOrigination': '44106',
+                   'ZipDestination': '97217', 'Pounds': '1', 'Ounces': '8'}
+        connector.execute([package])
+        self.assertEqual(len(transport.requests), 1)
+
+        other = dict(package, ZipDestination='90210')
+        response = connector.execute([dict(package, Pounds=' 1 '), other, other])
+        self.assertEqual(len(transport.requests), 2)
+        self.assertEqual(len(transport.requests[1]), 1)
+        self.assertEqual(response[0]['ZipDestination'], '97217')
+        self.assertEqual(response[2]['ZipDestination'], '90210')
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 3)
+
+        for zip_code in ['10001', '10002', '10003']:
+            connector.execute([dict(package, ZipDestination=zip_code)])
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.stats()['evictions'], 2)
+
+    def test_expiry(self):
+        cache = LRUCache()
+        cache.set('key', 'value', ttl=-1)
+        self.assertEqual(cache.get('key'), None)
+        self.assertEqual(cache.stats()['expirations'], 1)
+
+
+class CannedTransport(object):
+    """
+    Transport which answers every request with the same response body
+    """
+    def __init__(self, response):
+        self.response = response
+        self.requests = 0
+
+    def post(self, url, body):
+        self.requests += 1
+        return StringIO(self.response)
+
+
+class TestZipIndex(unittest.TestCase):
+    """
+    Tests for the offline ZIP code index
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'zip.idx')
+        build_index_from_csv(self.path, StringIO('ZIP,CITY,STATE\n'
+                                                 '20770,Greenbelt,MD\n'
+                                                 '06371,Old Lyme,CT\n'
+                                                 '20770,Berwyn Heights,MD\n'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_lookup(self):
+        index = ZipIndex(self.path)
+        self.assertEqual(len(index), 2)
+        self.assertEqual(index.get('20770'), {'Zip5': '20770', 'City': 'GREENBELT', 'State': 'MD'})
+        self.assertEqual(index.get('06371')['City'], 'OLD LYME')
+        self.assertEqual(index.get('90210'), None)
+        index.close()
+
+    def test_long_city_names(self):
+        index = ZipIndex(self.path)
+        index.add('00601', u'A' * 27 + u'\xd1ANDO', 'PR')
+        self.assertEqual(index.get('00601')['City'], u'A' * 27)
+        index.save()
+        self.assertEqual(ZipIndex(self.path).get('00601')['City'], u'A' * 27)
+
+    def test_city_state_fallback(self):
+        index = ZipIndex(self.path)
+        transport = CannedTransport(LocalUSPSHandler.RESPONSE)
+        connector = CityStateLookup(USPS_CONNECTION_TEST, USERID, PASSWORD,
+                                    transport=transport, zip_index=index)
+        response = connector.execute([{'Zip5': '20770'}, {'Zip5': '90210'}])
+        self.assertEqual(transport.requests, 1)
+        self.assertEqual(response[0]['City'], 'GREENBELT')
+        self.assertEqual(response[1]['City'], 'BEVERLY HILLS')
+
+        index.save()
+        reloaded = ZipIndex(self.path, max_age=3600)
+        self.assertEqual(reloaded.get('90210')['City'], 'BEVERLY HILLS')
+        reloaded.close()
+
+    def test_execute_iter_uses_index(self):
+        index = ZipIndex(self.path)
+        transport = CannedTransport(LocalUSPSHandler.RESPONSE)
+        connector = CityStateLookup(USPS_CONNECTION_TEST, USERID, PASSWORD,
+                                    transport=transport, zip_index=index)
+        results = dict(connector.execute_iter([{'Zip5': '20770'}, {'Zip5': '06371'}]))
+        self.assertEqual(transport.requests, 0)
+        self.assertEqual(results[0]['City'], 'GREENBELT')
+        self.assertEqual(results[1]['City'], 'OLD LYME')
+        index.close()
+
+    def test_city_state_fallback_records(self):
+        index = ZipIndex(self.path)
+        transport = CannedTransport(LocalUSPSHandler.RESPONSE)
+        connector = CityStateLookup(USPS_CONNECTION_TEST, USERID, PASSWORD,
+                                    transport=transport, zip_index=index, records=True)
+        response = connector.execute([{'Zip5': '20770'}, {'Zip5': '90210'}])
+        self.assertEqual(transport.requests, 1)
+        self.assertTrue(isinstance(response[0], AddressResult))
+        self.assertTrue(isinstance(response[1], AddressResult))
+        self.assertEqual((response[0].city, response[0].state, response[0].zip5), ('GREENBELT', 'MD', '20770'))
+        self.assertEqual(response[1].city, 'BEVERLY HILLS')
+        self.assertEqual(index.get('90210')['City'], 'BEVERLY HILLS')
+        index.close()
+
+
+class TestStreamingParse(unittest.TestCase):
+    """
+    Tests for incremental response parsing
+    """
+    def test_items_stream_before_body_is_read(self):
+        packages = ''.join('<Package ID="%s"><Postage><MailService>%s</MailService>'
+                           '<Rate>%s.00</Rate></Postage></Package>' % (i, 'x' * 2000, i)
+                           for i in reversed(range(25)))
+        body = StringIO('<RateV3Response>%s</RateV3Response>' % packages)
+        connector = DomesticRateCalculator(USPS_CONNECTION, USERID, PASSWORD)
+        items = connector.iter_response(body)
+        item_id, item = items.next()
+        self.assertEqual(item_id, '24')
+        self.assertEqual(item['Postage']['Rate'], '24.00')
+        self.assertTrue(body.tell() < len(body.getvalue()))
+        self.assertEqual(len(list(items)), 24)
+
+    def test_item_error(self):
+        body = StringIO('<RateV3Response><Package ID="0"><Error><Number>-2147219499</Number>'
+                        '<Description>Invalid ZIP</Description></Error></Package></RateV3Response>')
+        connector = DomesticRateCalculator(USPS_CONNECTION, USERID, PASSWORD)
+        items = list(connector.iter_response(body))
+        self.assertEqual(len(items), 1)
+        self.assertEqual(items[0][0], '0')
+        self.assertTrue(isinstance(items[0][1], USPSXMLError))
+        self.assertEqual(items[0][1].item_id, '0')
+        self.assertEqual(items[0][1].info['Description'], 'Invalid ZIP')
+
+    def test_request_error(self):
+        body = StringIO('<Error><Number>80040b1a</Number>'
+                        '<Description>Authorization failure.</Description></Error>')
+        connector = DomesticRateCalculator(USPS_CONNECTION, USERID, PASSWORD)
+        items = connector.iter_response(body)
+        self.assertRaises(USPSXMLError, items.next)
+        self.assertTrue(body.closed)
+
+
+class TestExecuteIter(unittest.TestCase):
+    """
+    Tests for incremental consumption of results
+    """
+    def test_bounded_lookahead(self):
+        transport = EchoTransport()
+        connector = AddressValidate(USPS_CONNECTION_TEST, USERID, PASSWORD,
+                                    transport=transport, concurrency=2)
+        consumed = list()
+
+        def addresses():
+            index = 0
+            while True:
+                consumed.append(index)
+                yield {'Address2': '%s Ivy Lane' % index, 'Zip5': '20770'}
+                index += 1
+
+        results = connector.execute_iter(addresses(), backlog=2)
+        seen = dict()
+        for i in range(20):
+            index, result = results.next()
+            seen[index] = result
+        results.close()
+        self.assertTrue(len(consumed) <= 20 + 3 * AddressValidate.MAX_ITEMS)
+        for index, result in seen.items():
+            self.assertEqual(result['Address2'], '%s Ivy Lane' % index)
+
+    def test_errors_are_yielded(self):
+        transport = CannedTransport('<Error><Number>80040b1a</Number>'
+                                    '<Description>Authorization failure</Description></Error>')
+        connector = TrackConfirm(USPS_CONNECTION_TEST, USERID, PASSWORD, transport=transport)
+        results = list(connector.execute_iter({'ID': 'EJ%09dUS' % i} for i in range(12)))
+        self.assertEqual(sorted(index for index, result in results), range(12))
+        for index, result in results:
+            self.assertTrue(isinstance(result, USPSXMLError))
+
+
+class TestRecords(unittest.TestCase):
+    """
+    Tests for typed result records
+    """
+    def test_rate_package(self):
+        body = StringIO('<RateV3Response><Package ID="0"><ZipOrigination>44106</ZipOrigination>'
+                        '<Pounds>1</Pounds><Ounces>8</Ounces><Zone>8</Zone>'
+                        '<Postage CLASSID="1"><MailService>Priority Mail</MailService>'
+                        '<Rate>10.25</Rate></Postage></Package></RateV3Response>')
+        connector = DomesticRateCalculator(USPS_CONNECTION, USERID, PASSWORD, records=True)
+        item_id, package = connector.iter_response(body).next()
+        self.assertTrue(isinstance(package, RatePackage))
+        self.assertEqual(package.id, '0')
+        self.assertEqual(package.zone, 8)
+        self.assertEqual(package.ounces, 8.0)
+        self.assertEqual(len(package.postage), 1)
+        self.assertEqual(package.postage[0].rate, 10.25)
+        self.assertEqual(package.postage[0].class_id, 1)
+        self.assertFalse(hasattr(package, '__dict__'))
+
+    def test_track_info(self):
+        body = StringIO('<TrackResponse><TrackInfo ID="EJ958083578US">'
+                        '<TrackSummary>Your item was delivered</TrackSummary>'
+                        '<TrackDetail>May 30 11:07 am NOTICE LEFT</TrackDetail>'
+                        '</TrackInfo></TrackResponse>')
+        connector = TrackConfirm(USPS_CONNECTION_TEST, USERID, PASSWORD, records=True)
+        item_id, info = connector.iter_response(body).next()
+        self.assertTrue(isinstance(info, TrackInfo))
+        self.assertEqual(info.summary.event, 'Your item was delivered')
+        self.assertEqual([detail.event for detail in info.details], ['May 30 11:07 am NOTICE LEFT'])
+
+
+class TestUtils(unittest.TestCase):
+    """
+    Tests for the XML conversion and file helpers
+    """
+    def test_xmltodict(self):
+        element = ET.fromstring('<Response><Package ID="0"><Postage CLASSID="1"><Rate>1.00</Rate></Postage>'
+                                '<Postage CLASSID="2"><Rate>2.00</Rate></Postage><Zone>8</Zone>'
+                                '<Note Type="a">text</Note></Package></Response>')
+        self.assertEqual(xmltodict(element), {'Package': {'ID': '0',
+                                                          'Postage': [{'CLASSID': '1', 'Rate': '1.00'},
+                                                                      {'CLASSID': '2', 'Rate': '2.00'}],
+                                                          'Zone': '8',
+                                                          'Note': {'text': 'text', 'Type': 'a'}}})
+
+    def test_dicttoxml(self):
+        element = dicttoxml({'Country': 'Japan', 'Pounds': '4', 'Machinable': False,
+                             'GXG': {'Width': '14', 'Length': '46'}},
+                            'Package', InternationalRateCalculator.PARAMETERS)
+        self.assertEqual(ET.tostring(element),
+                         '<Package><Pounds>4</Pounds><GXG><Length>46</Length><Width>14</Width></GXG>'
+                         '<Country>Japan</Country></Package>')
+
+    def test_atomic_write(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'state')
+            atomic_write(path, lambda fileobj: fileobj.write('first'))
+
+            def fail(fileobj):
+                fileobj.write('partial')
+                raise IOError('disk full')
+            self.assertRaises(IOError, atomic_write, path, fail)
+            self.assertEqual(open(path, 'rb').read(), 'first')
+            self.assertEqual(os.listdir(directory), ['state'])
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestRequestTemplates(unittest.TestCase):
+    """
+    Tests for precompiled request serialization
+    """
+    def assertSameXML(self, connector, data):
+        self.assertEqual(connector.make_request(data, USERID or 'user', 'pass"word'),
+                         ET.tostring(connector.make_xml(data, USERID or 'user', 'pass"word')))
+
+    def test_rate_request(self):
+        connector = DomesticRateCalculator(USPS_CONNECTION, USERID, PASSWORD)
+        self.assertSameXML(connector, [{'Service': 'ALL',
+                                        'ZipOrigination': '44106',
+                                        'ZipDestination': '97217',
+                                        'Pounds': '8',
+                                        'Ounces': '',
+                                        'Container': None,
+                                        'Size': 'REGULAR',
+                                        'Machinable': False,
+                                        },
+                                       {'Service': u'Priority & <Express> \xe9'},
+                                       {}])
+
+    def test_nested_request(self):
+        connector = InternationalRateCalculator(USPS_CONNECTION, USERID, PASSWORD)
+        self.assertSameXML(connector, [{'Pounds': '4',
+                                        'GXG': {'Length': '46', 'Width': '14', 'GiftFlag': 'N'},
+                                        'Country': 'Japan'},
+                                       {'Pounds': '1', 'GXG': {}}])
+
+    def test_overridden_make_xml(self):
+        connector = TrackConfirm(USPS_CONNECTION_TEST, USERID, PASSWORD)
+        self.assertSameXML(connector, [{'ID': 'EJ958083578US'}])
+
+
+class TestRecordReplay(unittest.TestCase):
+    """
+    Tests for recording responses and replaying them from disk
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        upstream = CannedTransport(LocalUSPSHandler.RESPONSE)
+        recorder = CityStateLookup(USPS_CONNECTION_TEST, USERID, PASSWORD,
+                                   transport=RecordingTransport(upstream, self.directory))
+        recorded = recorder.execute([{'Zip5': '90210'}])
+
+        replay = ReplayTransport(self.directory)
+        connector = CityStateLookup(USPS_CONNECTION_TEST, 'someone else', 'secret', transport=replay)
+        self.assertEqual(connector.execute([{'Zip5': '90210'}]), recorded)
+        self.assertEqual(upstream.requests, 1)
+        self.assertRaises(USPSTransportError, connector.execute, [{'Zip5': '20770'}])
+
+
+class TestSingleFlight(unittest.TestCase):
+    """
+    Tests for coalescing identical in-flight requests
+    """
+    def test_identical_requests_are_sent_once(self):
+        entered = threading.Event()
+        release = threading.Event()
+        upstream = CannedTransport(LocalUSPSHandler.RESPONSE)
+
+        class GatedTransport(object):
+            def post(self, url, body):
+                entered.set()
+                release.wait(5)
+                return upstream.post(url, body)
+
+        group = SingleFlight()
+        connector = CityStateLookup(USPS_CONNECTION_TEST, USERID, PASSWORD,
+                                    transport=GatedTransport(), single_flight=group)
+        results = list()
+        threads = [threading.Thread(target=lambda: results.append(connector.execute([{'Zip5': '90210'}])))
+                   for i in range(2)]
+        threads[0].start()
+        entered.wait(5)
+        threads[1].start()
+        while group.stats()['collapsed'] < 1:
+            threads[1].join(0.01)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(upstream.requests, 1)
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(group.stats()['sent'], 1)
+        self.assertEqual(group.stats()['in_flight'], 0)
+
+
+class TestBulkServiceStandards(unittest.TestCase):
+    """
+    Tests for deduplicated bulk service standard lookups
+    """
+    RESPONSES = {'StandardB': '<StandardBResponse><OriginZip>207</OriginZip>'
+                              '<DestinationZip>112</DestinationZip><Days>2</Days></StandardBResponse>',
+                 'PriorityMail': '<PriorityMailResponse><OriginZip>207</OriginZip>'
+                                 '<DestinationZip>112</DestinationZip><Days>1</Days></PriorityMailResponse>',
+                 'ExpressMailCommitment': '<ExpressMailCommitmentResponse><Commitment>'
+                                          '<CommitmentName>Next Day</CommitmentName></Commitment>'
+                                          '</ExpressMailCommitmentResponse>'}
+
+    def test_prefixes_are_fetched_once(self):
+        sent = list()
+        responses = self.RESPONSES
+
+        class ServiceTransport(object):
+            def post(self, url, body):
+                params = dict(urlparse.parse_qsl(body))
+                sent.append(params['XML'])
+                return StringIO(responses[params['API']])
+
+        packages = [('20770', '11210', 4),
+                    ('20771', '11230', 5),
+                    {'OriginZip': '20799', 'DestinationZip': '11201', 'CLASSID': 0, 'Date': '05-Aug-2004'},
+                    ('20770', '11210', 3, '05-Aug-2004'),
+                    ('20770', '11210', 3, '05-Aug-2004'),
+                    ('20770', '11210', 99)]
+        estimates = get_bulk_service_standards(packages, USPS_CONNECTION_TEST, USERID, PASSWORD,
+                                               transport=ServiceTransport())
+        self.assertEqual(estimates, ['2 Days', '2 Days', '1 Days', 'Next Day', 'Next Day', False])
+        self.assertEqual(len(sent), 3)
+        self.assertTrue('<OriginZip>207</OriginZip><DestinationZip>112</DestinationZip>' in ''.join(sent))
+
+    def test_services_share_one_pool(self):
+        responses = self.RESPONSES
+        state = {'in_flight': 0, 'peak': 0}
+        lock = threading.Lock()
+
+        class SlowTransport(object):
+            def post(self, url, body):
+                lock.acquire()
+                state['in_flight'] += 1
+                state['peak'] = max(state['peak'], state['in_flight'])
+                lock.release()
+                time.sleep(0.05)
+                lock.acquire()
+                state['in_flight'] -= 1
+                lock.release()
+                return StringIO(responses[dict(urlparse.parse_qsl(body))['API']])
+
+        packages = [('20770', '11210', 4), ('20770', '11210', 1), ('20770', '11210', 3, '05-Aug-2004')]
+        estimates = get_bulk_service_standards(packages, USPS_CONNECTION_TEST, USERID, PASSWORD,
+                                               transport=SlowTransport(), concurrency=3)
+        self.assertEqual(estimates, ['2 Days', '1 Days', 'Next Day'])
+        self.assertEqual(state['peak'], 3)
+
+
+class TestStandardsMatrix(unittest.TestCase):
+    """
+    Tests for the memory mapped service standards matrix
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'standards.bin')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_save_and_map(self):
+        matrix = StandardsMatrix(self.path, 'StandardB')
+        matrix.add('20770', '11210', 2)
+        matrix.save()
+
+        matrix = StandardsMatrix(self.path)
+        self.assertEqual(matrix.get('207', '112'), 2)
+        self.assertEqual(matrix.get('20799', '11299'), 2)
+        self.assertEqual(matrix.get('112', '207'), None)
+        self.assertEqual(matrix.get('4', '4'), None)
+        self.assertEqual(matrix.service, 'StandardB')
+        self.assertEqual(len(matrix), 1)
+        matrix.close()
+        self.assertRaises(ValueError, StandardsMatrix(self.path, 'PriorityMail').get, '207', '112')
+
+    def test_build_from_recorded_responses(self):
+        responses = os.path.join(self.directory, 'responses')
+        recorder = RecordingTransport(CannedTransport(TestBulkServiceStandards.RESPONSES['StandardB']), responses)
+        connector = PackageServicesServiceStandards(USPS_CONNECTION_TEST, USERID, PASSWORD, transport=recorder)
+        connector.execute([{'OriginZip': '207', 'DestinationZip': '112'}])
+        self.assertEqual(build_matrix_from_responses(self.path, 'StandardB', responses), 1)
+        self.assertEqual(StandardsMatrix(self.path).get('207', '112'), 2)
+
+    def test_lookup_falls_back_to_api(self):
+        transport = CannedTransport(TestBulkServiceStandards.RESPONSES['StandardB'])
+        matrices = {'StandardB': StandardsMatrix(self.path, 'StandardB')}
+        package = {'OriginZip': '20770', 'DestinationZip': '11210', 'CLASSID': 4}
+        for i in range(3):
+            self.assertEqual(get_service_standards(dict(package), USPS_CONNECTION_TEST, USERID, PASSWORD,
+                                                   transport, matrices=matrices), '2 Days')
+        self.assertEqual(transport.requests, 1)
+        self.assertEqual(get_bulk_service_standards([('207', '112', 5)], USPS_CONNECTION_TEST, USERID, PASSWORD,
+                                                    transport, matrices=matrices), ['2 Days'])
+        self.assertEqual(transport.requests, 1)
+
+    def test_priority_lookup_uses_priority_matrix(self):
+        transport = CannedTransport(TestBulkServiceStandards.RESPONSES['StandardB'])
+        priority = StandardsMatrix(os.path.join(self.directory, 'priority.bin'), 'PriorityMail')
+        priority.add('207', '112', 1)
+        matrices = {'PriorityMail': priority, 'StandardB': StandardsMatrix(self.path, 'StandardB')}
+        package = {'OriginZip': '20770', 'DestinationZip': '11210', 'CLASSID': 1}
+        self.assertEqual(get_service_standards(dict(package), USPS_CONNECTION_TEST, USERID, PASSWORD,
+                                               transport, matrices=matrices), '1 Days')
+        self.assertEqual(get_bulk_service_standards([('207', '112', 1)], USPS_CONNECTION_TEST, USERID, PASSWORD,
+                                                    transport, matrices=matrices), ['1 Days'])
+        self.assertEqual(transport.requests, 0)
+
+
+class TestTrackingPoller(unittest.TestCase):
+    """
+    Tests for the incremental tracking poller
+    """
+    IN_TRANSIT = ('<TrackResponse><TrackInfo ID="EJ958083578US">'
+                  '<TrackSummary>May 30 10:08 am ARRIVAL AT UNIT WILMINGTON DE 19850.</TrackSummary>'
+                  '<TrackDetail>May 29 9:55 am ACCEPT OR PICKUP EDGEWATER NJ 07020.</TrackDetail>'
+                  '</TrackInfo></TrackResponse>')
+    DELIVERED = ('<TrackResponse><TrackInfo ID="EJ958083578US">'
+                 '<TrackSummary>Your item was delivered at 8:10 am on June 1 in Wilmington DE 19801.</TrackSummary>'
+                 '<TrackDetail>May 30 10:08 am ARRIVAL AT UNIT WILMINGTON DE 19850.</TrackDetail>'
+                 '<TrackDetail>May 29 9:55 am ACCEPT OR PICKUP EDGEWATER NJ 07020.</TrackDetail>'
+                 '</TrackInfo></TrackResponse>')
+
+    def test_only_new_events_are_reported(self):
+        transport = CannedTransport(self.IN_TRANSIT)
+        poller = TrackingPoller(TrackConfirm(USPS_CONNECTION_TEST, USERID, PASSWORD,
+                                             transport=transport, records=True))
+        poller.add(['ej958083578us'], now=0)
+
+        changes = list(poller.poll(now=0))
+        self.assertEqual([(tracking_id, len(events)) for tracking_id, events in changes], [('EJ958083578US', 2)])
+        self.assertEqual(list(poller.poll(now=60)), [])
+        self.assertEqual(transport.requests, 1)
+
+        self.assertEqual(list(poller.poll(now=TrackingPoller.IN_TRANSIT_INTERVAL)), [])
+        self.assertEqual(poller.stats()['unchanged'], 1)
+        self.assertEqual(poller.store['EJ958083578US']['interval'], 2 * TrackingPoller.IN_TRANSIT_INTERVAL)
+
+        transport.response = self.DELIVERED
+        changes = list(poller.poll(now=10 * TrackingPoller.MAX_INTERVAL))
+        self.assertEqual(len(changes), 1)
+        self.assertEqual([event.event for event in changes[0][1]],
+                         ['Your item was delivered at 8:10 am on June 1 in Wilmington DE 19801.'])
+        self.assertTrue(poller.store['EJ958083578US']['done'])
+        self.assertEqual(list(poller.poll(now=100 * TrackingPoller.MAX_INTERVAL)), [])
+        self.assertEqual(transport.requests, 3)
+
+    def test_stopping_early_keeps_numbers_due(self):
+        response = '<TrackResponse>%s</TrackResponse>' % ''.join(
+            '<TrackInfo ID="EJ%09dUS"><TrackSummary>May 30 10:08 am ARRIVAL AT UNIT WILMINGTON DE 19850.'
+            '</TrackSummary></TrackInfo>' % index for index in range(10))
+        transport = CannedTransport(response)
+        poller = TrackingPoller(TrackConfirm(USPS_CONNECTION_TEST, USERID, PASSWORD,
+                                             transport=transport, records=True))
+        poller.add(['EJ%09dUS' % index for index in range(30)], now=0)
+        changes = poller.poll(now=0)
+        changes.next()
+        changes.close()
+        polled = [tracking_id for tracking_id, state in poller.store.items() if state['next_poll']]
+        self.assertEqual(sorted(poller.due(now=0) + polled), sorted(poller.store))
+
+    def test_failed_requests_are_retried_soon(self):
+        class FailingTransport(object):
+            def post(self, url, body):
+                raise socket.error('connection reset')
+
+        service = TrackConfirm(USPS_CONNECTION_TEST, USERID, PASSWORD,
+                               transport=CannedTransport(self.IN_TRANSIT), records=True)
+        poller = TrackingPoller(service)
+        poller.add(['EJ958083578US'], now=0)
+        list(poller.poll(now=0))
+        state = dict(poller.store['EJ958083578US'])
+
+        service.transport = FailingTransport()
+        due = TrackingPoller.IN_TRANSIT_INTERVAL
+        self.assertEqual(list(poller.poll(now=due)), [])
+        retried = poller.store['EJ958083578US']
+        self.assertEqual(retried['next_poll'], due + TrackingPoller.RETRY_INTERVAL)
+        self.assertEqual((retried['interval'], retried['summary']), (state['interval'], state['summary']))
+        self.assertEqual(poller.due(now=due + TrackingPoller.RETRY_INTERVAL), ['EJ958083578US'])
+
+    def test_failed_delivery_is_not_done(self):
+        poller = TrackingPoller(TrackConfirm(USPS_CONNECTION_TEST, USERID, PASSWORD, records=True))
+        poller.add(['EJ958083578US'], now=0)
+        for summary in ('Notice left, your item could not be delivered on June 1 in Wilmington DE.',
+                        'June 1 8:10 am NOT DELIVERED WILMINGTON DE 19801',
+                        "Your item wasn't delivered, delivery attempted June 1."):
+            poller.reschedule('EJ958083578US', summary, 0, changed=True)
+            self.assertFalse(poller.store['EJ958083578US']['done'], summary)
+        poller.reschedule('EJ958083578US', 'June 1 8:10 am DELIVERED WILMINGTON DE 19801', 0, changed=True)
+        self.assertTrue(poller.store['EJ958083578US']['done'])
+
+
+class TestRateShopping(unittest.TestCase):
+    """
+    Tests for picking the best service of every shipment
+    """
+    RESPONSE = ('<RateV3Response>'
+                '<Package ID="0"><ZipOrigination>20770</ZipOrigination><ZipDestination>11210</ZipDestination>'
+                '<Postage CLASSID="1"><MailService>Priority Mail</MailService><Rate>9.80</Rate></Postage>'
+                '<Postage CLASSID="3"><MailService>Express Mail</MailService><Rate>25.50</Rate></Postage>'
+                '<Postage CLASSID="4"><MailService>Parcel Post</MailService><Rate>7.25</Rate></Postage>'
+                '</Package>'
+                '<Package ID="1"><ZipOrigination>20770</ZipOrigination><ZipDestination>90210</ZipDestination>'
+                '<Postage CLASSID="1"><MailService>Priority Mail</MailService><Rate>12.10</Rate></Postage>'
+                '<Postage CLASSID="4"><MailService>Parcel Post</MailService><Rate>11.90</Rate></Postage>'
+                '</Package>'
+                '</RateV3Response>')
+    DAYS = {('11210', 1): 2, ('11210', 4): 3, ('90210', 1): 3, ('90210', 4): 8}
+
+    def shop(self, max_days):
+        connector = DomesticRateCalculator(USPS_CONNECTION_TEST, USERID, PASSWORD,
+                                           transport=CannedTransport(self.RESPONSE), records=True)
+        days = lambda package, postage: self.DAYS.get((package.zip_destination, postage.class_id))
+        shipments = [{'ZipOrigination': '20770', 'ZipDestination': '11210', 'Pounds': '1', 'Ounces': '0'},
+                     {'ZipOrigination': '20770', 'ZipDestination': '90210', 'Pounds': '3', 'Ounces': '0'}]
+        best = rateshopping.shop_rates(connector, shipments, max_days, days)
+        return [postage and postage.class_id for postage in best]
+
+    def check(self):
+        self.assertEqual(self.shop(None), [4, 4])
+        self.assertEqual(self.shop(3), [4, 1])
+        self.assertEqual(self.shop(2), [1, None])
+
+    @unittest.skipIf(rateshopping.numpy is None, 'numpy is not installed')
+    def test_array_selection(self):
+        self.check()
+
+    def test_pure_python_selection(self):
+        numpy = rateshopping.numpy
+        rateshopping.numpy = None
+        try:
+            self.check()
+        finally:
+            rateshopping.numpy = numpy
+
+
+class TestRateEngine(unittest.TestCase):
+    """
+    Tests for quoting domestic rates from local tables
+    """
+    RESPONSE = ('<RateV3Response><Package ID="0"><ZipOrigination>20770</ZipOrigination>'
+                '<ZipDestination>11210</ZipDestination><Pounds>2</Pounds><Ounces>3</Ounces><Zone>3</Zone>'
+                '<Postage CLASSID="1"><MailService>Priority Mail</MailService><Rate>%s</Rate></Postage>'
+                '<Postage CLASSID="4"><MailService>Parcel Post</MailService><Rate>7.25</Rate></Postage>'
+                '</Package></RateV3Response>')
+    PACKAGE = {'Service': 'ALL', 'ZipOrigination': '20770', 'ZipDestination': '11210',
+               'Pounds': '2', 'Ounces': '3', 'Size': 'REGULAR', 'Machinable': 'true'}
+
+    def test_learned_rates_are_quoted_locally(self):
+        transport = CannedTransport(self.RESPONSE % '9.80')
+        engine = RateEngine(sample_rate=0)
+        connector = DomesticRateCalculator(USPS_CONNECTION_TEST, USERID, PASSWORD, transport=transport,
+                                           records=True, rate_engine=engine)
+        live = connector.execute([self.PACKAGE])[0]
+        similar = dict(self.PACKAGE, ZipOrigination='20799', ZipDestination='11201', Ounces='15')
+        local = connector.execute([similar])[0]
+        self.assertEqual(transport.requests, 1)
+        self.assertEqual(local.zone, 3)
+        self.assertEqual([(postage.class_id, postage.rate) for postage in local.postage],
+                         [(postage.class_id, postage.rate) for postage in live.postage])
+        self.assertEqual(engine.quote(dict(self.PACKAGE, Pounds='3')), None)
+        self.assertEqual(engine.quote(dict(self.PACKAGE, Size='LARGE')), None)
+
+        path = os.path.join(tempfile.mkdtemp(), 'rates.bin')
+        try:
+            engine.save(path)
+            self.assertEqual(RateEngine.load(path).quote(similar).postage[0].rate, 9.80)
+        finally:
+            shutil.rmtree(os.path.dirname(path))
+
+    def test_sampled_mismatch_refreshes_tables(self):
+        transport = CannedTransport(self.RESPONSE % '9.80')
+        engine = RateEngine(sample_rate=1)
+        connector = DomesticRateCalculator(USPS_CONNECTION_TEST, USERID, PASSWORD, transport=transport,
+                                           records=True, rate_engine=engine)
+        connector.execute([self.PACKAGE])
+        transport.response = self.RESPONSE % '10.15'
+        self.assertEqual(connector.execute([self.PACKAGE])[0].postage[0].rate, 10.15)
+        self.assertEqual(engine.stats()['mismatches'], 1)
+        self.assertEqual(engine.quote(self.PACKAGE).postage[0].rate, 10.15)
+
+    def test_imported_zone_chart(self):
+        engine = RateEngine()
+        self.assertEqual(engine.import_zone_chart([('207', '005-009', 4)]), 5)
+        self.assertEqual(engine.zone('20770', '00844'), 4)
+        self.assertEqual(engine.zone('20770', '01001'), None)
+
+
+class TestAddressCache(unittest.TestCase):
+    """
+    Tests for caching address validation on canonicalized addresses
+    """
+    RESPONSE = ('<AddressValidateResponse><Address ID="0"><Address2>6406 IVY LN</Address2>'
+                '<City>GREENBELT</City><State>MD</State><Zip5>20770</Zip5><Zip4>1441</Zip4>'
+                '</Address></AddressValidateResponse>')
+
+    def test_near_duplicates_share_an_entry(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'addresses.cache')
+            transport = CannedTransport(self.RESPONSE)
+            cache = LRUCache(path=path)
+            connector = AddressValidate(USPS_CONNECTION_TEST, USERID, PASSWORD, transport=transport, cache=cache)
+            connector.execute([{'Address2': '6406 Ivy Lane', 'City': 'Greenbelt', 'State': 'MD'}])
+            result = connector.execute([{'Address2': ' 6406  IVY LN. ', 'City': 'greenbelt', 'State': 'md',
+                                         'Zip5': '', 'Zip4': None}])
+            self.assertEqual(transport.requests, 1)
+            self.assertEqual(result[0]['Zip4'], '1441')
+            self.assertEqual(cache.stats()['hit_ratio'], 0.5)
+            self.assertNotEqual(connector.cache_key({'Address2': '6406 Ivy Lane'}),
+                                connector.cache_key({'Address2': '6406 Ivy Lane Ave'}))
+
+            cache.save()
+            connector = AddressValidate(USPS_CONNECTION_TEST, USERID, PASSWORD, transport=transport,
+                                        cache=LRUCache(path=path))
+            connector.execute([{'Address2': '6406 Ivy Ln', 'City': 'GREENBELT', 'State': 'MD'}])
+            self.assertEqual(transport.requests, 1)
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestSQLiteCache(unittest.TestCase):
+    """
+    Tests for the shared on-disk cache
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'responses.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_entries_are_shared(self):
+        transport = CannedTransport(LocalUSPSHandler.RESPONSE)
+        for worker in range(2):
+            connector = CityStateLookup(USPS_CONNECTION_TEST, USERID, PASSWORD, transport=transport,
+                                        cache=SQLiteCache(self.path), records=True)
+            result = connector.execute([{'Zip5': '90210'}])
+        self.assertEqual(transport.requests, 1)
+        self.assertEqual(result[0].city, 'BEVERLY HILLS')
+        self.assertEqual(connector.cache.stats()['hit_ratio'], 1.0)
+
+    def test_expiry_and_eviction(self):
+        cache = SQLiteCache(self.path, maxsize=10)
+        cache.set('stale', 'value', ttl=-1)
+        self.assertEqual(cache.get('stale'), None)
+        threads = [threading.Thread(target=lambda offset=offset: [cache.set((offset, key), {'key': key})
+                                                                  for key in range(32)])
+                   for offset in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        cache.set('newest', {'key': 'newest'})
+        cache.evict()
+        self.assertEqual(len(cache), 10)
+        self.assertEqual(SQLiteCache(self.path).get('newest'), {'key': 'newest'})
+
+    def test_equal_keys_share_entries(self):
+        cache = SQLiteCache(self.path)
+        zip5 = u'90210'
+        cache.set(('RateV3', False, (('ZipOrigination', zip5), ('ZipDestination', zip5))), 'rates')
+        key = ('RateV3', False, (('ZipOrigination', u'90210'), ('ZipDestination', ''.join(['902', '10']))))
+        self.assertEqual(cache.get(key), 'rates')
+        cache.close()
+
+
+class TestBulkValidate(unittest.TestCase):
+    """
+    Tests for validating address files
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.input = os.path.join(self.directory, 'addresses.csv')
+        self.output = os.path.join(self.directory, 'validated.csv')
+        fileobj = open(self.input, 'wb')
+        fileobj.write('name,street,City,State\n')
+        for index in range(12):
+            fileobj.write('Customer %s,%s Ivy Lane,Greenbelt,MD\n' % (index, index))
+        fileobj.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def validate(self, transport):
+        connector = AddressValidate(USPS_CONNECTION_TEST, USERID, PASSWORD, transport=transport)
+        return validate_file(connector, self.input, self.output, column_map('Address2=street'), checkpoint_every=5)
+
+    def read_output(self):
+        fileobj = open(self.output, 'rb')
+        try:
+            return fileobj.read()
+        finally:
+            fileobj.close()
+
+    def test_rows_are_written_in_order(self):
+        transport = EchoTransport()
+        rows, elapsed = self.validate(transport)
+        self.assertEqual(rows, 12)
+        self.assertEqual(len(transport.requests), 3)
+        lines = self.read_output().splitlines()
+        self.assertEqual(lines[0].split(',')[:6], ['name', 'street', 'City', 'State', 'usps_FirmName', 'usps_Address1'])
+        self.assertEqual([line.split(',')[0] for line in lines[1:]], ['Customer %s' % index for index in range(12)])
+        self.assertEqual([line.split(',')[6] for line in lines[1:]], ['%s Ivy Lane' % index for index in range(12)])
+        #the explicit street mapping adds to the columns named like parameters
+        self.assertEqual(transport.requests[0][0].find('City').text, 'Greenbelt')
+        self.assertEqual(transport.requests[0][0].find('State').text, 'MD')
+        self.assertFalse(os.path.exists(self.output + '.checkpoint'))
+
+    def test_resume_from_checkpoint(self):
+        self.validate(EchoTransport())
+        expected = self.read_output()
+        lines = expected.splitlines(True)
+        Checkpoint(self.output + '.checkpoint').save(5, len(''.join(lines[:6])))
+        fileobj = open(self.output, 'ab')
+        fileobj.write('partial,row\r\n')
+        fileobj.close()
+
+        transport = EchoTransport()
+        rows, elapsed = self.validate(transport)
+        self.assertEqual(rows, 7)
+        self.assertEqual(len(transport.requests), 2)
+        self.assertEqual(self.read_output(), expected)
+
+    def test_transport_failure_stops_the_run(self):
+        self.validate(EchoTransport())
+        expected = self.read_output()
+        os.remove(self.output)
+
+        class FailingTransport(EchoTransport):
+            def post(self, url, body):
+                if '5 Ivy Lane' in dict(urlparse.parse_qsl(body))['XML']:
+                    raise socket.error('connection reset')
+                return EchoTransport.post(self, url, body)
+
+        connector = AddressValidate(USPS_CONNECTION_TEST, USERID, PASSWORD,
+                                    transport=FailingTransport(), concurrency=1)
+        self.assertRaises(socket.error, validate_file, connector, self.input, self.output,
+                          column_map('Address2=street'), checkpoint_every=5)
+        self.assertEqual(Checkpoint(self.output + '.checkpoint').rows, 5)
+        self.assertEqual(len(self.read_output().splitlines()), 6)
+
+        rows, elapsed = self.validate(EchoTransport())
+        self.assertEqual(rows, 7)
+        self.assertEqual(self.read_output(), expected)
+
+        os.remove(self.output)
+        connector = AddressValidate(USPS_CONNECTION_TEST, USERID, PASSWORD, transport=CannedTransport(
+            '<Error><Number>80040b1a</Number><Description>Authorization failure.</Description></Error>'))
+        self.assertRaises(USPSXMLError, validate_file, connector, self.input, self.output,
+                          column_map('Address2=street'))
+        self.assertEqual(Checkpoint(self.output + '.checkpoint').rows, 0)
+
+    def test_bounded_buffer(self):
+        transport = EchoTransport()
+        connector = AddressValidate(USPS_CONNECTION_TEST, USERID, PASSWORD, transport=transport)
+        rows, elapsed = validate_file(connector, self.input, self.output, column_map('Address2=street'),
+                                      buffer_rows=3)
+        self.assertEqual(rows, 12)
+        self.assertEqual(len(transport.requests), 4)
+        lines = self.read_output().splitlines()
+        self.assertEqual([line.split(',')[0] for line in lines[1:]], ['Customer %s' % index for index in range(12)])
+
+
+class TestAdaptiveConcurrency(unittest.TestCase):
+    """
+    Tests for the AIMD request limiter
+    """
+    def test_limit_follows_congestion(self):
+        controller = AdaptiveConcurrency(initial=4, maximum=8)
+        for i in range(40):
+            controller.acquire()
+            controller.release(0.01)
+        self.assertEqual(controller.stats()['limit'], 4)
+        for i in range(4):
+            controller.acquire()
+        for i in range(4):
+            controller.release(0.01)
+        self.assertTrue(controller.limit > 4)
+
+        controller.acquire()
+        controller.release(1.0, error=True)
+        self.assertEqual(controller.stats()['decreases'], 1)
+        self.assertTrue(controller.limit < 4)
+
+    def test_in_flight_is_bounded(self):
+        controller = AdaptiveConcurrency(initial=2, maximum=2)
+        peak = [0]
+        lock = threading.Lock()
+        upstream = CannedTransport(LocalUSPSHandler.RESPONSE)
+
+        class SlowTransport(object):
+            def post(self, url, body):
+                lock.acquire()
+                peak[0] = max(peak[0], controller.in_flight)
+                lock.release()
+                return upstream.post(url, body)
+
+            def close(self):
+                pass
+
+        connector = CityStateLookup(USPS_CONNECTION_TEST, USERID, PASSWORD, concurrency=8,
+                                    transport=ThrottledTransport(SlowTransport(), controller))
+        results = connector.execute([{'Zip5': '90210'}] * 40)
+        self.assertEqual(len(results), 40)
+        self.assertEqual(upstream.requests, 8)
+        self.assertTrue(peak[0] <= 2)
+        self.assertEqual(controller.in_flight, 0)
+
+    def test_slot_is_held_until_the_response_is_closed(self):
+        controller = AdaptiveConcurrency(initial=2)
+        body = StringIO(LocalUSPSHandler.RESPONSE)
+
+        class StreamTransport(object):
+            def post(self, url, data):
+                return body
+
+        response = ThrottledTransport(StreamTransport(), controller).post(USPS_CONNECTION_TEST, '')
+        self.assertEqual(body.tell(), 0)
+        self.assertEqual(controller.in_flight, 1)
+        response.read()
+        response.close()
+        self.assertEqual(controller.in_flight, 0)
+        self.assertEqual(controller.stats()['successes'], 1)
+
+    def test_error_responses_are_congestion(self):
+        controller = AdaptiveConcurrency(initial=4)
+        transport = CannedTransport('<Error><Number>80040b19</Number>'
+                                    '<Description>Too many requests.</Description></Error>')
+        connector = CityStateLookup(USPS_CONNECTION_TEST, USERID, PASSWORD,
+                                    transport=ThrottledTransport(transport, controller))
+        self.assertRaises(USPSXMLError, connector.execute, [{'Zip5': '90210'}])
+        self.assertEqual(controller.stats()['errors'], 1)
+        self.assertEqual(controller.stats()['decreases'], 1)
+        self.assertEqual(controller.in_flight, 0)
+
+    def test_rate_ceiling(self):
+        controller = AdaptiveConcurrency(max_rate=200)
+        started = time.time()
+        for i in range(5):
+            controller.acquire()
+            controller.release(0.0)
+        self.assertTrue(time.time() - started >= 4 / 200.0)
+
+
+class TestRequestPolicy(unittest.TestCase):
+    """
+    Tests for request timeouts, retries and hedging
+    """
+    def make_transport(self, delays, failures=0):
+        upstream = CannedTransport(LocalUSPSHandler.RESPONSE)
+        calls = [0]
+        lock = threading.Lock()
+
+        class ScriptedTransport(object):
+            def post(self, url, body):
+                lock.acquire()
+                call = calls[0]
+                calls[0] += 1
+                lock.release()
+                if call < failures:
+                    raise socket.error('connection reset')
+                time.sleep(delays[min(call, len(delays) - 1)])
+                return upstream.post(url, body)
+        return ScriptedTransport(), upstream
+
+    def lookup(self, transport, policy):
+        connector = CityStateLookup(USPS_CONNECTION_TEST, USERID, PASSWORD, transport=transport, policy=policy)
+        return connector.execute([{'Zip5': '90210'}])[0]
+
+    def test_transport_errors_are_retried(self):
+        transport, upstream = self.make_transport([0], failures=2)
+        policy = RequestPolicy(retries=2, backoff=0.001)
+        self.assertEqual(self.lookup(transport, policy)['City'], 'BEVERLY HILLS')
+        self.assertEqual(policy.stats()['retried'], 2)
+        self.assertRaises(socket.error, self.lookup, self.make_transport([0], failures=2)[0],
+                          RequestPolicy(retries=1, backoff=0.001))
+
+    def test_slow_requests_are_hedged(self):
+        transport, upstream = self.make_transport([1.0, 0])
+        policy = RequestPolicy(hedge=True, hedge_after=0.01)
+        started = time.time()
+        self.assertEqual(self.lookup(transport, policy)['City'], 'BEVERLY HILLS')
+        self.assertTrue(time.time() - started < 0.5)
+        self.assertEqual(policy.stats()['hedge_wins'], 1)
+
+    def test_timeout(self):
+        transport, upstream = self.make_transport([1.0])
+        policy = RequestPolicy(timeout=0.01)
+        self.assertRaises(USPSTimeoutError, self.lookup, transport, policy)
+        self.assertEqual(policy.stats()['timeouts'], 1)
+
+    def test_latency_includes_the_body(self):
+        upstream = CannedTransport(LocalUSPSHandler.RESPONSE)
+
+        class SlowBody(object):
+            def __init__(self, response):
+                self.response = response
+
+            def read(self, amt=None):
+                time.sleep(0.05)
+                return self.response.read()
+
+            def close(self):
+                self.response.close()
+
+        class SlowBodyTransport(object):
+            def post(self, url, body):
+                return SlowBody(upstream.post(url, body))
+
+        policy = RequestPolicy(hedge=True, min_samples=1)
+        self.assertEqual(self.lookup(SlowBodyTransport(), policy)['City'], 'BEVERLY HILLS')
+        self.assertTrue(policy.hedge_delay() >= 0.05)
+
+    def test_responses_stream_without_hedging(self):
+        body = StringIO(LocalUSPSHandler.RESPONSE)
+
+        class StreamTransport(object):
+            def post(self, url, data):
+                return body
+
+        policy = RequestPolicy(hedge=True, min_samples=1)
+        response = policy.post(StreamTransport(), USPS_CONNECTION_TEST, '')
+        self.assertEqual(body.tell(), 0)
+        self.assertEqual(policy.hedge_delay(), None)
+        self.assertEqual(response.read(), LocalUSPSHandler.RESPONSE)
+        response.close()
+        self.assertNotEqual(policy.hedge_delay(), None)
+
+
+class TestMetrics(unittest.TestCase):
+    """
+    Tests for per-service request metrics
+    """
+    def setUp(self):
+        self.registry = metrics.enable()
+
+    def tearDown(self):
+        metrics.disable()
+
+    def test_phases_and_volume(self):
+        transport = CannedTransport(LocalUSPSHandler.RESPONSE)
+        connector = CityStateLookup(USPS_CONNECTION_TEST, USERID, PASSWORD, transport=transport)
+        connector.execute([{'Zip5': '90210'}] * 7)
+        self.assertEqual(self.registry.get('requests', 'CityStateLookup'), 2)
+        self.assertEqual(self.registry.get('items', 'CityStateLookup'), 7)
+        self.assertEqual(self.registry.get('response_bytes', 'CityStateLookup'), 2 * len(LocalUSPSHandler.RESPONSE))
+        for phase in ('serialize', 'network', 'parse'):
+            self.assertEqual(self.registry.histogram('CityStateLookup', phase).count, 2)
+        self.assertEqual(self.registry.histogram('CityStateLookup', 'convert').count, 2)
+
+        exposition = self.registry.expose()
+        self.assertTrue('usps_phase_seconds_count{service="CityStateLookup",phase="network"} 2' in exposition)
+        self.assertTrue('usps_phase_seconds_bucket{service="CityStateLookup",phase="parse",le="+Inf"} 2' in exposition)
+        self.assertTrue('usps_items_total{service="CityStateLookup"} 7' in exposition)
+
+    def test_errors_by_code(self):
+        transport = CannedTransport('<Error><Number>80040b1a</Number><Description>Authorization failure.</Description>'
+                                    '<Source>USPSCOM::DoAuth</Source></Error>')
+        connector = CityStateLookup(USPS_CONNECTION_TEST, USERID, PASSWORD, transport=transport)
+        self.assertRaises(USPSXMLError, connector.execute, [{'Zip5': '90210'}])
+        self.assertEqual(self.registry.get('errors', 'CityStateLookup', '80040b1a'), 1)
+        self.assertTrue('usps_errors_total{service="CityStateLookup",code="80040b1a"} 1' in self.registry.expose())
+
+
+class TestPartialFailure(unittest.TestCase):
+    """
+    Tests for batches where USPS rejects some of the items
+    """
+    RESPONSE = ('<RateV3Response><Package ID="0"><ZipOrigination>20770</ZipOrigination>'
+                '<ZipDestination>90210</ZipDestination><Pounds>1</Pounds><Ounces>0</Ounces>'
+                '<Container></Container><Size>REGULAR</Size><Zone>8</Zone>'
+                '<Postage CLASSID="1"><MailService>Priority Mail</MailService><Rate>9.80</Rate></Postage>'
+                '</Package><Package ID="1"><Error><Number>-2147219499</Number>'
+                '<Description>Invalid ZIP</Description></Error></Package></RateV3Response>')
+    PACKAGE = {'Service': 'Priority', 'ZipOrigination': '20770', 'ZipDestination': '90210',
+               'Pounds': '1', 'Ounces': '0', 'Size': 'REGULAR'}
+
+    def connector(self, response):
+        return DomesticRateCalculator(USPS_CONNECTION, USERID, PASSWORD,
+                                      transport=CannedTransport(response))
+
+    def test_execute_returns_errors_in_place(self):
+        results = self.connector(self.RESPONSE).execute([self.PACKAGE, self.PACKAGE])
+        self.assertEqual(results[0]['Postage']['Rate'], '9.80')
+        self.assertTrue(isinstance(results[1], USPSXMLError))
+        self.assertEqual(results[1].info['Number'], '-2147219499')
+
+    def test_execute_partial(self):
+        results, errors = self.connector(self.RESPONSE).execute_partial([self.PACKAGE, self.PACKAGE])
+        self.assertEqual(results[0]['Postage']['Rate'], '9.80')
+        self.assertEqual(results[1], None)
+        self.assertEqual(errors.keys(), ['1'])
+        self.assertEqual(errors['1'].item_id, '1')
+
+    def test_errors_keep_their_position_across_requests(self):
+        class RejectingTransport(object):
+            def post(self, url, body):
+                request = ET.fromstring(dict(urlparse.parse_qsl(body))['XML'])
+                return StringIO('<RateV3Response>%s</RateV3Response>' % ''.join(
+                    '<Package ID="%s"><Error><Number>-2147219499</Number>'
+                    '<Description>Invalid ZIP</Description></Error></Package>' % item.get('ID')
+                    for item in request))
+
+        connector = DomesticRateCalculator(USPS_CONNECTION, USERID, PASSWORD, transport=RejectingTransport())
+        data = [self.PACKAGE] * (DomesticRateCalculator.MAX_ITEMS + 3)
+        results, errors = connector.execute_partial(data)
+        self.assertEqual(results, [None] * len(data))
+        self.assertEqual(sorted(errors, key=int), [str(index) for index in range(len(data))])
+        for item_id, error in errors.items():
+            self.assertEqual(error.item_id, item_id)
+
+    def test_request_error_raises(self):
+        response = ('<Error><Number>80040b1a</Number>'
+                    '<Description>Authorization failure.</Description></Error>')
+        connector = self.connector(response)
+        self.assertRaises(USPSXMLError, connector.execute, [self.PACKAGE])
+        self.assertRaises(USPSXMLError, connector.execute_partial, [self.PACKAGE])
+
+
 if __name__ == '__main__':
     #please append your USPS USERID to test against the wire
     import sys
@@ -1,12 +1,66 @@
 '''
 See http://www.usps.com/webtools/htm/Address-Information.htm for complete documentation of the API
 '''
+import re
+
 from usps.api.base import USPSService
+from usps.errors import USPSXMLError
+from usps.records import AddressResult
+
+#USPS Publication 28 abbreviations of common street suffixes and unit designators
+SUFFIXES = {'ALLEY': 'ALY', 'AVENUE': 'AVE', 'BOULEVARD': 'BLVD', 'CIRCLE': 'CIR',
+            'COURT': 'CT', 'DRIVE': 'DR', 'EXPRESSWAY': 'EXPY', 'FREEWAY': 'FWY',
+            'HIGHWAY': 'HWY', 'LANE': 'LN', 'PARKWAY': 'PKWY', 'PLACE': 'PL',
+            'PLAZA': 'PLZ', 'ROAD': 'RD', 'SQUARE': 'SQ', 'STREET': 'ST',
+            'TERRACE': 'TER', 'TRAIL': 'TRL'}
+UNITS = {'APARTMENT': 'APT', 'BUILDING': 'BLDG', 'DEPARTMENT': 'DEPT', 'FLOOR': 'FL',
+         'ROOM': 'RM', 'SUITE': 'STE', 'UNIT': 'UNIT'}
+UNIT_WORDS = set(UNITS.keys() + UNITS.values())
+PUNCTUATION = re.compile(r"[.,;:'\"#()]+")
+NOT_DIGITS = re.compile(r'\D+')
+
+
+def canonical_line(value):
+    """
+    Upper case an address line, drop punctuation, collapse whitespace and
+    abbreviate unit designators and the street suffix, which is the last
+    word or the word before a unit designator
+    """
+    words = PUNCTUATION.sub(' ', unicode(value).upper()).split()
+    for position, word in enumerate(words):
+        if word in UNITS:
+            words[position] = UNITS[word]
+        elif word in SUFFIXES and (position == len(words) - 1 or words[position + 1] in UNIT_WORDS):
+            words[position] = SUFFIXES[word]
+    return u' '.join(words)
+
+
+def canonical_address(data_dict, parameters):
+    """
+    @return: a tuple of the address fields in parameters in canonical form,
+        addresses USPS would answer the same way mostly share it
+    """
+    ret = list()
+    for key in parameters:
+        value = data_dict.get(key)
+        if value is None or value is False:
+            continue
+        if key in ('Zip5', 'Zip4'):
+            value = NOT_DIGITS.sub('', unicode(value))
+        else:
+            value = canonical_line(value)
+        if value:
+            ret.append((key, value))
+    return tuple(ret)
+
 
 class AddressValidate(USPSService):
     SERVICE_NAME = 'AddressValidate'
     CHILD_XML_NAME = 'Address'
     API = 'Verify'
+    MAX_ITEMS = 5
+    CACHE_TTL = 7 * 24 * 60 * 60
+    RECORD_CLASS = AddressResult
     PARAMETERS = ['FirmName',
                   'Address1',
                   'Address2',
@@ -15,18 +69,74 @@ class AddressValidate(USPSService):
                   'Zip5',
                   'Zip4',]
     
+    def cache_key(self, data_dict):
+        """
+        Addresses differing only in case, whitespace, punctuation or
+        abbreviations share a key
+        """
+        return (self.API, self.records, canonical_address(data_dict, self.PARAMETERS))
+    
     
 class ZipCodeLookup(USPSService):
     SERVICE_NAME = 'ZipCodeLookup'
     CHILD_XML_NAME = 'Address'
+    MAX_ITEMS = 5
+    CACHE_TTL = 7 * 24 * 60 * 60
+    RECORD_CLASS = AddressResult
     PARAMETERS = ['FirmName',
                   'Address1',
                   'Address2',
                   'City',
                   'State',]  
+    
+    def cache_key(self, data_dict):
+        return (self.API, self.records, canonical_address(data_dict, self.PARAMETERS))
 
 class CityStateLookup(USPSService):
     SERVICE_NAME = 'CityStateLookup'
     CHILD_XML_NAME = 'ZipCode'
+    MAX_ITEMS = 5
+    CACHE_TTL = 30 * 24 * 60 * 60
+    RECORD_CLASS = AddressResult
     PARAMETERS = ['Zip5',]
+    
+    def __init__(self, *args, **kwargs):
+        """
+        Takes the USPSService arguments plus an optional zip_index, a
+        usps.zipindex.ZipIndex answering known ZIP codes without a request
+        """
+        self.zip_index = kwargs.pop('zip_index', None)
+        super(CityStateLookup, self).__init__(*args, **kwargs)
+    
+    def execute(self, data, user_id=None, password=None):
+        """
+        Look ZIP codes up in the zip_index, only unknown or stale ones are
+        sent to USPS and their responses are added to the index. Index hits
+        are returned as AddressResult records when the service uses records
+        """
+        if self.zip_index is None:
+            return super(CityStateLookup, self).execute(data, user_id, password)
+        
+        results = list()
+        misses = list()
+        for index, data_dict in enumerate(data):
+            result = self.zip_index.get(data_dict.get('Zip5', ''))
+            if result is None:
+                misses.append(index)
+            elif self.records:
+                result = AddressResult(zip5=result['Zip5'], city=result['City'], state=result['State'])
+            results.append(result)
+        if misses:
+            fetched = super(CityStateLookup, self).execute([data[index] for index in misses], user_id, password)
+            for index, result in zip(misses, fetched):
+                if isinstance(result, USPSXMLError):
+                    location = None
+                elif self.records:
+                    location = (result.zip5, result.city, result.state)
+                else:
+                    location = (result.get('Zip5'), result.get('City'), result.get('State'))
+                if location and location[1] and location[2]:
+                    self.zip_index.add(*location)
+                results[index] = result
+        return results
 
@@ -0,0 +1,265 @@
+"""
+Non-blocking counterparts of the USPS service wrappers
+
+execute on these classes returns a USPSFuture straight away while the
+requests run on a bounded pool of worker threads, so a single caller can
+queue thousands of lookups without managing threads itself.
+
+This is still a thread pool, not an event loop: at most max_concurrency
+requests of an Executor are on the wire at once and the rest wait in its
+queue. Python 2 has no event loop in the standard library that the
+blocking urllib2 and httplib transports could run on, and asyncore would
+need an HTTP client of its own, so the package stays with threads.
+"""
+import sys
+import threading
+import Queue
+
+from usps.utils import chunked
+from usps.errors import USPSTimeoutError
+from usps.api.addressinformation import AddressValidate, ZipCodeLookup, CityStateLookup
+from usps.api.ratecalculator import DomesticRateCalculator, InternationalRateCalculator
+from usps.api.servicestandards import PriorityMailServiceStandards, PackageServicesServiceStandards, ExpressMailServiceCommitment
+from usps.api.tracking import TrackConfirm
+
+
+class USPSFuture(object):
+    """
+    The pending result of an asynchronous USPS call
+    """
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._done = False
+        self._result = None
+        self._exception = None
+        self._callbacks = list()
+
+    def done(self):
+        return self._done
+
+    def result(self, timeout=None):
+        """
+        Block until the call completes
+        @param timeout: seconds to wait, None to wait forever
+        @return: the result of the call, re-raising its exception if it failed
+        """
+        self._wait(timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        """
+        Block until the call completes
+        @return: the exception raised by the call or None
+        """
+        self._wait(timeout)
+        return self._exception
+
+    def add_done_callback(self, callback):
+        """
+        Call callback with this future once it completes, straight away if it already has
+        """
+        self._condition.acquire()
+        try:
+            if not self._done:
+                self._callbacks.append(callback)
+                return
+        finally:
+            self._condition.release()
+        callback(self)
+
+    def set_result(self, result):
+        self._finish(result, None)
+
+    def set_exception(self, exception):
+        self._finish(None, exception)
+
+    def _wait(self, timeout):
+        self._condition.acquire()
+        try:
+            if not self._done:
+                self._condition.wait(timeout)
+            if not self._done:
+                raise USPSTimeoutError('USPS call did not complete within %s seconds' % timeout)
+        finally:
+            self._condition.release()
+
+    def _finish(self, result, exception):
+        self._condition.acquire()
+        try:
+            self._result = result
+            self._exception = exception
+            self._done = True
+            callbacks, self._callbacks = self._callbacks, list()
+            self._condition.notify_all()
+        finally:
+            self._condition.release()
+        for callback in callbacks:
+            callback(self)
+
+
+def gather(futures):
+    """
+    Combine several futures into one
+    @param futures: a list of USPSFuture objects
+    @return: a USPSFuture of the list of their results, failing with the first exception
+    """
+    combined = USPSFuture()
+    results = [None] * len(futures)
+    state = {'pending': len(futures)}
+    lock = threading.Lock()
+    if not futures:
+        combined.set_result(results)
+
+    def make_callback(index):
+        def callback(future):
+            exception = future.exception()
+            lock.acquire()
+            try:
+                if combined.done():
+                    return
+                if exception is not None:
+                    combined.set_exception(exception)
+                    return
+                results[index] = future.result()
+                state['pending'] -= 1
+                if not state['pending']:
+                    combined.set_result(results)
+            finally:
+                lock.release()
+        return callback
+
+    for index, future in enumerate(futures):
+        future.add_done_callback(make_callback(index))
+    return combined
+
+
+class Executor(object):
+    """
+    Runs calls on at most max_concurrency worker threads, queueing the rest
+    """
+    def __init__(self, max_concurrency=10):
+        self.max_concurrency = max_concurrency
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._threads = list()
+
+    def submit(self, func, *args):
+        """
+        Schedule func(*args)
+        @return: a USPSFuture of its result
+        """
+        future = USPSFuture()
+        self._queue.put((future, func, args))
+        self._lock.acquire()
+        try:
+            if len(self._threads) < self.max_concurrency:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+        finally:
+            self._lock.release()
+        return future
+
+    def _work(self):
+        while True:
+            future, func, args = self._queue.get()
+            try:
+                result = func(*args)
+            except Exception:
+                future.set_exception(sys.exc_info()[1])
+            else:
+                future.set_result(result)
+
+
+DEFAULT_EXECUTOR = Executor()
+
+
+class AsyncUSPSService(object):
+    """
+    Mixin making execute return a USPSFuture, mix in ahead of a USPSService subclass
+    """
+    def __init__(self, *args, **kwargs):
+        """
+        Takes the arguments of the service it is mixed into plus an
+        optional executor, the Executor bounding how many requests run at
+        once, a process wide executor is shared when omitted
+        """
+        executor = kwargs.pop('executor', None)
+        super(AsyncUSPSService, self).__init__(*args, **kwargs)
+        if executor is None:
+            executor = DEFAULT_EXECUTOR
+        self.executor = executor
+
+    def execute(self, data, user_id=None, password=None):
+        """
+        Create XML from data dictionary and submit it to the USPS API in
+        the background, every request needed for data runs concurrently
+
+        Each request's worth of data goes through the synchronous execute
+        of the service, so caches, single_flight groups and the local
+        answers of services like CityStateLookup apply as they do there.
+
+        @param user_id: a USPS user id
+        @param data: the data to serialize and submit
+        @return: a USPSFuture of the response from USPS as a list of dictionaries
+        """
+        if user_id is None:
+            user_id = self.user_id
+
+        if password is None:
+            password = self.password
+
+        futures = [self.executor.submit(self._execute_blocking, chunk, user_id, password)
+                   for chunk in chunked(data, self.MAX_ITEMS)]
+        flattened = USPSFuture()
+
+        def flatten(future):
+            exception = future.exception()
+            if exception is not None:
+                flattened.set_exception(exception)
+            else:
+                flattened.set_result([item for result in future.result() for item in result])
+        gather(futures).add_done_callback(flatten)
+        return flattened
+
+    def _execute_blocking(self, data, user_id, password):
+        return super(AsyncUSPSService, self).execute(data, user_id, password)
+
+
+class AsyncAddressValidate(AsyncUSPSService, AddressValidate):
+    pass
+
+
+class AsyncZipCodeLookup(AsyncUSPSService, ZipCodeLookup):
+    pass
+
+
+class AsyncCityStateLookup(AsyncUSPSService, CityStateLookup):
+    pass
+
+
+class AsyncDomesticRateCalculator(AsyncUSPSService, DomesticRateCalculator):
+    pass
+
+
+class AsyncInternationalRateCalculator(AsyncUSPSService, InternationalRateCalculator):
+    pass
+
+
+class AsyncPriorityMailServiceStandards(AsyncUSPSService, PriorityMailServiceStandards):
+    pass
+
+
+class AsyncPackageServicesServiceStandards(AsyncUSPSService, PackageServicesServiceStandards):
+    pass
+
+
+class AsyncExpressMailServiceCommitment(AsyncUSPSService, ExpressMailServiceCommitment):
+    pass
+
+
+class AsyncTrackConfirm(AsyncUSPSService, TrackConfirm):
+    pass
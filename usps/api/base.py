@@ -2,14 +2,20 @@
 Base implementation of USPS service wrapper
 """
 
-import urllib, urllib2
-from usps.utils import utf8urlencode, xmltodict, dicttoxml
+import sys
+from usps.utils import utf8urlencode, xmltodict, dicttoxml, chunked, threaded_imap
 from usps.errors import USPSXMLError
+from usps.templates import RequestTemplate
+from usps.transport import UrllibTransport
+from usps import metrics
 
 try:
-    from xml.etree import ElementTree as ET
+    from xml.etree import cElementTree as ET
 except ImportError:
-    from elementtree import ElementTree as ET
+    try:
+        from xml.etree import ElementTree as ET
+    except ImportError:
+        from elementtree import ElementTree as ET
 
 class USPSService(object):
     """
@@ -18,15 +24,61 @@ class USPSService(object):
     SERVICE_NAME = ''
     CHILD_XML_NAME = ''
     PARAMETERS = []
+    MAX_ITEMS = None #the most items USPS accepts in a single request
+    CACHE_TTL = None #seconds a cached response stays valid, None for the cache default
+    POLICY = None #a usps.policy.RequestPolicy shared by the instances of a service
+    RECORD_CLASS = None #the usps.records class items are parsed into when records are enabled
     
     @property
     def API(self):
         return self.SERVICE_NAME
         
-    def __init__(self, url, user_id, password):
+    def __init__(self, url, user_id, password, transport=None, concurrency=4, cache=None, records=False,
+                 single_flight=None, policy=None):
+        """
+        @param url: the USPS API endpoint
+        @param user_id: a USPS user id
+        @param password: a USPS password
+        @param transport: the usps.transport object requests are posted
+            through, such as a shared HTTPConnectionPool, defaults to a
+            UrllibTransport
+        @param concurrency: the number of requests submitted at once when
+            data has to be split over several requests
+        @param cache: an optional cache such as an LRUCache, items found in
+            it are answered without contacting USPS
+        @param records: return RECORD_CLASS instances instead of dictionaries
+        @param single_flight: an optional usps.coalesce.SingleFlight, items
+            already in flight through it are waited on instead of resent
+        @param policy: an optional usps.policy.RequestPolicy timing out,
+            retrying and hedging requests, the class' POLICY by default
+        """
         self.url = url
         self.user_id = user_id
         self.password = password
+        if transport is None:
+            transport = UrllibTransport()
+        self.transport = transport
+        self.concurrency = concurrency
+        self.cache = cache
+        self.records = records
+        self.single_flight = single_flight
+        if policy is None:
+            policy = self.POLICY
+        self.policy = policy
+
+    def send_xml(self, xml):
+        """
+        send XML to USPS without reading the response
+        @param xml: the xml to submit, an element or an already serialized string
+        @return: the file-like response from USPS
+        """
+        if not isinstance(xml, basestring):
+            xml = ET.tostring(xml)
+        data = {'XML':xml,
+                'API':self.API}
+        if self.policy is not None:
+            return self.policy.post(self.transport, self.url, utf8urlencode(data))
+        return self.transport.post(self.url, utf8urlencode(data))
 
     def submit_xml(self, xml):
         """
@@ -34,15 +86,37 @@ class USPSService(object):
         @param xml: the xml to submit
         @return: the response element from USPS
         """
-        data = {'XML':ET.tostring(xml),
-                'API':self.API}
-        response = urllib2.urlopen(self.url, utf8urlencode(data))
-        root = ET.parse(response).getroot()
-        if root.tag == 'Error':
-            raise USPSXMLError(root)
-        error = root.find('.//Error')
-        if error:
-            raise USPSXMLError(error)
+        registry = metrics.registry
+        if registry is None:
+            return self.read_response(self.send_xml(xml))
+        started = metrics.clock()
+        try:
+            response = metrics.CountingResponse(self.send_xml(xml))
+            received = metrics.clock()
+            root = self.read_response(response)
+        except Exception:
+            registry.error(self.API, sys.exc_info()[1])
+            raise
+        registry.observe(self.API, 'network', received - started)
+        registry.observe(self.API, 'parse', metrics.clock() - received)
+        registry.count('requests', self.API)
+        registry.count('response_bytes', self.API, response.bytes)
+        return root
+    
+    def read_response(self, response):
+        """
+        Parse a complete response from USPS, raising for request level errors
+        @param response: the file-like response from USPS
+        @return: the response element, items may still hold their own Error elements
+        """
+        try:
+            root = ET.parse(response).getroot()
+            if root.tag == 'Error':
+                error = USPSXMLError(root)
+                _request_failed(response, error)
+                raise error
+        finally:
+            response.close()
         return root
     
     def parse_xml(self, xml):
@@ -53,9 +127,76 @@ class USPSService(object):
         """
         items = list()
         for item in xml.getchildren():#xml.findall(self.SERVICE_NAME+'Response'):
-            items.append(xmltodict(item))
+            error = _find_error(item)
+            if error is not None:
+                items.append(USPSXMLError(error, item.get('ID')))
+            else:
+                items.append(self.parse_item(item))
         return items
     
+    def parse_item(self, element):
+        """
+        Parse a single item of a response from USPS
+        @param element: the item element
+        @return: a dictionary or, when records are enabled, a RECORD_CLASS instance
+        """
+        registry = metrics.registry
+        if registry is not None:
+            started = metrics.clock()
+        if self.records:
+            item = self.RECORD_CLASS.from_element(element)
+        else:
+            item = xmltodict(element)
+        if registry is not None:
+            registry.observe(self.API, 'convert', metrics.clock() - started)
+        return item
+    
+    def iter_response(self, response):
+        """
+        Incrementally parse a response from USPS, each top level item is
+        parsed as soon as its end tag arrives and then discarded
+        
+        An item USPS answered with an Error is yielded as a USPSXMLError
+        instead of failing the whole response, only request level errors
+        are raised.
+        
+        @param response: the file-like response from USPS
+        @return: a generator of (ID attribute, dictionary or USPSXMLError) tuples
+        """
+        depth = 0
+        root = None
+        try:
+            for event, element in ET.iterparse(response, events=('start', 'end')):
+                if event == 'start':
+                    if root is None:
+                        root = element
+                    depth += 1
+                    continue
+                depth -= 1
+                #the children of a top level Error are its Number and Description, not items
+                if depth == 1 and root.tag != 'Error':
+                    item_id = element.get('ID')
+                    error = _find_error(element)
+                    if error is not None:
+                        yield item_id, USPSXMLError(error, item_id)
+                    else:
+                        yield item_id, self.parse_item(element)
+                    root.clear()
+                elif depth == 0 and element.tag == 'Error':
+                    error = USPSXMLError(element)
+                    _request_failed(response, error)
+                    raise error
+        finally:
+            response.close()
+    
+    def item_id(self, index, data_dict):
+        """
+        @param index: the position of data_dict within a request
+        @param data_dict: the data for a single item
+        @return: the ID attribute sent to USPS for the item
+        """
+        return str(index)
+    
     def make_xml(self, data, user_id, password=None):
         """
         Transform the data provided to an XML fragment
@@ -69,16 +210,194 @@ class USPSService(object):
         index = 0
         for data_dict in data:
             data_xml = dicttoxml(data_dict, self.CHILD_XML_NAME, self.PARAMETERS)
-            data_xml.attrib['ID'] = str(index)
+            data_xml.attrib['ID'] = self.item_id(index, data_dict)
             root.append(data_xml)
             index += 1
         return root
     
+    def make_request(self, data, user_id, password):
+        """
+        Serialize data to the XML request sent to USPS
+        
+        Services using the default make_xml are written by a RequestTemplate
+        compiled from their PARAMETERS, which skips building an element tree
+        but produces the same bytes.
+        
+        @param data: the data to serialize and send to USPS
+        @param user_id: the USPS API user id
+        @return: the request XML as a string
+        """
+        if type(self).make_xml.im_func is not USPSService.make_xml.im_func:
+            return ET.tostring(self.make_xml(data, user_id, password))
+        return RequestTemplate.for_service(type(self)).render(self, data, user_id, password)
+    
+    def iter_chunk(self, data, user_id, password):
+        """
+        Submit data which fits in a single request to USPS and stream
+        the parsed items as they arrive
+        
+        @param data: the data to serialize and submit
+        @param user_id: a USPS user id
+        @return: a generator of (index in data, dictionary) tuples in response order
+        """
+        positions = dict()
+        for index, data_dict in enumerate(data):
+            positions.setdefault(self.item_id(index, data_dict), list()).append(index)
+        registry = metrics.registry
+        if registry is not None:
+            started = metrics.clock()
+        request = self.make_request(data, user_id, password)
+        if registry is not None:
+            sent = metrics.clock()
+            registry.observe(self.API, 'serialize', sent - started)
+            registry.count('requests', self.API)
+            registry.count('items', self.API, len(data))
+            registry.count('request_bytes', self.API, len(request))
+        try:
+            response = self.send_xml(request)
+            if registry is not None:
+                received = metrics.clock()
+                registry.observe(self.API, 'network', received - sent)
+                response = metrics.CountingResponse(response)
+            arrival = 0
+            for item_id, item in self.iter_response(response):
+                if registry is not None and isinstance(item, USPSXMLError):
+                    registry.error(self.API, item)
+                indexes = positions.get(item_id)
+                if indexes:
+                    yield indexes.pop(0), item
+                else:
+                    yield arrival, item
+                arrival += 1
+        except Exception:
+            if registry is not None:
+                registry.error(self.API, sys.exc_info()[1])
+            raise
+        if registry is not None:
+            registry.observe(self.API, 'parse', metrics.clock() - received)
+            registry.count('response_bytes', self.API, response.bytes)
+    
+    def execute_chunk(self, data, user_id, password):
+        """
+        Submit data which fits in a single request to USPS
+        
+        @param data: the data to serialize and submit
+        @param user_id: a USPS user id
+        @return: the parsed response items in the order of data
+        """
+        results = [None] * len(data)
+        for index, item in self.iter_chunk(data, user_id, password):
+            results[index] = item
+        return results
+    
+    def cache_key(self, data_dict):
+        """
+        Build the cache key of an item from its normalized PARAMETERS values,
+        values differing only in surrounding whitespace share a key
+        @param data_dict: the data for a single item
+        @return: a hashable cache key
+        """
+        return (self.API, self.records, _normalize(data_dict, self.PARAMETERS))
+    
+    def execute_cached(self, data, user_id, password):
+        """
+        Answer the items found in the cache locally and submit only the misses
+        
+        @param data: the data to serialize and submit
+        @param user_id: a USPS user id
+        @return: the response items in the order of data
+        """
+        results = list()
+        misses = dict()
+        for index, data_dict in enumerate(data):
+            key = self.cache_key(data_dict)
+            result = self.cache.get(key)
+            if result is None:
+                misses.setdefault(key, (data_dict, list()))[1].append(index)
+            results.append(result)
+        if misses:
+            pending = misses.values()
+            fetched = self.execute_items([data_dict for data_dict, indexes in pending], user_id, password)
+            for (data_dict, indexes), result in zip(pending, fetched):
+                if not isinstance(result, USPSXMLError):
+                    self.cache.set(self.cache_key(data_dict), result, self.CACHE_TTL)
+                for index in indexes:
+                    results[index] = result
+        return results
+    
+    def execute_coalesced(self, data, user_id, password):
+        """
+        Submit only the items not already in flight through single_flight
+        and wait for the others to be answered
+        
+        @param data: the data to serialize and submit
+        @param user_id: a USPS user id
+        @return: the response items in the order of data
+        """
+        calls, owned = self.single_flight.join([self.cache_key(data_dict) for data_dict in data])
+        if owned:
+            owned = owned.items()
+            try:
+                results = self.execute_chunks([data[index] for key, index in owned], user_id, password)
+            except Exception:
+                error = sys.exc_info()[1]
+                for key, index in owned:
+                    self.single_flight.finish(key, error=error)
+                raise
+            for (key, index), result in zip(owned, results):
+                self.single_flight.finish(key, result)
+        return [call.wait() for call in calls]
+    
+    def execute_items(self, data, user_id, password):
+        """
+        Submit data, coalescing items with other callers when the service
+        has a single_flight group
+        """
+        if self.single_flight is not None:
+            return self.execute_coalesced(data, user_id, password)
+        return self.execute_chunks(data, user_id, password)
+    
+    def execute_chunks(self, data, user_id, password):
+        """
+        Split data into requests of at most MAX_ITEMS items and submit them concurrently
+        
+        @param data: the data to serialize and submit
+        @param user_id: a USPS user id
+        @return: the response items in the order of data
+        """
+        chunks = list(chunked(data, self.MAX_ITEMS))
+        workers = min(self.concurrency, len(chunks))
+        if workers < 2:
+            results = [self.execute_chunk(chunk, user_id, password) for chunk in chunks]
+        else:
+            results = [None] * len(chunks)
+            execute_chunk = lambda chunk: self.execute_chunk(chunk, user_id, password)
+            for index, success, result in threaded_imap(execute_chunk, chunks, workers):
+                if not success:
+                    raise result
+                results[index] = result
+        items = [item for result in results for item in result]
+        if len(chunks) > 1:
+            #IDs restart at 0 in every request, errors get the ID of their position in data
+            for index, item in enumerate(items):
+                if isinstance(item, USPSXMLError):
+                    items[index] = item.for_item(self.item_id(index, data[index]))
+        return items
+    
     def execute(self,data, user_id=None, password=None):
         """
         Create XML from data dictionary, submit it to 
         the USPS API and parse the response
         
+        Data holding more than MAX_ITEMS items is split over several
+        requests which are submitted concurrently. When the service has a
+        cache only the items missing from it are submitted, cached results
+        are shared between callers and should not be modified. The same
+        goes for results shared through a single_flight group.
+        
+        Items USPS answers with an Error come back as USPSXMLError
+        instances in their place, only request level errors are raised.
+        
         @param user_id: a USPS user id
         @param data: the data to serialize and submit
         @return: the response from USPS as a dictionary
@@ -88,6 +407,109 @@ class USPSService(object):
 
         if password is None:
             password = self.password
-            
-        xml = self.make_xml(data, user_id, password)
-        return self.parse_xml(self.submit_xml(xml))
\ No newline at end of file
+        
+        if self.cache is not None:
+            return self.execute_cached(data, user_id, password)
+        return self.execute_items(data, user_id, password)
+    
+    def execute_partial(self, data, user_id=None, password=None):
+        """
+        Execute data and separate the items USPS answered from the ones it rejected
+        
+        @param data: the data to serialize and submit
+        @param user_id: a USPS user id
+        @return: (results, errors) where results holds the response for
+            every item in the order of data, None for rejected ones, and
+            errors maps the ID of every rejected item to its USPSXMLError
+        """
+        results = self.execute(data, user_id, password)
+        errors = dict()
+        for index, result in enumerate(results):
+            if isinstance(result, USPSXMLError):
+                item_id = self.item_id(index, data[index])
+                if result.item_id != item_id:
+                    #cached and coalesced items were sent at other positions
+                    result = result.for_item(item_id)
+                errors[item_id] = result
+                results[index] = None
+        return results, errors
+    
+    def execute_iter(self, data, user_id=None, password=None, backlog=None):
+        """
+        Submit any iterable of data dictionaries, including unbounded
+        generators, and yield results as their requests complete
+        
+        Only backlog requests worth of data are read ahead of the consumer
+        so memory use does not grow with the size of data. Every chunk goes
+        through execute, so caches and the local answers of subclasses
+        apply as they do there.
+        
+        @param data: an iterable of data dictionaries
+        @param user_id: a USPS user id
+        @param backlog: the most requests in flight or waiting to be
+            consumed, defaults to twice the concurrency
+        @return: a generator of (index in data, result or exception) tuples
+            in completion order
+        """
+        if user_id is None:
+            user_id = self.user_id
+
+        if password is None:
+            password = self.password
+        
+        def execute_chunk(chunk):
+            indexes = [index for index, data_dict in chunk]
+            try:
+                results = self._execute_blocking([data_dict for index, data_dict in chunk], user_id, password)
+            except Exception:
+                results = [sys.exc_info()[1]] * len(chunk)
+            return zip(indexes, results)
+        
+        chunks = chunked(enumerate(data), self.MAX_ITEMS)
+        for task, success, results in threaded_imap(execute_chunk, chunks, max(self.concurrency, 1), backlog):
+            for result in results:
+                yield result
+    
+    def _execute_blocking(self, data, user_id, password):
+        """
+        execute returning the results themselves, for wrappers whose execute returns a future
+        """
+        return self.execute(data, user_id, password)
+
+
+def _request_failed(response, error):
+    """
+    Tell the response and the wrappers around it, such as a
+    usps.throttle.ThrottledResponse, that USPS answered with a request level error
+    """
+    while response is not None:
+        request_failed = getattr(response, 'request_failed', None)
+        if request_failed is not None:
+            request_failed(error)
+        response = getattr(response, 'response', None)
+
+def _find_error(element):
+    """
+    @return: the first Error element at or below element or None
+    """
+    if element.tag == 'Error':
+        return element
+    return element.find('.//Error')
+
+def _normalize(data_dict, parameters):
+    """
+    @return: a tuple of the PARAMETERS dicttoxml would serialize with their values stripped
+    """
+    ret = list()
+    for key in parameters:
+        value = data_dict.get(key, False)
+        if type(value).__name__ == 'dict':
+            value = _normalize(value, parameters)
+        elif value == False:
+            continue
+        elif value is None:
+            value = ''
+        else:
+            value = unicode(value).strip()
+        ret.append((key, value))
+    return tuple(ret)
\ No newline at end of file
@@ -2,6 +2,8 @@
 Rate Calculator classes
 """
 from usps.api.base import USPSService
+from usps.errors import USPSXMLError
+from usps.records import RatePackage, IntlRatePackage
 
 class DomesticRateCalculator(USPSService):
     """
@@ -9,6 +11,9 @@ class DomesticRateCalculator(USPSService):
     """
     SERVICE_NAME = 'RateV3'
     CHILD_XML_NAME = 'Package'
+    MAX_ITEMS = 25
+    CACHE_TTL = 24 * 60 * 60
+    RECORD_CLASS = RatePackage
 
     PARAMETERS = ['Service',
                   'FirstClassMailType',
@@ -27,6 +32,48 @@ class DomesticRateCalculator(USPSService):
                   'ShipDate',
                   ]
     
+    def __init__(self, *args, **kwargs):
+        """
+        Takes the USPSService arguments plus an optional rate_engine, a
+        usps.ratetable.RateEngine quoting known rates without a request,
+        which needs records=True
+        """
+        self.rate_engine = kwargs.pop('rate_engine', None)
+        super(DomesticRateCalculator, self).__init__(*args, **kwargs)
+        if self.rate_engine is not None and not self.records:
+            raise ValueError('a rate_engine needs records=True')
+    
+    def execute(self, data, user_id=None, password=None):
+        """
+        Quote packages from the rate_engine, the ones it cannot answer and a
+        sample of the ones it did are sent to USPS and teach the engine
+        """
+        if self.rate_engine is None:
+            return super(DomesticRateCalculator, self).execute(data, user_id, password)
+        
+        engine = self.rate_engine
+        results = list()
+        sent = list()
+        for index, data_dict in enumerate(data):
+            result = engine.quote(data_dict)
+            if result is not None:
+                result.id = str(index)
+            if result is None or engine.sample():
+                sent.append(index)
+            results.append(result)
+        if sent:
+            fetched = super(DomesticRateCalculator, self).execute([data[index] for index in sent], user_id, password)
+            for index, package in zip(sent, fetched):
+                if isinstance(package, USPSXMLError):
+                    #a rejected package teaches nothing about prices
+                    pass
+                elif results[index] is None:
+                    engine.learn(data[index], package)
+                else:
+                    engine.check(data[index], results[index], package)
+                results[index] = package
+        return results
+    
     
 class InternationalRateCalculator(USPSService):
     """
@@ -34,6 +81,9 @@ class InternationalRateCalculator(USPSService):
     """
     SERVICE_NAME = 'IntlRate'
     CHILD_XML_NAME = 'Package'
+    MAX_ITEMS = 25
+    CACHE_TTL = 24 * 60 * 60
+    RECORD_CLASS = IntlRatePackage
     PARAMETERS = [
                   'Pounds',
                   'Ounces',
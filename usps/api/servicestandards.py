@@ -1,19 +1,18 @@
 """
 Service standards API wrappers
 """
-from usps.utils import dicttoxml, xmltodict
-from usps.api.base import USPSService
+from usps.utils import dicttoxml, threaded_imap
+from usps.api.base import USPSService, _find_error
+from usps.errors import USPSXMLError
+from usps.records import ServiceStandard
 
-try:
-    from xml.etree import ElementTree as ET
-except ImportError:
-    from elementtree import ElementTree as ET
-    
-    
 
 
 class ServiceStandards(USPSService):
     SERVICE_NAME = ''
+    MAX_ITEMS = 1 #each request carries a single origin/destination pair
+    CACHE_TTL = 24 * 60 * 60
+    RECORD_CLASS = ServiceStandard
     PARAMETERS = [
                   'OriginZip',
                   'DestinationZip'
@@ -24,13 +23,14 @@ class ServiceStandards(USPSService):
         """
         Transform the data provided to an XML fragment
         @param userid: the USPS API user id
-        @param data: the data to serialize and send to USPS
+        @param data: a list holding the single item to serialize and send to USPS
         @return: an XML fragment representing data
         """
-        for data_dict in data:
-            data_xml = dicttoxml(data_dict, self.SERVICE_NAME+'Request', self.PARAMETERS)
-            data_xml.attrib['USERID'] = user_id
-            data_xml.attrib['PASSWORD'] = password
+        if len(data) != 1:
+            raise ValueError('%s requests carry exactly one item, got %d' % (self.SERVICE_NAME, len(data)))
+        data_xml = dicttoxml(data[0], self.SERVICE_NAME+'Request', self.PARAMETERS)
+        data_xml.attrib['USERID'] = user_id
+        data_xml.attrib['PASSWORD'] = password
         return data_xml
     
     def parse_xml(self, xml):
@@ -39,7 +39,18 @@ class ServiceStandards(USPSService):
         @param xml: the xml to parse
         @return: a dictionary representing the XML response from USPS
         """
-        return [xmltodict(xml),]
+        return [self.parse_item(xml),]
+    
+    def iter_response(self, response):
+        """
+        The response element itself is the single item so it is parsed whole
+        """
+        root = self.read_response(response)
+        error = _find_error(root)
+        if error is not None:
+            yield None, USPSXMLError(error)
+        else:
+            yield None, self.parse_xml(root)[0]
     
 
 class PriorityMailServiceStandards(ServiceStandards):
@@ -61,6 +72,7 @@ class ExpressMailServiceCommitment(ServiceStandards):
     Provides drop off locations and commitments for shipment on a given date
     """
     SERVICE_NAME = 'ExpressMailCommitment'
+    CACHE_TTL = 60 * 60 #commitments depend on the time of day
     PARAMETERS = [
                   'OriginZIP',
                   'DestinationZIP',
@@ -73,7 +85,78 @@ CLASSID_TO_SERVICE = {
                       'Express': [2,3,13,23,25,27]
                       }
     
-def get_service_standards(package_data, url, user_id, password):
+def _delivery_time(response):
+    """
+    @param response: a ServiceStandard record or the USPSXMLError USPS answered with
+    @return: the delivery estimate as a string or False
+    """
+    if isinstance(response, USPSXMLError):
+        return False
+    if response.commitments:
+        return response.commitments[0].name or False
+    if response.days is None:
+        return False
+    return '%s Days' % response.days
+
+
+def _domestic_service(classid):
+    """
+    @return: the service standards class answering a domestic class id or None
+    """
+    if classid in CLASSID_TO_SERVICE['Priority']:
+        return PriorityMailServiceStandards
+    if classid in CLASSID_TO_SERVICE['Package']:
+        return PackageServicesServiceStandards
+    return None
+
+
+def _zip_prefix(zip_code):
+    """
+    Domestic service standards only depend on the 3-digit ZIP prefixes
+    """
+    return (zip_code or '').strip()[:3]
+
+
+def _standards_request(package_data):
+    """
+    @param package_data: a dictionary as taken by get_service_standards
+    @return: (service class, request data) for the package or None for an unknown class id,
+        equal requests always have equal data
+    """
+    classid = package_data.get('CLASSID', False)
+    if classid in CLASSID_TO_SERVICE['Express']:
+        #commitments depend on the full ZIP codes and the mailing date
+        return ExpressMailServiceCommitment, {'OriginZIP': package_data.get('OriginZip'),
+                                              'DestinationZIP': package_data.get('DestinationZip'),
+                                              'Date': package_data.get('Date', "")}
+    service_class = _domestic_service(classid)
+    if service_class is None:
+        return None
+    return service_class, {'OriginZip': _zip_prefix(package_data.get('OriginZip')),
+                           'DestinationZip': _zip_prefix(package_data.get('DestinationZip'))}
+
+
+def _matrix_days(matrices, service_class, data):
+    """
+    @param matrices: a dictionary of SERVICE_NAME to usps.standardsmatrix.StandardsMatrix or None
+    @return: the delivery days the matrix of service_class holds for data or None
+    """
+    if not matrices or service_class.SERVICE_NAME not in matrices:
+        return None
+    return matrices[service_class.SERVICE_NAME].get(data.get('OriginZip'), data.get('DestinationZip'))
+
+
+def _matrix_add(matrices, service_class, data, response):
+    """
+    Remember a fetched standard in the matrix of service_class
+    """
+    if isinstance(response, USPSXMLError):
+        return
+    if matrices and service_class.SERVICE_NAME in matrices:
+        matrices[service_class.SERVICE_NAME].add(data.get('OriginZip'), data.get('DestinationZip'), response.days)
+
+
+def get_service_standards(package_data, url, user_id, password, transport=None, matrices=None):
     """
     Given a package class id return the appropriate service standards api class
     for calculating a domestic service standard or express mail commitment
@@ -81,37 +164,98 @@ def get_service_standards(package_data, url, user_id, password):
     @param package_data: a dictionary containing OriginZip, DestinationZip, CLASSID, and optional Date keys
     @param: url a URL to send api calls to
     @param: user_id a valid USPS user id
+    @param: transport an optional transport shared between calls
+    @param matrices: an optional dictionary of SERVICE_NAME to usps.standardsmatrix.StandardsMatrix,
+        domestic standards found there are answered without a request
     @return: a service standard estimate for the provided data as a string or False
     """
     classid = package_data.get('CLASSID', False)
-    connection = False
     if classid in CLASSID_TO_SERVICE['Express']:
         data = {}
         data['OriginZIP'] = package_data.get('OriginZip')
         data['DestinationZIP'] = package_data.get('DestinationZip')
         data['Date'] = package_data.get('Date', "")
         
-        connection = ExpressMailServiceCommitment(url, user_id, password)
-        response = connection.execute([data])[0]   
-
-        commitment = response.get('Commitment')
-        if type(commitment).__name__ == 'list':
-            delivery_time = commitment[0].get('CommitmentName', False)
-        else:
-            delivery_time = commitment.get('CommitmentName', False)
+        connection = ExpressMailServiceCommitment(url, user_id, password, transport, records=True)
+        response = connection.execute([data])[0]
+        if isinstance(response, USPSXMLError):
+            raise response
+        delivery_time = _delivery_time(response)
         
     else:    
-        if classid in CLASSID_TO_SERVICE['Package']:
-            connection = PackageServicesServiceStandards(url, user_id, password)
-        elif classid in CLASSID_TO_SERVICE['Priority']:
-            connection = PackageServicesServiceStandards(url, user_id, password)
-
-        if connection:            
+        service_class = _domestic_service(classid)
+        if service_class:            
             package_data.pop('Date', None)
-            response = connection.execute([package_data])[0]
-            delivery_time = '%s Days' % response.get('Days')
+            days = _matrix_days(matrices, service_class, package_data)
+            if days is None:
+                connection = service_class(url, user_id, password, transport, records=True)
+                response = connection.execute([package_data])[0]
+                if isinstance(response, USPSXMLError):
+                    raise response
+                _matrix_add(matrices, service_class, package_data, response)
+                days = response.days
+            delivery_time = '%s Days' % days
         else:
             delivery_time = False
             
     return delivery_time
+
+
+BULK_FIELDS = ('OriginZip', 'DestinationZip', 'CLASSID', 'Date')
+
+def get_bulk_service_standards(packages, url, user_id, password, transport=None, concurrency=8,
+                               matrices=None):
+    """
+    Service standard estimates for many packages at once
+    
+    Packages are collapsed to the unique requests the estimates actually
+    depend on, the 3-digit origin and destination ZIP prefixes for domestic
+    standards and the full ZIP codes and date for Express Mail commitments,
+    and each unique request is sent once. Requests of every service share
+    one pool of concurrency workers.
+    
+    @param packages: an iterable of dictionaries as taken by get_service_standards
+        or of (OriginZip, DestinationZip, CLASSID[, Date]) tuples
+    @param: url a URL to send api calls to
+    @param: user_id a valid USPS user id
+    @param: transport an optional transport shared between calls
+    @param concurrency: how many requests may be in flight at once
+    @param matrices: an optional dictionary of SERVICE_NAME to usps.standardsmatrix.StandardsMatrix,
+        domestic standards found there are answered without a request
+    @return: a list with the estimate for every package, in order, as a string or False
+    """
+    keys = list()
+    unique = dict()
+    estimates = dict()
+    connections = dict()
+    for package_data in packages:
+        if not isinstance(package_data, dict):
+            package_data = dict(zip(BULK_FIELDS, package_data))
+        request = _standards_request(package_data)
+        if request is None:
+            keys.append(None)
+            continue
+        service_class, data = request
+        key = (service_class, tuple(sorted(data.items())))
+        keys.append(key)
+        if key in estimates:
+            continue
+        days = _matrix_days(matrices, service_class, data)
+        if days is not None:
+            estimates[key] = '%s Days' % days
+        elif key not in unique:
+            unique[key] = data
+            if service_class not in connections:
+                connections[service_class] = service_class(url, user_id, password, transport, records=True)
+    
+    def fetch(key):
+        return connections[key[0]].execute([unique[key]])[0]
     
+    requests = unique.keys()
+    for index, success, response in threaded_imap(fetch, requests, max(concurrency, 1)):
+        if not success:
+            raise response
+        key = requests[index]
+        _matrix_add(matrices, key[0], unique[key], response)
+        estimates[key] = _delivery_time(response)
+    return [estimates.get(package_key, False) for package_key in keys]
@@ -2,11 +2,15 @@
 Track and Confirm class
 """
 from usps.api.base import USPSService
+from usps.records import TrackInfo
 
 try:
-    from xml.etree import ElementTree as ET
+    from xml.etree import cElementTree as ET
 except ImportError:
-    from elementtree import ElementTree as ET
+    try:
+        from xml.etree import ElementTree as ET
+    except ImportError:
+        from elementtree import ElementTree as ET
 
 class TrackConfirm(USPSService):
     """
@@ -15,6 +19,15 @@ class TrackConfirm(USPSService):
     SERVICE_NAME = 'Track'
     CHILD_XML_NAME = 'TrackID'
     API = 'TrackV2'
+    MAX_ITEMS = 10
+    CACHE_TTL = 15 * 60 #tracking changes through the day
+    RECORD_CLASS = TrackInfo
+    
+    def item_id(self, index, data_dict):
+        return str(data_dict.get('ID'))
+    
+    def cache_key(self, data_dict):
+        return (self.API, self.records, self.item_id(None, data_dict).strip().upper())
     
     def make_xml(self, data, user_id, password):
           
@@ -0,0 +1,269 @@
+"""
+Validate large address files through AddressValidate
+
+Rows are streamed from a CSV or JSON lines file, packed MAX_ITEMS to a
+request, validated by a pool of concurrent requests and written out in
+input order with the USPS answer added to every row. Progress is
+checkpointed next to the output so an interrupted run started again with
+the same arguments carries on from the last checkpoint. A request that
+fails outright, rather than with USPS rejecting an address, stops the run
+at its last checkpoint so the rows are retried when the run is resumed.
+
+    python -m usps.bulkvalidate --userid ID [--map Address2=street,Zip5=zip]
+        [--concurrency 8] [--cache responses.db] input.csv output.csv
+"""
+import csv
+import itertools
+import json
+import optparse
+import os
+import sys
+import time
+
+from usps.api import USPS_CONNECTION
+from usps.api.addressinformation import AddressValidate
+from usps.cache import SQLiteCache
+from usps.errors import USPSXMLError
+from usps.utils import atomic_write
+
+RESULT_FIELDS = AddressValidate.PARAMETERS + ['ReturnText']
+RESULT_PREFIX = 'usps_'
+ERROR_FIELD = 'usps_error'
+
+
+def column_map(text, columns=None):
+    """
+    @param text: comma separated PARAMETER=column pairs
+    @param columns: the input columns, used to map columns named like a PARAMETER
+    @return: a dictionary of AddressValidate parameter to input column
+    """
+    mapping = dict()
+    if columns:
+        names = dict((column.lower(), column) for column in columns)
+        for parameter in AddressValidate.PARAMETERS:
+            if parameter.lower() in names:
+                mapping[parameter] = names[parameter.lower()]
+    for pair in (text or '').split(','):
+        if pair.strip():
+            parameter, column = pair.split('=', 1)
+            if parameter.strip() not in AddressValidate.PARAMETERS:
+                raise ValueError('%s is not an AddressValidate parameter' % parameter.strip())
+            mapping[parameter.strip()] = column.strip()
+    return mapping
+
+
+def to_unicode(value):
+    if value is None or isinstance(value, unicode):
+        return value
+    return str(value).decode('utf8')
+
+
+def to_utf8(value):
+    if isinstance(value, unicode):
+        return value.encode('utf8')
+    return value
+
+
+def is_rejection(result):
+    """
+    @return: True if result is USPS rejecting a single address, as opposed to
+        a request that failed as a whole and should be retried
+    """
+    return isinstance(result, USPSXMLError) and result.item_id is not None
+
+
+def describe(result):
+    """
+    @param result: a response item or the USPSXMLError USPS rejected the address with
+    @return: the result fields of a response item and its error description, if any
+    """
+    if isinstance(result, USPSXMLError):
+        return dict(), unicode(result) or type(result).__name__
+    return dict((field, result.get(field)) for field in RESULT_FIELDS), None
+
+
+class Checkpoint(object):
+    """
+    The rows and output bytes written so far, kept in a small JSON file
+    """
+    def __init__(self, path):
+        self.path = path
+        self.rows = 0
+        self.size = 0
+        if os.path.exists(path):
+            fileobj = open(path, 'rb')
+            try:
+                state = json.load(fileobj)
+            finally:
+                fileobj.close()
+            self.rows = state['rows']
+            self.size = state['size']
+
+    def save(self, rows, size):
+        self.rows = rows
+        self.size = size
+        atomic_write(self.path, lambda fileobj: json.dump({'rows': rows, 'size': size}, fileobj))
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class CSVFormat(object):
+    def __init__(self, infile):
+        self.reader = csv.DictReader(infile)
+        self.columns = self.reader.fieldnames or []
+
+    def rows(self):
+        return self.reader
+
+    def writer(self, outfile, fresh):
+        fields = self.columns + [RESULT_PREFIX + field for field in RESULT_FIELDS] + [ERROR_FIELD]
+        writer = csv.DictWriter(outfile, fields, extrasaction='ignore')
+        if fresh:
+            writer.writerow(dict((field, field) for field in fields))
+
+        def write(row, result, error):
+            row = dict(row)
+            for field, value in result.items():
+                row[RESULT_PREFIX + field] = to_utf8(value)
+            row[ERROR_FIELD] = to_utf8(error)
+            writer.writerow(row)
+        return write
+
+
+class JSONLinesFormat(object):
+    def __init__(self, infile):
+        self.infile = infile
+        self.first = None
+        line = infile.readline()
+        if line.strip():
+            self.first = json.loads(line)
+        self.columns = self.first and self.first.keys() or []
+
+    def rows(self):
+        if self.first is not None:
+            yield self.first
+        for line in self.infile:
+            if line.strip():
+                yield json.loads(line)
+
+    def writer(self, outfile, fresh):
+        def write(row, result, error):
+            row = dict(row)
+            if error is None:
+                row['usps'] = result
+            else:
+                row[ERROR_FIELD] = error
+            outfile.write(json.dumps(row) + '\n')
+        return write
+
+
+def validate_file(service, input_path, output_path, mapping=None, checkpoint_every=1000,
+                  progress=None, input_format=None, buffer_rows=10000):
+    """
+    Validate every row of input_path and write them with their results to output_path
+
+    Transport errors, timeouts and errors USPS answers a whole request with
+    are raised after checkpointing the rows written before the failed one,
+    run validate_file again to resume.
+
+    @param service: the AddressValidate instance used, its concurrency sets the worker pool size
+    @param mapping: a column_map of explicit PARAMETER=column pairs, columns named like
+        one of AddressValidate.PARAMETERS are mapped to it unless mapping says otherwise
+    @param checkpoint_every: rows written between checkpoints
+    @param progress: an optional function called with (rows done, seconds elapsed) at every checkpoint
+    @param input_format: 'csv' or 'jsonl', guessed from the file name by default
+    @param buffer_rows: the most rows read ahead of the oldest unwritten one
+    @return: (rows validated in this run, seconds elapsed)
+    """
+    if input_format is None:
+        input_format = input_path.lower().endswith(('.jsonl', '.json')) and 'jsonl' or 'csv'
+    format_class = input_format == 'jsonl' and JSONLinesFormat or CSVFormat
+    checkpoint = Checkpoint(output_path + '.checkpoint')
+    fresh = checkpoint.rows == 0 and not checkpoint.size
+
+    infile = open(input_path, 'rb')
+    outfile = open(output_path, fresh and 'wb' or 'r+b')
+    started = time.time()
+    try:
+        source = format_class(infile)
+        explicit = mapping or dict()
+        mapping = column_map(None, source.columns)
+        mapping.update(explicit)
+        if not fresh:
+            #drop whatever was written after the last checkpoint
+            outfile.truncate(checkpoint.size)
+            outfile.seek(checkpoint.size)
+        write = source.writer(outfile, fresh)
+        skipped = checkpoint.rows
+        source_rows = itertools.islice(source.rows(), skipped, None)
+        done = 0
+
+        def save():
+            outfile.flush()
+            os.fsync(outfile.fileno())
+            checkpoint.save(skipped + done, outfile.tell())
+
+        while True:
+            #input is read buffer_rows at a time so a stalled request cannot grow the buffers below
+            rows = list(itertools.islice(source_rows, buffer_rows))
+            if not rows:
+                break
+            data = [dict((parameter, to_unicode(row.get(column) or u''))
+                         for parameter, column in mapping.items()) for row in rows]
+            #results arrive in completion order and wait here until every earlier row is written
+            results = dict()
+            written = 0
+            for index, result in service.execute_iter(data):
+                if isinstance(result, Exception) and not is_rejection(result):
+                    save()
+                    raise result
+                results[index] = result
+                while written in results:
+                    result, error = describe(results.pop(written))
+                    write(rows[written], result, error)
+                    written += 1
+                    done += 1
+                    if done % checkpoint_every == 0:
+                        save()
+                        if progress is not None:
+                            progress(done, time.time() - started)
+        outfile.flush()
+    finally:
+        infile.close()
+        outfile.close()
+    checkpoint.remove()
+    return done, time.time() - started
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options] INPUT OUTPUT')
+    parser.add_option('--userid')
+    parser.add_option('--password', default='')
+    parser.add_option('--url', default=USPS_CONNECTION)
+    parser.add_option('--map', default='', help='PARAMETER=column pairs, like Address2=street,Zip5=zip')
+    parser.add_option('--format', choices=['csv', 'jsonl'], help='guessed from the input file name by default')
+    parser.add_option('--concurrency', type='int', default=8)
+    parser.add_option('--cache', help='a SQLite response cache shared with other runs')
+    parser.add_option('--checkpoint-every', type='int', default=1000)
+    options, args = parser.parse_args(argv)
+    if len(args) != 2:
+        parser.error('INPUT and OUTPUT are required')
+    if not options.userid:
+        parser.error('--userid is required')
+
+    cache = options.cache and SQLiteCache(options.cache) or None
+    service = AddressValidate(options.url, options.userid, options.password,
+                              concurrency=options.concurrency, cache=cache)
+
+    def progress(rows, elapsed):
+        sys.stderr.write('%d rows, %.1f rows/s\n' % (rows, rows / max(elapsed, 1e-6)))
+
+    rows, elapsed = validate_file(service, args[0], args[1], column_map(options.map),
+                                  options.checkpoint_every, progress, options.format)
+    sys.stderr.write('validated %d rows in %.1fs, %.1f rows/s\n' % (rows, elapsed, rows / max(elapsed, 1e-6)))
+
+
+if __name__ == '__main__':
+    main()
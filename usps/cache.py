@@ -0,0 +1,311 @@
+"""
+Response caches for USPS service wrappers
+"""
+import cPickle
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+from usps.utils import atomic_write
+
+
+def canonical_key(key):
+    """
+    @param key: a cache key built from tuples, lists, dicts, sets, strings and numbers
+    @return: the same byte string for every key comparing equal to key
+    """
+    return json.dumps(_canonical(key), separators=(',', ':'))
+
+
+def _canonical(value):
+    if isinstance(value, str):
+        return value.decode('utf8')
+    if isinstance(value, (tuple, list)):
+        return [_canonical(item) for item in value]
+    if isinstance(value, dict):
+        return sorted([_canonical(item) for item in value.items()], key=canonical_key)
+    if isinstance(value, (set, frozenset)):
+        return sorted([_canonical(item) for item in value], key=canonical_key)
+    return value
+
+
+class LRUCache(object):
+    """
+    Thread-safe in-memory cache bounded by size with per-entry expiry
+    """
+    def __init__(self, maxsize=1024, ttl=3600, path=None):
+        """
+        @param maxsize: the most entries kept, the least recently used go first
+        @param ttl: the default number of seconds an entry stays valid
+        @param path: an optional file the entries are loaded from and saved to
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.path = path
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def get(self, key):
+        """
+        @return: the cached value for key or None if it is missing or expired
+        """
+        self._lock.acquire()
+        try:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires = entry
+            if expires < time.time():
+                self.expirations += 1
+                self.misses += 1
+                return None
+            #reinserting moves the entry to the most recently used end
+            self._data[key] = entry
+            self.hits += 1
+            return value
+        finally:
+            self._lock.release()
+
+    def set(self, key, value, ttl=None):
+        """
+        Store value under key
+        @param ttl: seconds the entry stays valid, the cache default when omitted
+        """
+        if ttl is None:
+            ttl = self.ttl
+        self._lock.acquire()
+        try:
+            self._data.pop(key, None)
+            self._data[key] = (value, time.time() + ttl)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._data.clear()
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._data)
+
+    def load(self):
+        """
+        Add the unexpired entries saved to path, least recently used first
+        """
+        fileobj = open(self.path, 'rb')
+        try:
+            entries = cPickle.load(fileobj)
+        finally:
+            fileobj.close()
+        now = time.time()
+        self._lock.acquire()
+        try:
+            for key, entry in entries:
+                if entry[1] >= now and key not in self._data:
+                    self._data[key] = entry
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        finally:
+            self._lock.release()
+
+    def save(self):
+        """
+        Atomically write the unexpired entries to path
+        """
+        now = time.time()
+        self._lock.acquire()
+        try:
+            entries = [(key, entry) for key, entry in self._data.iteritems() if entry[1] >= now]
+        finally:
+            self._lock.release()
+        atomic_write(self.path, lambda fileobj: cPickle.dump(entries, fileobj, 2))
+
+    def stats(self):
+        """
+        @return: a dictionary of cache counters
+        """
+        lookups = self.hits + self.misses
+        return {'size': len(self._data),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'hit_ratio': lookups and float(self.hits) / lookups or 0.0,
+                }
+
+
+class SQLiteCache(object):
+    """
+    Cache kept in a SQLite database in WAL mode, shared by every thread and
+    process opening the same file
+
+    Values are pickled and compressed. Entries are evicted oldest first once
+    the cache holds more than maxsize of them, an entry's age is refreshed
+    when it is read, at most once a minute to keep reads from writing.
+    """
+    #how many writes go by between checks of the size bound
+    EVICT_EVERY = 64
+    TOUCH_AFTER = 60
+
+    def __init__(self, path, maxsize=100000, ttl=3600, timeout=30):
+        """
+        @param path: the database file, created when missing
+        @param maxsize: the most entries kept
+        @param ttl: the default number of seconds an entry stays valid
+        @param timeout: seconds to wait for another process' write lock
+        """
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timeout = timeout
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._connection()
+
+    def _connection(self):
+        """
+        @return: the connection of the current thread, connections are not
+            shared between threads or carried over a fork
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None and self._local.pid == os.getpid():
+            return connection
+        connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+        connection.text_factory = str
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.execute('CREATE TABLE IF NOT EXISTS entries '
+                           '(key BLOB PRIMARY KEY, value BLOB, expires REAL, accessed REAL)')
+        connection.execute('CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)')
+        self._local.connection = connection
+        self._local.pid = os.getpid()
+        return connection
+
+    def _key(self, key):
+        #pickles of equal keys can differ, so the digest is taken of a canonical encoding
+        return sqlite3.Binary(hashlib.sha1(canonical_key(key)).digest())
+
+    def _count(self, name):
+        self._lock.acquire()
+        try:
+            setattr(self, name, getattr(self, name) + 1)
+        finally:
+            self._lock.release()
+
+    def get(self, key):
+        """
+        @return: the cached value for key or None if it is missing or expired
+        """
+        connection = self._connection()
+        digest = self._key(key)
+        row = connection.execute('SELECT value, expires, accessed FROM entries WHERE key = ?',
+                                 (digest,)).fetchone()
+        if row is None:
+            self._count('misses')
+            return None
+        value, expires, accessed = row
+        now = time.time()
+        if expires < now:
+            self._count('expirations')
+            self._count('misses')
+            return None
+        if accessed + self.TOUCH_AFTER < now:
+            connection.execute('UPDATE entries SET accessed = ? WHERE key = ?', (now, digest))
+        self._count('hits')
+        return cPickle.loads(zlib.decompress(str(value)))
+
+    def set(self, key, value, ttl=None):
+        """
+        Store value under key
+        @param ttl: seconds the entry stays valid, the cache default when omitted
+        """
+        if ttl is None:
+            ttl = self.ttl
+        now = time.time()
+        value = sqlite3.Binary(zlib.compress(cPickle.dumps(value, 2)))
+        connection = self._connection()
+        connection.execute('INSERT OR REPLACE INTO entries (key, value, expires, accessed) VALUES (?, ?, ?, ?)',
+                           (self._key(key), value, now + ttl, now))
+        self._lock.acquire()
+        try:
+            self._writes += 1
+            evict = self._writes % self.EVICT_EVERY == 0
+        finally:
+            self._lock.release()
+        if evict:
+            self.evict()
+
+    def evict(self):
+        """
+        Drop expired entries and the oldest entries above maxsize
+        """
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            expired = connection.execute('DELETE FROM entries WHERE expires < ?', (time.time(),)).rowcount
+            excess = connection.execute('SELECT COUNT(*) FROM entries').fetchone()[0] - self.maxsize
+            if excess > 0:
+                connection.execute('DELETE FROM entries WHERE key IN '
+                                   '(SELECT key FROM entries ORDER BY accessed LIMIT ?)', (excess,))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        self._lock.acquire()
+        try:
+            self.expirations += max(expired, 0)
+            self.evictions += max(excess, 0)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._connection().execute('DELETE FROM entries')
+
+    def close(self):
+        """
+        Close the connection of the current thread
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+    def __len__(self):
+        return self._connection().execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+
+    def stats(self):
+        """
+        @return: a dictionary of cache counters, the counters are kept per process
+        """
+        lookups = self.hits + self.misses
+        return {'size': len(self),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'hit_ratio': lookups and float(self.hits) / lookups or 0.0,
+                }
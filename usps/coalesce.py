@@ -0,0 +1,88 @@
+"""
+Single-flight coalescing of identical in-flight requests
+"""
+import threading
+
+
+class Call(object):
+    """
+    A request item in flight, every caller asking for it waits on the same Call
+    """
+    def __init__(self):
+        self._event = threading.Event()
+        self.result = None
+        self.error = None
+
+    def finish(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self._event.set()
+
+    def wait(self):
+        """
+        Block until the leader has finished the call
+        @return: the result, re-raising the leader's exception if it failed
+        """
+        self._event.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class SingleFlight(object):
+    """
+    Tracks in-flight request items by key so that only the first caller
+    asking for an item sends it and later callers share its result
+
+    One instance may be shared by any number of service instances.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = dict()
+        self.leaders = 0
+        self.collapsed = 0
+
+    def join(self, keys):
+        """
+        @param keys: the keys of the items a caller needs
+        @return: (calls, owned) where calls holds the Call for every key and
+            owned maps the keys this caller must fetch to their first position
+        """
+        calls = list()
+        owned = dict()
+        self._lock.acquire()
+        try:
+            for index, key in enumerate(keys):
+                call = self._calls.get(key)
+                if call is None:
+                    call = self._calls[key] = Call()
+                    owned[key] = index
+                    self.leaders += 1
+                else:
+                    self.collapsed += 1
+                calls.append(call)
+        finally:
+            self._lock.release()
+        return calls, owned
+
+    def finish(self, key, result=None, error=None):
+        """
+        Publish the result of an owned key to every caller waiting on it
+        """
+        self._lock.acquire()
+        try:
+            call = self._calls.pop(key)
+        finally:
+            self._lock.release()
+        call.finish(result, error)
+
+    def stats(self):
+        """
+        @return: a dictionary of coalescing counters
+        """
+        requested = self.leaders + self.collapsed
+        return {'in_flight': len(self._calls),
+                'sent': self.leaders,
+                'collapsed': self.collapsed,
+                'collapse_ratio': requested and float(self.collapsed) / requested or 0.0,
+                }
@@ -4,6 +4,27 @@ Global errors module for USPS app
 from usps.utils import xmltodict
 
 class USPSXMLError(Exception):
-    def __init__(self, element):
+    def __init__(self, element, item_id=None):
+        """
+        @param element: the Error element USPS returned
+        @param item_id: the ID of the item the error belongs to, None for request level errors
+        """
         self.info = xmltodict(element)
-        super(USPSXMLError, self).__init__(self.info['Description'])
\ No newline at end of file
+        self.item_id = item_id
+        super(USPSXMLError, self).__init__(self.info['Description'])
+    
+    def for_item(self, item_id):
+        """
+        @return: a copy of the error belonging to the item with ID item_id,
+            errors may be shared between callers so they are not changed in place
+        """
+        error = Exception.__new__(type(self), *self.args)
+        error.__dict__.update(self.__dict__)
+        error.item_id = item_id
+        return error
+
+class USPSTimeoutError(Exception):
+    pass
+
+class USPSTransportError(Exception):
+    pass
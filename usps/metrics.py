@@ -0,0 +1,188 @@
+"""
+Request metrics for USPS service wrappers
+
+Once enabled, every request a service sends records how long each phase
+took, per service (the API name):
+
+    serialize   building the request XML
+    network     sending the request until USPS starts answering
+    parse       reading and parsing the response, including convert
+    convert     turning response items into dictionaries or records
+
+along with request and item counts, request and response bytes and errors
+by USPS error number or exception type. The registry renders everything in
+the Prometheus text exposition format.
+
+Metrics are off by default and cost a single attribute lookup per phase
+while off.
+"""
+import bisect
+import threading
+import time
+
+#the registry services record into, None while metrics are disabled
+registry = None
+
+clock = time.time
+
+
+class Histogram(object):
+    """
+    Cumulative bucket counts, sum and count of observed values
+    """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """
+        @return: (upper bound, observations at or below it) pairs ending with +Inf
+        """
+        total = 0
+        ret = list()
+        for bound, count in zip(list(self.buckets) + ['+Inf'], self.counts):
+            total += count
+            ret.append((bound, total))
+        return ret
+
+
+class Registry(object):
+    """
+    Thread-safe in-memory store of latency histograms and counters
+    """
+    BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+               0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets=None):
+        self.buckets = tuple(buckets or self.BUCKETS)
+        self._lock = threading.Lock()
+        self.histograms = dict()
+        self.counters = dict()
+
+    def observe(self, service, phase, seconds):
+        """
+        Record how long a phase of a request to service took
+        """
+        self._lock.acquire()
+        try:
+            histogram = self.histograms.get((service, phase))
+            if histogram is None:
+                histogram = self.histograms[(service, phase)] = Histogram(self.buckets)
+            histogram.observe(seconds)
+        finally:
+            self._lock.release()
+
+    def count(self, name, service, value=1, code=None):
+        """
+        Add value to a counter
+        @param name: requests, items, request_bytes, response_bytes or errors
+        @param code: the error number or type, for errors
+        """
+        key = (name, service, code)
+        self._lock.acquire()
+        try:
+            self.counters[key] = self.counters.get(key, 0) + value
+        finally:
+            self._lock.release()
+
+    def error(self, service, error):
+        """
+        Count an error raised while talking to service
+        """
+        info = getattr(error, 'info', None)
+        if isinstance(info, dict) and info.get('Number'):
+            code = info['Number']
+        else:
+            code = type(error).__name__
+            if getattr(error, 'code', None) is not None:
+                code = '%s %s' % (code, error.code)
+        self.count('errors', service, code=code)
+
+    def get(self, name, service, code=None):
+        """
+        @return: the value of a counter
+        """
+        return self.counters.get((name, service, code), 0)
+
+    def histogram(self, service, phase):
+        """
+        @return: the Histogram of a phase or None if it was never observed
+        """
+        return self.histograms.get((service, phase))
+
+    def expose(self):
+        """
+        @return: every metric in the Prometheus text exposition format
+        """
+        self._lock.acquire()
+        try:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+        finally:
+            self._lock.release()
+        lines = ['# HELP usps_phase_seconds Time spent in each phase of a USPS request',
+                 '# TYPE usps_phase_seconds histogram']
+        for (service, phase), histogram in histograms:
+            labels = 'service="%s",phase="%s"' % (_escape(service), _escape(phase))
+            for bound, total in histogram.cumulative():
+                lines.append('usps_phase_seconds_bucket{%s,le="%s"} %d' % (labels, bound, total))
+            lines.append('usps_phase_seconds_sum{%s} %r' % (labels, histogram.sum))
+            lines.append('usps_phase_seconds_count{%s} %d' % (labels, histogram.count))
+        current = None
+        for (name, service, code), value in counters:
+            if name != current:
+                lines.append('# TYPE usps_%s_total counter' % name)
+                current = name
+            labels = 'service="%s"' % _escape(service)
+            if code is not None:
+                labels += ',code="%s"' % _escape(code)
+            lines.append('usps_%s_total{%s} %d' % (name, labels, value))
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class CountingResponse(object):
+    """
+    File-like wrapper counting the bytes read from a response
+    """
+    def __init__(self, response):
+        self.response = response
+        self.bytes = 0
+
+    def read(self, amt=None):
+        if amt is None:
+            data = self.response.read()
+        else:
+            data = self.response.read(amt)
+        self.bytes += len(data)
+        return data
+
+    def close(self):
+        self.response.close()
+
+
+def enable(new_registry=None):
+    """
+    Start recording metrics for every service in the process
+    @return: the registry recorded into
+    """
+    global registry
+    if new_registry is None:
+        new_registry = Registry()
+    registry = new_registry
+    return registry
+
+
+def disable():
+    global registry
+    registry = None
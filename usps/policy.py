@@ -0,0 +1,246 @@
+"""
+Timeouts, retries and hedging for requests to USPS
+
+A RequestPolicy decides how a service sends each request: it can bound
+the time a request may take, retry transport failures after a jittered
+exponential backoff and hedge slow requests by sending a second copy
+once the first has been outstanding longer than the observed 95th
+percentile, taking whichever answer arrives first.
+
+Hedging sends requests twice, so it only suits idempotent lookups. All
+the APIs wrapped by this package are lookups.
+"""
+import collections
+import httplib
+import random
+import socket
+import StringIO
+import sys
+import threading
+import time
+import urllib2
+
+from usps.errors import USPSTimeoutError
+
+
+def is_retryable(error):
+    """
+    @return: True if a request failing with error may succeed when sent again
+    """
+    if isinstance(error, urllib2.HTTPError):
+        return error.code >= 500 or error.code == 429
+    return isinstance(error, (urllib2.URLError, socket.error, httplib.HTTPException, USPSTimeoutError))
+
+
+class Attempt(object):
+    """
+    One copy of a request running in its own thread
+    """
+    def __init__(self, transport, url, body, finished):
+        self.transport = transport
+        self.url = url
+        self.body = body
+        self.finished = finished
+        self.content = None
+        self.error = None
+        self.latency = None
+        self.abandoned = False
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def run(self):
+        started = time.time()
+        try:
+            response = self.transport.post(self.url, self.body)
+            try:
+                self.content = response.read()
+            finally:
+                response.close()
+        except Exception:
+            self.error = sys.exc_info()[1]
+        self.latency = time.time() - started
+        self.finished(self)
+
+
+class TimedResponse(object):
+    """
+    File-like wrapper observing the latency of a request when its response is closed
+    """
+    def __init__(self, response, policy, started):
+        self.response = response
+        self.policy = policy
+        self.started = started
+        self.closed = False
+
+    def read(self, amt=None):
+        if amt is None:
+            return self.response.read()
+        return self.response.read(amt)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.policy._observe(time.time() - self.started)
+        self.response.close()
+
+
+class RequestPolicy(object):
+    """
+    How requests are timed out, retried and hedged, shareable between services
+    """
+    def __init__(self, timeout=None, retries=0, backoff=0.1, max_backoff=2.0, hedge=False,
+                 hedge_percentile=0.95, hedge_after=None, min_samples=20, window=200):
+        """
+        @param timeout: seconds a request may take, including hedges but not retries,
+            a copy still running then is left to finish in the background
+        @param retries: how many times a request failing with a transport error is sent again
+        @param backoff: the base of the exponential backoff between retries in seconds
+        @param max_backoff: the longest backoff in seconds
+        @param hedge: send a second copy of requests slower than hedge_percentile
+        @param hedge_percentile: the latency percentile after which a request is hedged
+        @param hedge_after: a fixed hedging delay in seconds instead of the percentile
+        @param min_samples: latencies observed before hedging by percentile starts
+        @param window: how many recent latencies the percentile is taken over
+        """
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_after = hedge_after
+        self.min_samples = min_samples
+        self._latencies = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.retried = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.timeouts = 0
+
+    def hedge_delay(self):
+        """
+        @return: seconds after which a request is hedged or None if it should not be
+        """
+        if not self.hedge:
+            return None
+        if self.hedge_after is not None:
+            return self.hedge_after
+        latencies = sorted(self._latencies)
+        if len(latencies) < self.min_samples:
+            return None
+        return latencies[min(len(latencies) - 1, int(self.hedge_percentile * len(latencies)))]
+
+    def post(self, transport, url, body):
+        """
+        Send a request under the policy
+        @return: a file-like response
+        """
+        self._count('requests')
+        attempt = 0
+        while True:
+            try:
+                return self.send(transport, url, body)
+            except Exception:
+                error = sys.exc_info()
+                if attempt >= self.retries or not is_retryable(error[1]):
+                    raise error[0], error[1], error[2]
+            #full jitter keeps clients that failed together from retrying together
+            time.sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt)))
+            attempt += 1
+            self._count('retried')
+
+    def send(self, transport, url, body):
+        """
+        Send a request once, hedged and timed out as configured
+        """
+        delay = self.hedge_delay()
+        if delay is None and self.timeout is None:
+            #streamed, the latency is observed once the body is read and closed like an Attempt's
+            return TimedResponse(transport.post(url, body), self, time.time())
+
+        condition = threading.Condition(threading.Lock())
+        done = list()
+
+        def finished(attempt):
+            condition.acquire()
+            try:
+                done.append(attempt)
+                if attempt.abandoned:
+                    return
+                condition.notify_all()
+            finally:
+                condition.release()
+
+        started = time.time()
+        deadline = self.timeout is not None and started + self.timeout or None
+        attempts = [Attempt(transport, url, body, finished)]
+        condition.acquire()
+        try:
+            while True:
+                winner = self._first_success(done)
+                #a copy failing before it was hedged is left to the retries
+                if winner is not None or len(done) == len(attempts):
+                    break
+                now = time.time()
+                waits = list()
+                if deadline is not None:
+                    waits.append(deadline - now)
+                if delay is not None and len(attempts) == 1:
+                    hedge_at = started + delay
+                    if hedge_at <= now:
+                        attempts.append(Attempt(transport, url, body, finished))
+                        self._count('hedged')
+                        continue
+                    waits.append(hedge_at - now)
+                if waits and min(waits) <= 0:
+                    break
+                condition.wait(waits and min(waits) or None)
+            for attempt in attempts:
+                if attempt not in done:
+                    attempt.abandoned = True
+        finally:
+            condition.release()
+
+        if winner is not None:
+            self._observe(winner.latency)
+            if winner is not attempts[0]:
+                self._count('hedge_wins')
+            return StringIO.StringIO(winner.content)
+        if done:
+            raise done[0].error
+        self._count('timeouts')
+        raise USPSTimeoutError('USPS did not answer within %s seconds' % self.timeout)
+
+    def _first_success(self, done):
+        for attempt in done:
+            if attempt.error is None:
+                return attempt
+        return None
+
+    def _observe(self, latency):
+        self._lock.acquire()
+        try:
+            self._latencies.append(latency)
+        finally:
+            self._lock.release()
+
+    def _count(self, name):
+        self._lock.acquire()
+        try:
+            setattr(self, name, getattr(self, name) + 1)
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """
+        @return: a dictionary of policy counters
+        """
+        return {'requests': self.requests,
+                'retried': self.retried,
+                'hedged': self.hedged,
+                'hedge_wins': self.hedge_wins,
+                'timeouts': self.timeouts,
+                'hedge_delay': self.hedge_delay(),
+                }
@@ -0,0 +1,245 @@
+"""
+Incremental tracking poller built on TrackConfirm
+
+The poller keeps the last known state of every tracking number, asks USPS
+only about the numbers that are due and reports only events it has not
+reported before. How soon a number is due again depends on its latest
+event: out for delivery is polled soon, in transit less often and less
+often still while nothing changes, delivered is never polled again.
+
+The state store is any mapping of tracking number to a small dictionary,
+a dict keeps it in memory and a shelve keeps it between runs.
+"""
+import heapq
+import re
+import threading
+import time
+
+from usps.errors import USPSXMLError
+
+DELIVERED = re.compile(r'\bdelivered\b', re.IGNORECASE)
+#could not be delivered, was not delivered, wasn't delivered, never delivered...
+NOT_DELIVERED = re.compile(r"(?:\bnot|\bnever|n't)\s+(?:\w+\s+)?delivered\b", re.IGNORECASE)
+OUT_FOR_DELIVERY = re.compile(r'\bout for delivery\b', re.IGNORECASE)
+
+
+def event_text(event):
+    """
+    @param event: a usps.records.TrackEvent
+    @return: the event as a single line of text
+    """
+    if event.event is not None and event.event_date is None:
+        return event.event
+    return ' '.join([value for value in (event.event_date, event.event_time, event.event,
+                                         event.event_city, event.event_state, event.event_zip)
+                     if value])
+
+
+def is_delivered(summary):
+    """
+    @param summary: the latest event as text
+    @return: True if the event says the item was delivered
+    """
+    return bool(DELIVERED.search(summary)) and not NOT_DELIVERED.search(summary)
+
+
+class TrackingPoller(object):
+    """
+    Polls tracking numbers that are due and yields their new events
+    """
+    OUT_FOR_DELIVERY_INTERVAL = 60 * 60
+    IN_TRANSIT_INTERVAL = 4 * 60 * 60
+    NOT_FOUND_INTERVAL = 6 * 60 * 60
+    RETRY_INTERVAL = 5 * 60
+    MAX_INTERVAL = 24 * 60 * 60
+
+    def __init__(self, service, store=None):
+        """
+        @param service: a usps.api.tracking.TrackConfirm created with records=True
+        @param store: a mapping of tracking number to state, a new dict by default
+        """
+        if not service.records:
+            raise ValueError('the poller needs a TrackConfirm service created with records=True')
+        self.service = service
+        if store is None:
+            store = dict()
+        self.store = store
+        self._lock = threading.Lock()
+        self._schedule = list()
+        self.polled = 0
+        self.unchanged = 0
+        for tracking_id, state in store.items():
+            if not state['done']:
+                self._schedule.append((state['next_poll'], tracking_id))
+        heapq.heapify(self._schedule)
+
+    def add(self, tracking_ids, now=None):
+        """
+        Start following tracking numbers, numbers already followed are left alone
+        """
+        if now is None:
+            now = time.time()
+        self._lock.acquire()
+        try:
+            for tracking_id in tracking_ids:
+                tracking_id = str(tracking_id).strip().upper()
+                if tracking_id in self.store:
+                    continue
+                self.store[tracking_id] = {'events': 0, 'summary': None, 'interval': 0,
+                                           'next_poll': now, 'done': False}
+                heapq.heappush(self._schedule, (now, tracking_id))
+        finally:
+            self._lock.release()
+
+    def remove(self, tracking_id):
+        """
+        Stop following a tracking number
+        """
+        self._lock.acquire()
+        try:
+            self.store.pop(str(tracking_id).strip().upper(), None)
+        finally:
+            self._lock.release()
+
+    def due(self, now=None, limit=None):
+        """
+        @return: the tracking numbers due by now, at most limit of them, in the order they fell due
+        """
+        if now is None:
+            now = time.time()
+        due = list()
+        self._lock.acquire()
+        try:
+            while self._schedule and self._schedule[0][0] <= now and (limit is None or len(due) < limit):
+                next_poll, tracking_id = heapq.heappop(self._schedule)
+                state = self.store.get(tracking_id)
+                #entries of removed or rescheduled numbers are dropped lazily
+                if state is not None and not state['done'] and state['next_poll'] == next_poll:
+                    due.append(tracking_id)
+        finally:
+            self._lock.release()
+        return due
+
+    def poll(self, now=None, limit=None):
+        """
+        Ask USPS about the tracking numbers that are due
+        @param limit: the most tracking numbers to poll
+        @return: a generator of (tracking number, new events) tuples for the
+            numbers that changed, the newest event first
+        """
+        if now is None:
+            now = time.time()
+        tracking_ids = self.due(now, limit)
+        pending = set(tracking_ids)
+        data = [{'ID': tracking_id} for tracking_id in tracking_ids]
+        try:
+            for index, result in self.service.execute_iter(data):
+                tracking_id = tracking_ids[index]
+                pending.discard(tracking_id)
+                if isinstance(result, USPSXMLError) and result.item_id is not None:
+                    #USPS rejecting the number itself means it knows nothing about it yet
+                    events = None
+                elif isinstance(result, Exception):
+                    #the request failed as a whole, the number keeps its state and is retried soon
+                    self._retry(tracking_id, now)
+                    continue
+                else:
+                    events = self.update(tracking_id, result, now)
+                if events is None:
+                    self.reschedule(tracking_id, None, now)
+                elif events:
+                    yield tracking_id, events
+        finally:
+            #numbers left unanswered when the caller stops early or an error escapes stay due
+            self._restore(pending)
+
+    def _retry(self, tracking_id, now):
+        self._lock.acquire()
+        try:
+            state = self.store.get(tracking_id)
+            if state is None or state['done']:
+                return
+            state = dict(state)
+            state['next_poll'] = now + self.RETRY_INTERVAL
+            self.store[tracking_id] = state
+            heapq.heappush(self._schedule, (state['next_poll'], tracking_id))
+        finally:
+            self._lock.release()
+
+    def _restore(self, tracking_ids):
+        self._lock.acquire()
+        try:
+            for tracking_id in tracking_ids:
+                state = self.store.get(tracking_id)
+                if state is not None and not state['done']:
+                    heapq.heappush(self._schedule, (state['next_poll'], tracking_id))
+        finally:
+            self._lock.release()
+
+    def update(self, tracking_id, info, now):
+        """
+        Compare a response with the stored state and schedule the next poll
+        @param info: the usps.records.TrackInfo returned for tracking_id
+        @return: the new events, an empty list when nothing changed, None if USPS knows nothing yet
+        """
+        self.polled += 1
+        if info.summary is None:
+            return None
+        summary = event_text(info.summary)
+        count = 1 + len(info.details)
+        state = self.store[tracking_id]
+        #USPS only ever adds events, so the count and latest event tell if anything changed
+        if count == state['events'] and summary == state['summary']:
+            self.unchanged += 1
+            self.reschedule(tracking_id, summary, now, changed=False)
+            return []
+        events = [info.summary] + list(info.details)
+        new = max(count - state['events'], 1)
+        self.reschedule(tracking_id, summary, now, changed=True, events=count)
+        return events[:new]
+
+    def reschedule(self, tracking_id, summary, now, changed=False, events=None):
+        """
+        Store the state of a tracking number and work out when it is due next
+        @param summary: the latest event as text or None if it was not found
+        """
+        self._lock.acquire()
+        try:
+            state = self.store.get(tracking_id)
+            if state is None:
+                return
+            state = dict(state)
+            if events is not None:
+                state['events'] = events
+            if summary is None:
+                interval = self.NOT_FOUND_INTERVAL
+            elif is_delivered(summary):
+                state['done'] = True
+                interval = 0
+            elif OUT_FOR_DELIVERY.search(summary):
+                interval = self.OUT_FOR_DELIVERY_INTERVAL
+            elif changed or not state['interval']:
+                interval = self.IN_TRANSIT_INTERVAL
+            else:
+                #back off while a package sits in transit without news
+                interval = min(state['interval'] * 2, self.MAX_INTERVAL)
+            if summary is not None:
+                state['summary'] = summary
+            state['interval'] = interval
+            state['next_poll'] = now + interval
+            #reassign so shelve and other persistent mappings write the change
+            self.store[tracking_id] = state
+            if not state['done']:
+                heapq.heappush(self._schedule, (state['next_poll'], tracking_id))
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """
+        @return: a dictionary of poller counters
+        """
+        return {'following': len(self.store),
+                'polled': self.polled,
+                'unchanged': self.unchanged,
+                'unchanged_ratio': self.polled and float(self.unchanged) / self.polled or 0.0,
+                }
@@ -0,0 +1,151 @@
+"""
+Rate shopping over batches of shipments
+
+The postage quoted for every shipment is flattened into parallel arrays of
+shipment number, rate and delivery days so the best service of every
+shipment is found in a few array operations instead of walking each
+shipment's postage in turn. NumPy is used when it is installed, otherwise
+the same selection runs in pure python.
+"""
+from usps.api.servicestandards import CLASSID_TO_SERVICE
+from usps.errors import USPSXMLError
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def standards_days(matrices):
+    """
+    @param matrices: a dictionary of SERVICE_NAME to usps.standardsmatrix.StandardsMatrix
+    @return: a days function for RateTable answering Priority Mail and
+        Package Services standards from the matrices
+    """
+    services = dict()
+    for class_id in CLASSID_TO_SERVICE['Priority']:
+        services[class_id] = 'PriorityMail'
+    for class_id in CLASSID_TO_SERVICE['Package']:
+        services[class_id] = 'StandardB'
+
+    def days(package, postage):
+        matrix = matrices.get(services.get(postage.class_id))
+        if matrix is None:
+            return None
+        return matrix.get(package.zip_origination, package.zip_destination)
+    return days
+
+
+class RateTable(object):
+    """
+    The postage quoted for a batch of shipments held in array form
+    """
+    def __init__(self, packages, days=None, commercial=False):
+        """
+        @param packages: usps.records.RatePackage records, as returned by a
+            DomesticRateCalculator created with records=True, packages USPS
+            rejected with a USPSXMLError get no service
+        @param days: an optional function of (package, postage) returning the
+            delivery days of a service or None when they are unknown
+        @param commercial: shop by commercial rates where USPS quotes them
+        """
+        self.packages = packages
+        self.postage = list()
+        shipments = list()
+        rates = list()
+        delivery_days = list()
+        for index, package in enumerate(packages):
+            if isinstance(package, USPSXMLError):
+                continue
+            for postage in package.postage:
+                rate = postage.rate
+                if commercial and postage.commercial_rate is not None:
+                    rate = postage.commercial_rate
+                if not isinstance(rate, float):
+                    continue
+                self.postage.append(postage)
+                shipments.append(index)
+                rates.append(rate)
+                if days is not None:
+                    delivery_days.append(days(package, postage))
+                else:
+                    delivery_days.append(None)
+
+        if numpy is not None:
+            self.shipments = numpy.array(shipments, dtype=numpy.int64)
+            self.rates = numpy.array(rates, dtype=numpy.float64)
+            self.days = numpy.array([value is None and numpy.nan or value for value in delivery_days],
+                                    dtype=numpy.float64)
+        else:
+            self.shipments = shipments
+            self.rates = rates
+            self.days = delivery_days
+
+    def __len__(self):
+        return len(self.postage)
+
+    def select(self, max_days=None):
+        """
+        @param max_days: only consider services known to deliver within this many days
+        @return: for every package the position in self.postage of its cheapest
+            acceptable service or -1 when there is none
+        """
+        if numpy is not None:
+            return self._select_arrays(max_days)
+        best = [-1] * len(self.packages)
+        for position, shipment in enumerate(self.shipments):
+            if max_days is not None:
+                days = self.days[position]
+                if days is None or days > max_days:
+                    continue
+            current = best[shipment]
+            if current == -1 or self.rates[position] < self.rates[current]:
+                best[shipment] = position
+        return best
+
+    def _select_arrays(self, max_days):
+        best = numpy.empty(len(self.packages), dtype=numpy.int64)
+        best.fill(-1)
+        candidates = numpy.arange(len(self.postage))
+        if max_days is not None:
+            #nan days compare false so unknown standards are dropped too
+            candidates = candidates[self.days <= max_days]
+        if not len(candidates):
+            return best.tolist()
+        shipments = self.shipments[candidates]
+        #sorted by shipment then rate, the first row of every shipment is its cheapest
+        order = numpy.lexsort((self.rates[candidates], shipments))
+        shipments = shipments[order]
+        first = numpy.ones(len(order), dtype=bool)
+        first[1:] = shipments[1:] != shipments[:-1]
+        best[shipments[first]] = candidates[order][first]
+        return best.tolist()
+
+    def best(self, max_days=None):
+        """
+        @param max_days: only consider services known to deliver within this many days
+        @return: for every package its cheapest acceptable usps.records.Postage or None
+        """
+        return [position != -1 and self.postage[position] or None
+                for position in self.select(max_days)]
+
+
+def shop_rates(service, shipments, max_days=None, days=None, commercial=False):
+    """
+    Quote every service for a batch of shipments and pick the cheapest of each
+
+    @param service: a DomesticRateCalculator created with records=True
+    @param shipments: DomesticRateCalculator data dictionaries, their Service is replaced by ALL
+    @param max_days: only consider services known to deliver within this many days
+    @param days: a function of (package, postage) returning delivery days, see standards_days
+    @param commercial: shop by commercial rates where USPS quotes them
+    @return: for every shipment its cheapest acceptable usps.records.Postage or None
+    """
+    if not service.records:
+        raise ValueError('rate shopping needs a DomesticRateCalculator created with records=True')
+    data = list()
+    for shipment in shipments:
+        shipment = dict(shipment)
+        shipment['Service'] = 'ALL'
+        data.append(shipment)
+    return RateTable(service.execute(data), days, commercial).best(max_days)
@@ -0,0 +1,264 @@
+"""
+Local domestic rate engine
+
+Domestic postage only depends on the requested service and size flags, the
+zone between the origin and destination 3-digit ZIP prefixes and the weight
+bracket. The engine keeps a zone chart as a 1000x1000 byte matrix and, for
+every combination of service and size flags it has seen, one array of rates
+per mail class indexed by zone and weight bracket, so a quote is a handful
+of array reads.
+
+Tables are learned from RateV3 responses or imported, and can be saved to
+and loaded from a file. A DomesticRateCalculator created with a rate_engine
+answers what the engine knows, learns from the rest and sends a sample of
+the answered items to USPS as well to catch rate changes.
+"""
+import array
+import cPickle
+import math
+import random
+import threading
+
+from usps.records import Postage, RatePackage
+from usps.standardsmatrix import parse_prefixes, prefix_number
+from usps.utils import atomic_write
+
+PREFIXES = 1000
+ZONES = 10
+#by the ounce up to a pound, then by the pound up to 70 pounds
+BRACKETS = 16 + 70
+UNKNOWN = -1.0
+NOT_OFFERED = -2.0
+CELLS = ZONES * BRACKETS
+
+TABLE_PARAMETERS = ('Service', 'FirstClassMailType', 'Container', 'Size',
+                    'Width', 'Length', 'Height', 'Girth', 'Machinable')
+
+
+def table_key(data_dict):
+    """
+    @param data_dict: a DomesticRateCalculator data dictionary
+    @return: the key of the price table answering data_dict
+    """
+    return tuple([unicode(data_dict.get(key) or '').strip().upper() for key in TABLE_PARAMETERS])
+
+
+def weight_bracket(pounds, ounces):
+    """
+    @return: the weight bracket of a package or None if the weight is not understood or too heavy
+    """
+    try:
+        weight = float(pounds or 0) * 16 + float(ounces or 0)
+    except (TypeError, ValueError):
+        return None
+    if weight <= 0:
+        return None
+    if weight <= 16:
+        return int(math.ceil(weight)) - 1
+    bracket = 15 + int(math.ceil(weight / 16))
+    if bracket >= BRACKETS:
+        return None
+    return bracket
+
+
+class RateEngine(object):
+    """
+    In-process domestic rate tables learned from or checked against RateV3
+    """
+    def __init__(self, sample_rate=0.01):
+        """
+        @param sample_rate: the fraction of locally answered items a
+            DomesticRateCalculator also sends to USPS to check the tables
+        """
+        self.sample_rate = sample_rate
+        self.zones = bytearray(PREFIXES * PREFIXES)
+        self.tables = dict()
+        self.services = dict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.checked = 0
+        self.mismatches = 0
+
+    def zone(self, origin, destination):
+        """
+        @return: the zone between two ZIP codes or prefixes or None if it is unknown
+        """
+        origin = prefix_number(origin)
+        destination = prefix_number(destination)
+        if origin is None or destination is None:
+            return None
+        return self.zones[origin * PREFIXES + destination] or None
+
+    def set_zone(self, origin, destination, zone):
+        origin = prefix_number(origin)
+        destination = prefix_number(destination)
+        if origin is not None and destination is not None and zone and 0 < zone < ZONES:
+            self.zones[origin * PREFIXES + destination] = zone
+
+    def import_zone_chart(self, rows):
+        """
+        @param rows: (origin, destination, zone) rows, origin and destination
+            may be prefix ranges like "005-098" as printed on USPS zone charts
+        @return: the number of prefix pairs set
+        """
+        count = 0
+        for origin, destination, zone in rows:
+            for origin_prefix in parse_prefixes(str(origin)):
+                for destination_prefix in parse_prefixes(str(destination)):
+                    self.set_zone(origin_prefix, destination_prefix, int(zone))
+                    count += 1
+        return count
+
+    def add_prices(self, data_dict, zone, postage):
+        """
+        Set every rate quoted for one table cell, classes missing from
+        postage are recorded as not offered for the cell
+
+        @param data_dict: the DomesticRateCalculator data the rates were quoted for
+        @param zone: the zone the rates were quoted for
+        @param postage: usps.records.Postage records or (class id, mail service, rate) tuples
+        """
+        bracket = weight_bracket(data_dict.get('Pounds'), data_dict.get('Ounces'))
+        if bracket is None or not zone or not 0 < zone < ZONES:
+            return
+        cell = zone * BRACKETS + bracket
+        rates = dict()
+        for item in postage:
+            if isinstance(item, Postage):
+                item = (item.class_id, item.mail_service, item.rate)
+            class_id, mail_service, rate = item
+            if class_id is None or not isinstance(rate, float):
+                continue
+            rates[class_id] = rate
+            if mail_service is not None:
+                self.services[class_id] = mail_service
+        self._lock.acquire()
+        try:
+            table = self.tables.setdefault(table_key(data_dict), dict())
+            for class_id in rates:
+                if class_id not in table:
+                    table[class_id] = array.array('d', [UNKNOWN]) * CELLS
+            for class_id, column in table.iteritems():
+                column[cell] = rates.get(class_id, NOT_OFFERED)
+        finally:
+            self._lock.release()
+
+    def learn(self, data_dict, package):
+        """
+        Add a RateV3 response to the tables
+        @param data_dict: the data the package was quoted for
+        @param package: the usps.records.RatePackage USPS returned
+        """
+        if package.zone is None:
+            return
+        self.set_zone(data_dict.get('ZipOrigination'), data_dict.get('ZipDestination'), package.zone)
+        self.add_prices(data_dict, package.zone, package.postage)
+
+    def quote(self, data_dict):
+        """
+        @param data_dict: a DomesticRateCalculator data dictionary
+        @return: a usps.records.RatePackage shaped like the RateV3 response
+            or None when the tables cannot answer it
+        """
+        zone = self.zone(data_dict.get('ZipOrigination'), data_dict.get('ZipDestination'))
+        bracket = weight_bracket(data_dict.get('Pounds'), data_dict.get('Ounces'))
+        table = self.tables.get(table_key(data_dict))
+        if zone is None or bracket is None or not table:
+            self.misses += 1
+            return None
+        cell = zone * BRACKETS + bracket
+        postage = list()
+        for class_id in sorted(table):
+            rate = table[class_id][cell]
+            if rate == UNKNOWN:
+                self.misses += 1
+                return None
+            if rate != NOT_OFFERED:
+                postage.append(Postage(class_id=class_id, mail_service=self.services.get(class_id), rate=rate))
+        self.hits += 1
+        return RatePackage(zip_origination=data_dict.get('ZipOrigination'),
+                           zip_destination=data_dict.get('ZipDestination'),
+                           pounds=_float(data_dict.get('Pounds')),
+                           ounces=_float(data_dict.get('Ounces')),
+                           container=data_dict.get('Container'),
+                           size=data_dict.get('Size'),
+                           machinable=data_dict.get('Machinable'),
+                           zone=zone,
+                           postage=postage)
+
+    def sample(self):
+        """
+        @return: True if a locally answered item should be checked against USPS
+        """
+        return random.random() < self.sample_rate
+
+    def check(self, data_dict, quoted, package):
+        """
+        Compare a local quote with the live response, a differing response replaces the table cell
+        @return: True if they agree
+        """
+        self.checked += 1
+        local = sorted((postage.class_id, postage.rate) for postage in quoted.postage)
+        live = sorted((postage.class_id, postage.rate) for postage in package.postage
+                      if isinstance(postage.rate, float))
+        if local == live and quoted.zone == package.zone:
+            return True
+        self.mismatches += 1
+        self.learn(data_dict, package)
+        return False
+
+    def stats(self):
+        """
+        @return: a dictionary of engine counters
+        """
+        quotes = self.hits + self.misses
+        return {'tables': len(self.tables),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': quotes and float(self.hits) / quotes or 0.0,
+                'checked': self.checked,
+                'mismatches': self.mismatches,
+                }
+
+    def save(self, path):
+        """
+        Atomically write the zone chart and price tables to a file
+        """
+        self._lock.acquire()
+        try:
+            state = {'zones': str(self.zones),
+                     'services': dict(self.services),
+                     'tables': dict((key, dict((class_id, column.tostring())
+                                               for class_id, column in table.iteritems()))
+                                    for key, table in self.tables.iteritems())}
+        finally:
+            self._lock.release()
+        atomic_write(path, lambda fileobj: cPickle.dump(state, fileobj, 2))
+
+    @classmethod
+    def load(cls, path, sample_rate=0.01):
+        """
+        @return: an engine holding the tables saved to path
+        """
+        fileobj = open(path, 'rb')
+        try:
+            state = cPickle.load(fileobj)
+        finally:
+            fileobj.close()
+        engine = cls(sample_rate)
+        engine.zones = bytearray(state['zones'])
+        engine.services = state['services']
+        for key, table in state['tables'].iteritems():
+            columns = engine.tables[key] = dict()
+            for class_id, data in table.iteritems():
+                columns[class_id] = array.array('d')
+                columns[class_id].fromstring(data)
+        return engine
+
+
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
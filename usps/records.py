@@ -0,0 +1,242 @@
+"""
+Typed result records built straight from USPS response elements
+
+Records use __slots__, convert numeric fields once at parse time and
+always hold repeated elements in lists, unlike the dictionaries produced
+by xmltodict whose shape depends on how many elements USPS returned.
+"""
+
+
+def _number(convert):
+    def converter(text):
+        if text is None or not text.strip():
+            return None
+        try:
+            return convert(text)
+        except ValueError:
+            return text
+    return converter
+
+integer = _number(int)
+decimal = _number(float)
+
+def text(value):
+    return value
+
+
+class RecordType(type):
+    """
+    Builds __slots__ and the tag lookup table of a Record from its FIELDS
+    """
+    def __new__(mcs, name, bases, attrs):
+        fields = attrs.get('FIELDS', ())
+        attributes = attrs.get('ATTRIBUTES', ())
+        attrs['__slots__'] = tuple([field[0] for field in attributes] +
+                                   [field[0] for field in fields])
+        attrs['_TAGS'] = dict((field[1], field) for field in fields)
+        return type.__new__(mcs, name, bases, attrs)
+
+
+class Record(object):
+    """
+    Base result record
+
+    FIELDS holds (attribute, child tag, converter, repeated) tuples, a
+    converter may be another Record class for nested elements.
+    ATTRIBUTES holds (attribute, xml attribute, converter) tuples.
+    """
+    __metaclass__ = RecordType
+    FIELDS = ()
+    ATTRIBUTES = ()
+
+    def __init__(self, **kwargs):
+        for field in self.ATTRIBUTES:
+            setattr(self, field[0], kwargs.get(field[0]))
+        for attribute, tag, converter, repeated in self.FIELDS:
+            if repeated:
+                setattr(self, attribute, kwargs.get(attribute, list()))
+            else:
+                setattr(self, attribute, kwargs.get(attribute))
+
+    @classmethod
+    def from_element(cls, element):
+        """
+        @param element: a response element
+        @return: a record holding the converted values of element
+        """
+        record = cls()
+        for attribute, name, converter in cls.ATTRIBUTES:
+            value = element.get(name)
+            if value is not None:
+                setattr(record, attribute, converter(value))
+        tags = cls._TAGS
+        for child in element:
+            field = tags.get(child.tag)
+            if field is None:
+                continue
+            attribute, tag, converter, repeated = field
+            if isinstance(converter, RecordType):
+                value = converter.from_element(child)
+            else:
+                value = converter(child.text)
+            if repeated:
+                getattr(record, attribute).append(value)
+            else:
+                setattr(record, attribute, value)
+        return record
+
+    def to_dict(self):
+        """
+        @return: the record as a dictionary keyed by attribute name
+        """
+        ret = dict()
+        for attribute in self.__slots__:
+            value = getattr(self, attribute)
+            if isinstance(value, Record):
+                value = value.to_dict()
+            elif isinstance(value, list):
+                value = [item.to_dict() if isinstance(item, Record) else item for item in value]
+            ret[attribute] = value
+        return ret
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.to_dict() == other.to_dict()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '<%s %s>' % (type(self).__name__, self.to_dict())
+
+
+class Postage(Record):
+    ATTRIBUTES = (('class_id', 'CLASSID', integer),)
+    FIELDS = (('mail_service', 'MailService', text, False),
+              ('rate', 'Rate', decimal, False),
+              ('commercial_rate', 'CommercialRate', decimal, False),
+              )
+
+
+class RatePackage(Record):
+    ATTRIBUTES = (('id', 'ID', text),)
+    FIELDS = (('zip_origination', 'ZipOrigination', text, False),
+              ('zip_destination', 'ZipDestination', text, False),
+              ('pounds', 'Pounds', decimal, False),
+              ('ounces', 'Ounces', decimal, False),
+              ('container', 'Container', text, False),
+              ('size', 'Size', text, False),
+              ('machinable', 'Machinable', text, False),
+              ('zone', 'Zone', integer, False),
+              ('postage', 'Postage', Postage, True),
+              )
+
+
+class IntlService(Record):
+    ATTRIBUTES = (('id', 'ID', integer),)
+    FIELDS = (('pounds', 'Pounds', decimal, False),
+              ('ounces', 'Ounces', decimal, False),
+              ('mail_type', 'MailType', text, False),
+              ('country', 'Country', text, False),
+              ('postage', 'Postage', decimal, False),
+              ('commitments', 'SvcCommitments', text, False),
+              ('description', 'SvcDescription', text, False),
+              ('max_dimensions', 'MaxDimensions', text, False),
+              ('max_weight', 'MaxWeight', decimal, False),
+              )
+
+
+class IntlRatePackage(Record):
+    ATTRIBUTES = (('id', 'ID', text),)
+    FIELDS = (('prohibitions', 'Prohibitions', text, False),
+              ('restrictions', 'Restrictions', text, False),
+              ('observations', 'Observations', text, False),
+              ('customs_forms', 'CustomsForms', text, False),
+              ('express_mail', 'ExpressMail', text, False),
+              ('areas_served', 'AreasServed', text, False),
+              ('services', 'Service', IntlService, True),
+              )
+
+
+class AddressResult(Record):
+    ATTRIBUTES = (('id', 'ID', text),)
+    FIELDS = (('firm_name', 'FirmName', text, False),
+              ('address1', 'Address1', text, False),
+              ('address2', 'Address2', text, False),
+              ('city', 'City', text, False),
+              ('state', 'State', text, False),
+              ('zip5', 'Zip5', text, False),
+              ('zip4', 'Zip4', text, False),
+              ('return_text', 'ReturnText', text, False),
+              )
+
+
+class TrackEvent(Record):
+    """
+    A tracking event, TrackV2 returns events as plain text
+    """
+    FIELDS = (('event_time', 'EventTime', text, False),
+              ('event_date', 'EventDate', text, False),
+              ('event', 'Event', text, False),
+              ('event_city', 'EventCity', text, False),
+              ('event_state', 'EventState', text, False),
+              ('event_zip', 'EventZIPCode', text, False),
+              )
+    ATTRIBUTES = ()
+
+    @classmethod
+    def from_element(cls, element):
+        if len(element):
+            return super(TrackEvent, cls).from_element(element)
+        return cls(event=element.text)
+
+
+class TrackInfo(Record):
+    ATTRIBUTES = (('id', 'ID', text),)
+    FIELDS = (('summary', 'TrackSummary', TrackEvent, False),
+              ('details', 'TrackDetail', TrackEvent, True),
+              )
+
+
+class CommitmentLocation(Record):
+    FIELDS = (('city', 'City', text, False),
+              ('state', 'State', text, False),
+              ('street', 'Street', text, False),
+              ('zip', 'Zip', text, False),
+              ('facility', 'Facility', text, False),
+              ('cutoff', 'CutOff', text, False),
+              )
+
+
+class Commitment(Record):
+    FIELDS = (('name', 'CommitmentName', text, False),
+              ('time', 'CommitmentTime', text, False),
+              ('sequence', 'CommitmentSequence', text, False),
+              ('locations', 'Location', CommitmentLocation, True),
+              )
+
+
+class ServiceStandard(Record):
+    """
+    A Priority Mail, Package Services or Express Mail service standard
+    """
+    FIELDS = (('origin_zip', 'OriginZip', text, False),
+              ('destination_zip', 'DestinationZip', text, False),
+              ('days', 'Days', integer, False),
+              ('origin_city', 'OriginCity', text, False),
+              ('origin_state', 'OriginState', text, False),
+              ('destination_city', 'DestinationCity', text, False),
+              ('destination_state', 'DestinationState', text, False),
+              ('date', 'Date', text, False),
+              ('time', 'Time', text, False),
+              ('commitments', 'Commitment', Commitment, True),
+              )
+
+    @classmethod
+    def from_element(cls, element):
+        record = super(ServiceStandard, cls).from_element(element)
+        #express mail commitments spell their ZIP codes in capitals
+        if record.origin_zip is None:
+            record.origin_zip = element.findtext('OriginZIP')
+        if record.destination_zip is None:
+            record.destination_zip = element.findtext('DestinationZIP')
+        return record
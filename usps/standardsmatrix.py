@@ -0,0 +1,241 @@
+"""
+Precomputed service standards for Priority Mail and Package Services
+
+Domestic service standards only depend on the 3-digit origin and destination
+ZIP prefixes, so a service's standards fit a 1000x1000 matrix of delivery
+days, one byte per cell with 0 for unknown. The matrix file is memory mapped
+on first use and a lookup is a single byte read, the operating system shares
+its pages between processes.
+
+    python -m usps.standardsmatrix --service StandardB --responses DIR matrix.bin
+    python -m usps.standardsmatrix --service PriorityMail --url URL --userid ID
+        [--origins 207,208] [--destinations 000-999] matrix.bin
+"""
+import optparse
+import os
+import struct
+
+from usps.utils import ET, MappedFile, atomic_write
+
+MAGIC = 'USPSSTD1'
+#magic, SERVICE_NAME of the service the standards were fetched from
+HEADER = struct.Struct('<8s24s')
+PREFIXES = 1000
+UNKNOWN = 0
+
+
+def prefix_number(zip_code):
+    """
+    @param zip_code: a ZIP code or 3-digit ZIP prefix
+    @return: the prefix as an integer or None if it does not start with 3 digits
+    """
+    prefix = str(zip_code or '').strip()[:3]
+    if len(prefix) != 3 or not prefix.isdigit():
+        return None
+    return int(prefix)
+
+
+class StandardsMatrix(MappedFile):
+    """
+    Lazily loaded, memory mapped prefix by prefix table of delivery days
+    """
+    def __init__(self, path, service=None):
+        """
+        @param path: the matrix file, it need not exist yet
+        @param service: the SERVICE_NAME the standards come from, read from the file when it exists
+        """
+        super(StandardsMatrix, self).__init__(path)
+        self.service = service
+
+    def _check(self, mapped):
+        magic, service = HEADER.unpack_from(mapped, 0)
+        if magic != MAGIC or len(mapped) != HEADER.size + PREFIXES * PREFIXES:
+            raise ValueError('%s is not a service standards matrix' % self.path)
+        service = service.rstrip('\x00')
+        if self.service is not None and self.service != service:
+            raise ValueError('%s holds %s standards, not %s' % (self.path, service, self.service))
+        self.service = service
+
+    def get(self, origin, destination):
+        """
+        @param origin: the origin ZIP code or prefix
+        @param destination: the destination ZIP code or prefix
+        @return: the delivery days or None if the cell is unknown
+        """
+        origin = prefix_number(origin)
+        destination = prefix_number(destination)
+        if origin is None or destination is None:
+            return None
+        cell = origin * PREFIXES + destination
+        days = self._updates.get(cell)
+        if days is not None:
+            return days
+        if self._map is None:
+            self._load()
+            if self._map is None:
+                return None
+        days = ord(self._map[HEADER.size + cell])
+        if days == UNKNOWN:
+            return None
+        return days
+
+    def add(self, origin, destination, days):
+        """
+        Record the delivery days for a prefix pair, kept in memory until save is called
+        """
+        origin = prefix_number(origin)
+        destination = prefix_number(destination)
+        if origin is None or destination is None or days is None or not 0 < days < 256:
+            return
+        self._updates[origin * PREFIXES + destination] = int(days)
+
+    def cells(self):
+        """
+        @return: the matrix as a bytearray of PREFIXES * PREFIXES cells
+        """
+        self._load()
+        if self._map is not None:
+            cells = bytearray(self._map[HEADER.size:])
+        else:
+            cells = bytearray(PREFIXES * PREFIXES)
+        for cell, days in self._updates.items():
+            cells[cell] = days
+        return cells
+
+    def save(self):
+        """
+        Merge the in-memory additions into the matrix file
+        """
+        cells = self.cells()
+        self.close()
+        write_matrix(self.path, self.service or '', cells)
+        self._updates.clear()
+
+    def __len__(self):
+        """
+        @return: the number of known cells
+        """
+        cells = self.cells()
+        return len(cells) - cells.count(chr(UNKNOWN))
+
+
+def write_matrix(path, service, cells):
+    """
+    Atomically write a matrix file
+    @param path: the file to write
+    @param service: the SERVICE_NAME the standards come from
+    @param cells: PREFIXES * PREFIXES delivery days
+    """
+    def write(fileobj):
+        fileobj.write(HEADER.pack(MAGIC, service))
+        fileobj.write(str(cells))
+    atomic_write(path, write)
+
+
+def parse_prefixes(text):
+    """
+    @param text: comma separated prefixes and ranges, like "207,208,300-399"
+    @return: the list of 3-digit prefixes
+    """
+    prefixes = list()
+    for part in text.split(','):
+        part = part.strip()
+        if '-' in part:
+            low, high = part.split('-', 1)
+            prefixes.extend('%03d' % number for number in range(int(low), int(high) + 1))
+        elif part:
+            prefixes.append('%03d' % int(part))
+    return prefixes
+
+
+def build_matrix(path, service, origins, destinations):
+    """
+    Fill a matrix from the API, cells already known are not requested again
+
+    @param path: the matrix file to write
+    @param service: a PriorityMailServiceStandards or PackageServicesServiceStandards instance
+    @param origins: the 3-digit origin prefixes to fetch
+    @param destinations: the 3-digit destination prefixes to fetch
+    @return: the number of cells fetched
+    """
+    matrix = StandardsMatrix(path, service.SERVICE_NAME)
+    pairs = [(origin, destination) for origin in origins for destination in destinations
+             if matrix.get(origin, destination) is None]
+    data = [{'OriginZip': origin, 'DestinationZip': destination} for origin, destination in pairs]
+    for index, result in service.execute_iter(data):
+        if isinstance(result, Exception):
+            continue
+        if isinstance(result, dict):
+            days = result.get('Days')
+            days = days and int(days)
+        else:
+            days = result.days
+        matrix.add(pairs[index][0], pairs[index][1], days)
+    matrix.save()
+    return len(pairs)
+
+
+def build_matrix_from_responses(path, service_name, directory):
+    """
+    Fill a matrix from responses saved by a usps.transport.RecordingTransport
+
+    @param path: the matrix file to write
+    @param service_name: the SERVICE_NAME whose responses are read
+    @param directory: the directory the responses were recorded to
+    @return: the number of responses read
+    """
+    matrix = StandardsMatrix(path, service_name)
+    tag = service_name + 'Response'
+    count = 0
+    for filename in os.listdir(directory):
+        if not filename.endswith('.xml'):
+            continue
+        try:
+            root = ET.parse(os.path.join(directory, filename)).getroot()
+        except SyntaxError:
+            continue
+        if root.tag != tag:
+            continue
+        days = root.findtext('Days')
+        if days and days.strip().isdigit():
+            matrix.add(root.findtext('OriginZip'), root.findtext('DestinationZip'), int(days))
+            count += 1
+    matrix.save()
+    return count
+
+
+def main(argv=None):
+    from usps.api import USPS_CONNECTION
+    from usps.api.servicestandards import PriorityMailServiceStandards, PackageServicesServiceStandards
+    services = dict((service_class.SERVICE_NAME, service_class)
+                    for service_class in (PriorityMailServiceStandards, PackageServicesServiceStandards))
+
+    parser = optparse.OptionParser(usage='%prog [options] MATRIX')
+    parser.add_option('--service', choices=sorted(services), default='StandardB')
+    parser.add_option('--responses', help='build from responses recorded to this directory')
+    parser.add_option('--url', default=USPS_CONNECTION)
+    parser.add_option('--userid')
+    parser.add_option('--password', default='')
+    parser.add_option('--origins', default='000-999')
+    parser.add_option('--destinations', default='000-999')
+    parser.add_option('--concurrency', type='int', default=8)
+    options, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error('the matrix file is required')
+
+    if options.responses:
+        count = build_matrix_from_responses(args[0], options.service, options.responses)
+        print '%d responses read' % count
+    else:
+        if not options.userid:
+            parser.error('--userid is required to build from the API')
+        service = services[options.service](options.url, options.userid, options.password,
+                                            concurrency=options.concurrency, records=True)
+        count = build_matrix(args[0], service, parse_prefixes(options.origins),
+                             parse_prefixes(options.destinations))
+        print '%d cells fetched' % count
+    print '%d cells known' % len(StandardsMatrix(args[0]))
+
+
+if __name__ == '__main__':
+    main()
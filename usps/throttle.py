@@ -0,0 +1,213 @@
+"""
+Adaptive concurrency limiting for requests to USPS
+
+An AdaptiveConcurrency controller caps how many requests are in flight at
+once and moves the cap the way TCP moves its congestion window: every
+request that comes back quickly and without error raises it a little
+(by 1/limit, so about one per round of requests) and an error, a timeout
+or a response much slower than the fastest seen cuts it by a factor. An
+optional max_rate additionally spaces requests out to a requests/sec
+ceiling.
+
+Requests go through the controller when the service's transport is wrapped
+in a ThrottledTransport, which uses the process-wide SHARED_CONTROLLER
+unless given another, so every service in the process backs off together.
+A request holds its slot until its response is closed, so responses still
+stream, and a response USPS answers with a top level Error, the way it
+reports throttling, counts as congestion.
+"""
+import sys
+import threading
+import time
+import urllib2
+
+from usps.errors import USPSXMLError
+from usps.transport import Transport
+
+
+class AdaptiveConcurrency(object):
+    """
+    Additive increase, multiplicative decrease limit on requests in flight
+    """
+    def __init__(self, initial=4, minimum=1, maximum=64, backoff=0.7, latency_tolerance=3.0,
+                 max_rate=None):
+        """
+        @param initial: the starting limit
+        @param minimum: the limit never drops below this
+        @param maximum: the limit never grows above this
+        @param backoff: the factor the limit is multiplied by on congestion
+        @param latency_tolerance: a response this many times slower than the
+            fastest one seen counts as congestion
+        @param max_rate: an optional ceiling in requests per second
+        """
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self.max_rate = max_rate
+        self.in_flight = 0
+        self.min_latency = None
+        self._condition = threading.Condition(threading.Lock())
+        self._next_slot = 0.0
+        self._last_decrease = 0.0
+        self.successes = 0
+        self.errors = 0
+        self.decreases = 0
+        self.waits = 0
+        self.wait_time = 0.0
+
+    def acquire(self):
+        """
+        Block until a request may be sent
+        """
+        started = time.time()
+        waited = False
+        self._condition.acquire()
+        try:
+            while self.in_flight >= int(self.limit):
+                waited = True
+                self._condition.wait()
+            self.in_flight += 1
+            delay = 0.0
+            if self.max_rate:
+                now = time.time()
+                slot = max(now, self._next_slot)
+                self._next_slot = slot + 1.0 / self.max_rate
+                delay = slot - now
+        finally:
+            self._condition.release()
+        if delay > 0:
+            waited = True
+            time.sleep(delay)
+        if waited:
+            self._condition.acquire()
+            try:
+                self.waits += 1
+                self.wait_time += time.time() - started
+            finally:
+                self._condition.release()
+
+    def release(self, latency, error=False):
+        """
+        Report how a request went and let the next one through
+        @param latency: seconds the request took
+        @param error: True if it failed in a way that suggests USPS is overloaded
+        """
+        self._condition.acquire()
+        try:
+            self.in_flight -= 1
+            congested = error
+            if error:
+                self.errors += 1
+            else:
+                self.successes += 1
+                if self.min_latency is None:
+                    self.min_latency = latency
+                elif latency > self.min_latency * self.latency_tolerance:
+                    congested = True
+                #the baseline drifts up slowly so one lucky response does not pin it
+                self.min_latency = min(latency, self.min_latency * 1.01)
+            now = time.time()
+            if congested:
+                #requests in flight when congestion started fail together, count them once
+                if now - self._last_decrease > (self.min_latency or 0.0):
+                    self.limit = max(self.minimum, self.limit * self.backoff)
+                    self.decreases += 1
+                    self._last_decrease = now
+            elif self.in_flight + 1 >= int(self.limit):
+                #only grow while the limit is actually what holds requests back
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            self._condition.notify_all()
+        finally:
+            self._condition.release()
+
+    def stats(self):
+        """
+        @return: a dictionary of controller counters
+        """
+        return {'limit': int(self.limit),
+                'in_flight': self.in_flight,
+                'min_latency': self.min_latency,
+                'successes': self.successes,
+                'errors': self.errors,
+                'decreases': self.decreases,
+                'waits': self.waits,
+                'wait_time': self.wait_time,
+                }
+
+
+SHARED_CONTROLLER = AdaptiveConcurrency()
+
+
+def is_congestion(error):
+    """
+    @return: True if error suggests USPS is overloaded rather than that the request was bad
+    """
+    if isinstance(error, urllib2.HTTPError):
+        return error.code >= 500 or error.code == 429
+    if isinstance(error, USPSXMLError):
+        return error.item_id is None
+    return True
+
+
+class ThrottledResponse(object):
+    """
+    File-like wrapper holding a request's slot until the response is closed
+    """
+    def __init__(self, response, controller, started):
+        self.response = response
+        self.controller = controller
+        self.started = started
+        self.congested = False
+        self.closed = False
+
+    def read(self, amt=None):
+        try:
+            if amt is None:
+                return self.response.read()
+            return self.response.read(amt)
+        except Exception:
+            self.request_failed(sys.exc_info()[1])
+            raise
+
+    def request_failed(self, error):
+        """
+        Called by the service when the response turns out to be an error
+        """
+        self.congested = self.congested or is_congestion(error)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.controller.release(time.time() - self.started, self.congested)
+        self.response.close()
+
+
+class ThrottledTransport(Transport):
+    """
+    Sends requests through another transport under an AdaptiveConcurrency limit
+    """
+    def __init__(self, transport, controller=None):
+        """
+        @param transport: the transport actually sending requests
+        @param controller: the AdaptiveConcurrency to obey, SHARED_CONTROLLER by default
+        """
+        self.transport = transport
+        if controller is None:
+            controller = SHARED_CONTROLLER
+        self.controller = controller
+
+    def post(self, url, body):
+        self.controller.acquire()
+        started = time.time()
+        try:
+            response = self.transport.post(url, body)
+        except Exception:
+            error = sys.exc_info()[1]
+            self.controller.release(time.time() - started, is_congestion(error))
+            raise
+        return ThrottledResponse(response, self.controller, started)
+
+    def close(self):
+        self.transport.close()
@@ -0,0 +1,315 @@
+"""
+HTTP transports used to submit requests to the USPS API
+
+A transport is any object with a post(url, body) method returning a
+file-like response, USPSService accepts one at construction.
+"""
+import hashlib
+import httplib
+import os
+import re
+import socket
+import StringIO
+import threading
+import time
+import urllib2
+import urlparse
+
+from usps.errors import USPSTransportError
+from usps.utils import atomic_write
+
+
+class Transport(object):
+    """
+    Base transport
+    """
+    def post(self, url, body):
+        """
+        POST a urlencoded body to the given URL
+        @param url: the URL to post to
+        @param body: the urlencoded request body
+        @return: a file-like response object
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class UrllibTransport(Transport):
+    """
+    Opens a new connection per request with urllib2
+    """
+    def __init__(self, timeout=None):
+        """
+        @param timeout: socket timeout in seconds
+        """
+        self.timeout = timeout
+
+    def post(self, url, body):
+        if self.timeout is None:
+            return urllib2.urlopen(url, body)
+        return urllib2.urlopen(url, body, self.timeout)
+
+
+class PooledResponse(object):
+    """
+    File-like wrapper around an httplib response which hands its connection
+    back to the pool once the body has been read or the response is closed
+    """
+    def __init__(self, pool, key, connection, response):
+        self.pool = pool
+        self.key = key
+        self.connection = connection
+        self.response = response
+        self.status = response.status
+        self.reason = response.reason
+
+    def read(self, amt=None):
+        if self.response is None:
+            return ''
+        try:
+            if amt is None:
+                data = self.response.read()
+            else:
+                data = self.response.read(amt)
+        except Exception:
+            self._release(discard=True)
+            raise
+        if not data or (amt is None):
+            self._release()
+        return data
+
+    def close(self):
+        if self.response is not None:
+            #an unread body leaves the socket in an unknown state
+            self._release(discard=not self.response.isclosed())
+
+    def _release(self, discard=False):
+        response, self.response = self.response, None
+        if response is None:
+            return
+        discard = discard or response.will_close
+        response.close()
+        self.pool._put_connection(self.key, self.connection, discard)
+
+
+class HTTPConnectionPool(Transport):
+    """
+    Thread-safe keep-alive connection pool which may be shared by any number
+    of USPSService instances
+    """
+    CONNECTION_CLASSES = {'http': httplib.HTTPConnection,
+                          'https': httplib.HTTPSConnection}
+    HEADERS = {'Content-Type': 'application/x-www-form-urlencoded',
+               'Connection': 'keep-alive'}
+
+    def __init__(self, maxsize=10, idle_timeout=30, timeout=None):
+        """
+        @param maxsize: the maximum number of open connections per host
+        @param idle_timeout: seconds an unused connection is kept around
+        @param timeout: socket timeout in seconds for new connections
+        """
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._lock = threading.Condition(threading.Lock())
+        self._idle = dict()
+        self._open = dict()
+        self._acquired = 0
+        self._reused = 0
+        self._created = 0
+        self._discarded = 0
+        self._waits = 0
+        self._wait_time = 0.0
+
+    def post(self, url, body):
+        parts = urlparse.urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or '/'
+        if parts.query:
+            path = '%s?%s' % (path, parts.query)
+
+        connection, reused = self._get_connection(key)
+        try:
+            response = self._send(connection, path, body)
+        except (httplib.HTTPException, socket.error):
+            self._put_connection(key, connection, discard=True)
+            if not reused:
+                raise
+            #the server may have dropped an idle keep-alive connection
+            connection, reused = self._get_connection(key, fresh=True)
+            try:
+                response = self._send(connection, path, body)
+            except Exception:
+                self._put_connection(key, connection, discard=True)
+                raise
+        except Exception:
+            self._put_connection(key, connection, discard=True)
+            raise
+
+        wrapper = PooledResponse(self, key, connection, response)
+        if response.status != 200:
+            body = StringIO.StringIO(wrapper.read())
+            raise urllib2.HTTPError(url, response.status, response.reason,
+                                    response.msg, body)
+        return wrapper
+
+    def _send(self, connection, path, body):
+        connection.request('POST', path, body, self.HEADERS)
+        return connection.getresponse()
+
+    def _new_connection(self, key):
+        scheme, host, port = key
+        connection_class = self.CONNECTION_CLASSES[scheme]
+        if self.timeout is None:
+            return connection_class(host, port)
+        return connection_class(host, port, timeout=self.timeout)
+
+    def _get_connection(self, key, fresh=False):
+        started = None
+        self._lock.acquire()
+        try:
+            idle = self._idle.setdefault(key, [])
+            now = time.time()
+            while idle and now - idle[0][1] > self.idle_timeout:
+                #oldest connections sit at the front of the list
+                idle.pop(0)[0].close()
+                self._open[key] -= 1
+                self._discarded += 1
+            while not idle and self._open.get(key, 0) >= self.maxsize:
+                if started is None:
+                    started = time.time()
+                    self._waits += 1
+                self._lock.wait()
+            if started is not None:
+                self._wait_time += time.time() - started
+            self._acquired += 1
+            if idle and not fresh:
+                self._reused += 1
+                return idle.pop()[0], True
+            if idle:
+                idle.pop()[0].close()
+                self._discarded += 1
+            else:
+                self._open[key] = self._open.get(key, 0) + 1
+            self._created += 1
+        finally:
+            self._lock.release()
+        return self._new_connection(key), False
+
+    def _put_connection(self, key, connection, discard=False):
+        self._lock.acquire()
+        try:
+            if discard:
+                connection.close()
+                self._open[key] -= 1
+                self._discarded += 1
+            else:
+                self._idle.setdefault(key, []).append((connection, time.time()))
+            self._lock.notify()
+        finally:
+            self._lock.release()
+
+    def close(self):
+        """
+        Close every idle connection held by the pool
+        """
+        self._lock.acquire()
+        try:
+            for key, idle in self._idle.items():
+                for connection, last_used in idle:
+                    connection.close()
+                    self._open[key] -= 1
+                del idle[:]
+            self._lock.notify_all()
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """
+        @return: a dictionary of pool statistics
+        """
+        self._lock.acquire()
+        try:
+            acquired = self._acquired
+            return {'acquired': acquired,
+                    'reused': self._reused,
+                    'created': self._created,
+                    'discarded': self._discarded,
+                    'open': sum(self._open.values()),
+                    'idle': sum(len(idle) for idle in self._idle.values()),
+                    'reuse_ratio': acquired and float(self._reused) / acquired or 0.0,
+                    'waits': self._waits,
+                    'wait_time': self._wait_time,
+                    'avg_wait_time': self._waits and self._wait_time / self._waits or 0.0,
+                    }
+        finally:
+            self._lock.release()
+
+
+CREDENTIALS = re.compile(r' (?:USERID|PASSWORD)="[^"]*"')
+
+def request_key(body):
+    """
+    @param body: a urlencoded request body
+    @return: a digest of the API and XML of the request, ignoring credentials
+    """
+    params = dict(urlparse.parse_qsl(body))
+    xml = CREDENTIALS.sub('', params.get('XML', ''))
+    return hashlib.sha1('%s\n%s' % (params.get('API', ''), xml)).hexdigest()
+
+
+class RecordingTransport(Transport):
+    """
+    Passes requests to another transport and saves every response to disk
+    so a ReplayTransport can serve it later
+    """
+    def __init__(self, transport, directory):
+        """
+        @param transport: the transport actually sending requests
+        @param directory: the directory responses are written to
+        """
+        self.transport = transport
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def post(self, url, body):
+        response = self.transport.post(url, body)
+        try:
+            content = response.read()
+        finally:
+            response.close()
+        atomic_write(os.path.join(self.directory, request_key(body) + '.xml'),
+                     lambda fileobj: fileobj.write(content))
+        return StringIO.StringIO(content)
+
+    def close(self):
+        self.transport.close()
+
+
+class ReplayTransport(Transport):
+    """
+    Serves responses captured by a RecordingTransport from memory
+    """
+    def __init__(self, directory):
+        """
+        @param directory: the directory a RecordingTransport wrote to
+        """
+        self.directory = directory
+        self.responses = dict()
+        for filename in os.listdir(directory):
+            if filename.endswith('.xml'):
+                fileobj = open(os.path.join(directory, filename), 'rb')
+                try:
+                    self.responses[filename[:-4]] = fileobj.read()
+                finally:
+                    fileobj.close()
+
+    def post(self, url, body):
+        key = request_key(body)
+        content = self.responses.get(key)
+        if content is None:
+            raise USPSTransportError('No recorded response for request %s' % key)
+        return StringIO.StringIO(content)
@@ -1,11 +1,21 @@
 """
 Utility functions for use in USPS app
 """
+import mmap
+import os
+import sys
+import tempfile
 import urllib
+import threading
+import Queue
+from itertools import islice
 try:
-    from xml.etree import ElementTree as ET
+    from xml.etree import cElementTree as ET
 except ImportError:
-    from elementtree import ElementTree as ET
+    try:
+        from xml.etree import ElementTree as ET
+    except ImportError:
+        from elementtree import ElementTree as ET
     
 def utf8urlencode(data):
     """
@@ -23,59 +33,219 @@ def dicttoxml(dictionary, tagname, attributes=None):
     """
     Transform a dictionary to xml
     
-    @todo: unit tests
+    Nested dictionaries are walked with an explicit stack rather than by
+    recursion.
+    
     @param dictionary: a dictionary
-    @param parent:  a parent node
+    @param tagname: the tag of the returned element
+    @param attributes: the keys to serialize, in order, nested dictionaries
+        are serialized with the same keys
     @return: XML serialization of the given dictionary
     """
-    element = ET.Element(tagname)
-    
-    if attributes: #USPS likes things in a certain order!
-        for key in attributes:
-            value = dictionary.get(key, False)
-            if type(value).__name__ == 'dict':
-                elem = dicttoxml(value, key, attributes)
-                element.append(elem)
-            elif value != False:
-                ET.SubElement(element, key).text = value
-    else:
-        for key, value in dictionary.iteritems():
-            if type(value).__name__ == 'dict':
-                elem = dicttoxml(value, key)
-                element.append(elem)
-            else:
-                ET.SubElement(element, key).text = value
-    return element
+    SubElement = ET.SubElement
+    root = ET.Element(tagname)
+    stack = [(dictionary, root)]
+    while stack:
+        dictionary, element = stack.pop()
+        if attributes: #USPS likes things in a certain order!
+            get = dictionary.get
+            for key in attributes:
+                value = get(key, False)
+                if type(value) is dict:
+                    stack.append((value, SubElement(element, key)))
+                elif value != False:
+                    SubElement(element, key).text = value
+        else:
+            for key, value in dictionary.iteritems():
+                if type(value) is dict:
+                    stack.append((value, SubElement(element, key)))
+                else:
+                    SubElement(element, key).text = value
+    return root
 
 def xmltodict(element):
     """
     Transform an xml fragment into a python dictionary
     
-    @todo: unit tests
+    Elements with children become dictionaries which also hold their
+    attributes, childless elements with attributes become dictionaries
+    with a 'text' key and the rest become their text. Repeated tags are
+    collected in a list. The fragment is walked with an explicit stack
+    rather than by recursion.
+    
     @param element: an XML fragment
     @return: a dictionary representation of an XML fragment
     """
-    ret = dict()
-    for item in element:
-        if len(item) > 0:
-            value = xmltodict(item)         
-            if len(item.attrib.items()) > 0:
-                for k, v in item.attrib.items():
-                    value[k] = v
-        elif len(item.attrib.items()) > 0:
-            value = {'text': item.text}
-            for k, v in item.attrib.items():
-                    value[k] = v     
-        else:
-            value = item.text
-            
-        if item.tag in ret and type(ret[item.tag]).__name__ != 'list':
-            old_value = ret.get(item.tag, None)
-            ret[item.tag] = [old_value,value,]             
-        elif item.tag in ret and type(ret[item.tag]).__name__ == 'list':
-            ret[item.tag].append(value)
-        else:
-            ret[item.tag] = value
+    root = dict()
+    stack = [(element, root)]
+    pop = stack.pop
+    push = stack.append
+    attributed = list()
+    while stack:
+        element, ret = pop()
+        for item in element:
+            attrib = item.attrib
+            if len(item):
+                value = dict()
+                push((item, value))
+                if attrib:
+                    #attributes win over child tags so apply them once the children are in
+                    attributed.append((value, attrib))
+            elif attrib:
+                value = {'text': item.text}
+                value.update(attrib)
+            else:
+                value = item.text
             
-    return ret
+            tag = item.tag
+            existing = ret.get(tag, ret)
+            if existing is ret:
+                ret[tag] = value
+            elif type(existing) is list:
+                existing.append(value)
+            else:
+                ret[tag] = [existing, value]
+    for value, attrib in attributed:
+        value.update(attrib)
+    return root
+
+def chunked(iterable, size=None):
+    """
+    Split an iterable into lists of at most size items
+    
+    @param iterable: the items to split
+    @param size: the maximum chunk size, None for a single chunk
+    @return: a generator of lists
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def threaded_imap(func, iterable, workers, backlog=None):
+    """
+    Apply func to every item of an iterable from a pool of worker threads
+    
+    At most backlog items are pulled from the iterable ahead of the consumer
+    so arbitrarily long iterables run in constant memory.
+    
+    @param func: a callable taking a single item
+    @param iterable: the items to process
+    @param workers: the number of worker threads
+    @param backlog: the maximum number of outstanding items, defaults to twice workers
+    @return: a generator of (index, success, result or exception) tuples in completion order
+    """
+    if backlog is None:
+        backlog = workers * 2
+    tasks = Queue.Queue()
+    results = Queue.Queue()
+    
+    def worker():
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            index, item = task
+            try:
+                results.put((index, True, func(item)))
+            except Exception:
+                results.put((index, False, sys.exc_info()[1]))
+    
+    threads = list()
+    for i in range(workers):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    
+    pending = 0
+    try:
+        for task in enumerate(iterable):
+            tasks.put(task)
+            pending += 1
+            if pending >= backlog:
+                pending -= 1
+                yield results.get()
+        while pending:
+            pending -= 1
+            yield results.get()
+    finally:
+        for thread in threads:
+            tasks.put(None)
+    #every task is done so the workers exit straight away
+    for thread in threads:
+        thread.join()
+
+def atomic_write(path, write):
+    """
+    Write a file so readers only ever see it complete: write is called with
+    a temporary file in the same directory which then replaces path
+    
+    @param path: the file to write
+    @param write: a callable taking the open file
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    handle, temp_path = tempfile.mkstemp(dir=directory)
+    fileobj = os.fdopen(handle, 'wb')
+    try:
+        try:
+            write(fileobj)
+        finally:
+            fileobj.close()
+    except:
+        os.remove(temp_path)
+        raise
+    os.rename(temp_path, path)
 
+class MappedFile(object):
+    """
+    A file of fixed width records memory mapped on first use, with
+    additions kept in memory until they are saved
+    
+    Subclasses check the header of the mapped file in _check.
+    """
+    def __init__(self, path):
+        """
+        @param path: the file, it need not exist yet
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._map = None
+        self._updates = dict()
+    
+    def _check(self, mapped):
+        """
+        Validate the header of a newly mapped file
+        @raise ValueError: if the file is not of the expected kind
+        """
+        raise NotImplementedError
+    
+    def _load(self):
+        self._lock.acquire()
+        try:
+            if self._map is not None or not os.path.exists(self.path):
+                return
+            fileobj = open(self.path, 'rb')
+            try:
+                mapped = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+            finally:
+                fileobj.close()
+            try:
+                self._check(mapped)
+            except:
+                mapped.close()
+                raise
+            self._map = mapped
+        finally:
+            self._lock.release()
+    
+    def close(self):
+        self._lock.acquire()
+        try:
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+        finally:
+            self._lock.release()
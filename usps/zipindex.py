@@ -0,0 +1,163 @@
+"""
+Offline ZIP code to city/state index used to short-circuit CityStateLookup
+
+The index is a sorted table of fixed width records which is memory mapped
+on first use and searched with a binary search, so lookups never parse the
+file and the operating system shares its pages between processes.
+"""
+import csv
+import struct
+import time
+
+from usps.utils import MappedFile, atomic_write
+
+MAGIC = 'USPSZIP1'
+HEADER = struct.Struct('<8sI')
+#zip5, state, city, unix time the record was last confirmed
+RECORD = struct.Struct('<5s2s28sI')
+
+
+def encode_city(city):
+    """
+    @return: city as UTF-8 cut to the 28 bytes a record holds without splitting a character
+    """
+    return city.encode('utf8')[:28].decode('utf8', 'ignore').encode('utf8')
+
+
+def decode_city(city):
+    #files written before cities were cut on a character boundary may end in a partial character
+    return city.rstrip('\x00').decode('utf8', 'ignore')
+
+
+class ZipIndex(MappedFile):
+    """
+    Lazily loaded, memory mapped ZIP code index
+    """
+    def __init__(self, path, max_age=None):
+        """
+        @param path: the index file, it need not exist yet
+        @param max_age: seconds after which a record is stale and has to be
+            confirmed against the API, None to trust records forever
+        """
+        super(ZipIndex, self).__init__(path)
+        self.max_age = max_age
+        self._count = 0
+
+    def _check(self, mapped):
+        magic, count = HEADER.unpack_from(mapped, 0)
+        if magic != MAGIC:
+            raise ValueError('%s is not a ZIP code index' % self.path)
+        self._count = count
+
+    def _record(self, position):
+        return RECORD.unpack_from(self._map, HEADER.size + position * RECORD.size)
+
+    def _search(self, zip5):
+        if self._map is None:
+            self._load()
+            if self._map is None:
+                return None
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            offset = HEADER.size + middle * RECORD.size
+            key = self._map[offset:offset + 5]
+            if key < zip5:
+                low = middle + 1
+            elif key > zip5:
+                high = middle
+            else:
+                return self._record(middle)
+        return None
+
+    def get(self, zip5, include_stale=False):
+        """
+        @param zip5: a five digit ZIP code
+        @param include_stale: return records older than max_age as well
+        @return: a dictionary shaped like a CityStateLookup response or None
+        """
+        zip5 = str(zip5).strip()
+        record = self._updates.get(zip5)
+        if record is None:
+            record = self._search(zip5)
+            if record is None:
+                return None
+        key, state, city, updated = record
+        if not include_stale and self.max_age is not None and updated + self.max_age < time.time():
+            return None
+        return {'Zip5': zip5,
+                'City': decode_city(city),
+                'State': state.rstrip('\x00')}
+
+    def add(self, zip5, city, state, updated=None):
+        """
+        Record a city/state for a ZIP code, kept in memory until save is called
+        """
+        if updated is None:
+            updated = time.time()
+        self._updates[str(zip5).strip()] = (zip5, state.encode('utf8'), encode_city(city), int(updated))
+
+    def records(self):
+        """
+        @return: every record in the index as (zip5, city, state, updated) tuples sorted by ZIP code
+        """
+        self._load()
+        merged = dict()
+        count = self._map is not None and self._count or 0
+        for position in range(count):
+            zip5, state, city, updated = self._record(position)
+            merged[zip5] = (city, state, updated)
+        for zip5, (key, state, city, updated) in self._updates.items():
+            merged[zip5] = (city, state, updated)
+        return [(zip5, decode_city(city), state.rstrip('\x00'), updated)
+                for zip5, (city, state, updated) in sorted(merged.items())]
+
+    def save(self):
+        """
+        Merge the in-memory additions into the index file
+        """
+        records = self.records()
+        self.close()
+        write_index(self.path, records)
+        self._updates.clear()
+
+    def __len__(self):
+        self._load()
+        return self._count
+
+
+def write_index(path, records):
+    """
+    Atomically write an index file
+    @param path: the file to write
+    @param records: (zip5, city, state, updated) tuples
+    """
+    rows = dict()
+    for zip5, city, state, updated in records:
+        zip5 = str(zip5).strip()
+        if zip5 not in rows:
+            rows[zip5] = RECORD.pack(zip5, state.encode('utf8'), encode_city(city), int(updated))
+
+    def write(fileobj):
+        fileobj.write(HEADER.pack(MAGIC, len(rows)))
+        for zip5 in sorted(rows):
+            fileobj.write(rows[zip5])
+    atomic_write(path, write)
+
+
+def build_index_from_csv(path, csvfile, zip_field='ZIP', city_field='CITY', state_field='STATE'):
+    """
+    Build an index from a USPS ZIP code file in CSV form, the first row
+    seen for a ZIP code wins
+
+    @param path: the index file to write
+    @param csvfile: an open CSV file with a header row
+    @return: the number of ZIP codes written
+    """
+    updated = time.time()
+    records = list()
+    for row in csv.DictReader(csvfile):
+        records.append((row[zip_field].zfill(5), row[city_field].decode('utf8').upper(),
+                        row[state_field].upper(), updated))
+    write_index(path, records)
+    return len(set(record[0] for record in records))